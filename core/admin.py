@@ -1,16 +1,45 @@
-import csv
-import io
+import json
+from datetime import datetime
 
 from django import forms
+from django.conf import settings
 from django.contrib import admin, messages
-from django.shortcuts import redirect, render
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.core.paginator import Paginator
+from django.core.validators import FileExtensionValidator
+from django.db import connections
+from django.db.models import Max, Min
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import path
+from django.utils import timezone
+from django.utils.functional import cached_property
 
-from .models import Category, ProductInstance, ProductType
+from .importer import (
+    IMPORT_EXTENSIONS,
+    create_import_job,
+    fail_stale_import_jobs,
+    retry_import_job,
+)
+from .models import (
+    Category,
+    ImportedFile,
+    ImportJob,
+    PriceHistory,
+    ProductInstance,
+    ProductType,
+)
 
 
 class CsvImportForm(forms.Form):
-    csv_file = forms.FileField()
+    csv_file = forms.FileField(
+        validators=[FileExtensionValidator(IMPORT_EXTENSIONS)],
+        help_text="فایل CSV یا Excel (.xlsx)",
+    )
+    dry_run = forms.BooleanField(required=False, label="فقط پیش‌نمایش تغییرات")
+    force = forms.BooleanField(
+        required=False, label="وارد کردن دوباره فایلی که قبلاً وارد شده است"
+    )
 
 
 # Register your models here.
@@ -22,14 +51,35 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(ProductType)
 class ProductTypeAdmin(admin.ModelAdmin):
-    list_display = ("name", "category", "base_weight", "waste", "waste_ratio")
+    list_display = (
+        "name",
+        "category",
+        "unit",
+        "base_weight",
+        "waste",
+        "waste_ratio",
+    )
     list_filter = ("category",)
     search_fields = ("name",)
 
     def get_urls(self):
         urls = super().get_urls()
         new_urls = [
-            path("import-csv/", self.import_csv, name="import_csv"),
+            path(
+                "import-csv/",
+                self.admin_site.admin_view(self.import_csv),
+                name="import_csv",
+            ),
+            path(
+                "import-csv/<int:job_id>/",
+                self.admin_site.admin_view(self.import_job),
+                name="import_job",
+            ),
+            path(
+                "import-csv/<int:job_id>/status/",
+                self.admin_site.admin_view(self.import_job_status),
+                name="import_job_status",
+            ),
         ]
         return new_urls + urls
 
@@ -37,57 +87,14 @@ class ProductTypeAdmin(admin.ModelAdmin):
         if request.method == "POST":
             csv_form = CsvImportForm(request.POST, request.FILES)
             if csv_form.is_valid():
-                csv_file = request.FILES["csv_file"]
-                decoded_file = csv_file.read().decode("utf-8")
-                io_string = io.StringIO(decoded_file)
-                next(io_string)  # Skip header row
-
-                for line in csv.reader(io_string, delimiter=","):
-                    if len(line) < 3:  # Skip empty or incomplete lines
-                        continue
-
-                    # Check if this is a category line or a product line
-                    if line[1].strip() == "" and line[2].strip() == "":
-                        # This is a category line
-                        category_name = line[0].strip()
-                        if category_name:
-                            category, created = Category.objects.get_or_create(
-                                name=category_name
-                            )
-                            current_category = category
-                        else:
-                            current_category = None
-                    else:
-                        # This is a product line
-                        product_name = line[0].strip()
-                        try:
-                            base_weight = float(line[1].strip())
-                            waste = float(line[2].strip())
-
-                            # Check if product already exists
-                            try:
-                                product = ProductType.objects.get(name=product_name)
-                                product.base_weight = base_weight
-                                product.waste = waste
-                                if "current_category" in locals():
-                                    product.category = current_category
-                                product.save()
-                            except ProductType.DoesNotExist:
-                                ProductType.objects.create(
-                                    name=product_name,
-                                    base_weight=base_weight,
-                                    waste=waste,
-                                    category=(
-                                        current_category
-                                        if "current_category" in locals()
-                                        else None
-                                    ),
-                                )
-                        except (ValueError, IndexError):
-                            messages.error(request, f"Error with line: {line}")
-
-                messages.success(request, "مقادیر ثابت محصولات با موفقیت وارد شدند")
-                return redirect("admin:core_producttype_changelist")
+                # Streamed to disk and imported in the background
+                job = create_import_job(
+                    request.FILES["csv_file"],
+                    user=request.user,
+                    dry_run=csv_form.cleaned_data["dry_run"],
+                    force=csv_form.cleaned_data["force"],
+                )
+                return redirect("admin:import_job", job_id=job.pk)
             else:
                 messages.error(request, "Please correct the errors below.")
         else:
@@ -95,6 +102,210 @@ class ProductTypeAdmin(admin.ModelAdmin):
 
         return render(request, "admin/csv_import.html", {"form": csv_form})
 
+    def import_job(self, request, job_id):
+        fail_stale_import_jobs()
+        job = get_object_or_404(ImportJob, pk=job_id)
+        return render(
+            request,
+            "admin/import_job.html",
+            {
+                **self.admin_site.each_context(request),
+                "title": f"وارد کردن {job.file_name}",
+                "job": job,
+                "status": self.job_status(job),
+            },
+        )
+
+    def import_job_status(self, request, job_id):
+        fail_stale_import_jobs()
+        job = get_object_or_404(ImportJob, pk=job_id)
+        return JsonResponse(self.job_status(job))
+
+    def job_status(self, job: ImportJob) -> dict:
+        """Return the progress of an import job, as polled by its page."""
+        return {
+            "status": job.status,
+            "status_display": job.get_status_display(),
+            "finished": job.finished,
+            "percent": job.percent,
+            "rows_processed": job.rows_processed,
+            "categories_created": job.categories_created,
+            "product_types_created": job.product_types_created,
+            "product_types_updated": job.product_types_updated,
+            "rows_unchanged": job.rows_unchanged,
+            "error_count": job.error_count,
+            "errors": job.errors,
+            "message": job.message,
+        }
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "file_name",
+        "status",
+        "dry_run",
+        "rows_processed",
+        "product_types_created",
+        "product_types_updated",
+        "error_count",
+        "user",
+        "created_at",
+    )
+    list_filter = ("status", "dry_run")
+    readonly_fields = [field.name for field in ImportJob._meta.fields]
+    actions = ["retry"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        # Jobs of a restarted process are shown as failed, ready for a retry
+        fail_stale_import_jobs()
+        return super().changelist_view(request, extra_context)
+
+    @admin.action(description="اجرای دوباره کارهای ناموفق")
+    def retry(self, request, queryset):
+        retried = sum(
+            retry_import_job(job)
+            for job in queryset.filter(status=ImportJob.STATUS_FAILED)
+        )
+        self.message_user(request, f"{retried} کار دوباره اجرا شد.")
+
+
+@admin.register(ImportedFile)
+class ImportedFileAdmin(admin.ModelAdmin):
+    list_display = ("file_name", "rows", "imported_at", "sha256")
+    search_fields = ("file_name", "sha256")
+    readonly_fields = ("file_name", "rows", "imported_at", "sha256")
+
+    def has_add_permission(self, request):
+        return False
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using the row estimate of the PostgreSQL planner instead of
+    COUNT(*) when it is above ``ADMIN_ESTIMATED_COUNT_THRESHOLD``.
+    """
+
+    @cached_property
+    def count(self) -> int:
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == "postgresql":
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+                plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimate = int(plan[0]["Plan"]["Plan Rows"])
+            if estimate > settings.ADMIN_ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class AutocompleteFilter(admin.SimpleListFilter):
+    """
+    Filter on a foreign key picked with the admin autocomplete widget,
+    instead of rendering a link for every related object.
+    """
+
+    template = "admin/autocomplete_filter.html"
+    field_name = ""
+
+    def __init__(self, request, params, model, model_admin):
+        self.parameter_name = f"{self.field_name}__id__exact"
+        super().__init__(request, params, model, model_admin)
+        field = model._meta.get_field(self.field_name)
+        # The widget takes its choices from a form field of the relation
+        self.widget = field.formfield(
+            widget=AutocompleteSelect(field, model_admin.admin_site)
+        ).widget
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self) -> bool:
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.parameter_name: self.value()})
+        return queryset
+
+    def choices(self, changelist):
+        yield {
+            "selected": self.value() is None,
+            "query_string": changelist.get_query_string(remove=[self.parameter_name]),
+            "display": "همه",
+        }
+
+    def rendered_widget(self) -> str:
+        """Render the widget, it navigates to the filtered list on change."""
+        return self.widget.render(
+            self.parameter_name,
+            self.value(),
+            attrs={"id": f"filter_{self.parameter_name}"},
+        )
+
+
+class ProductTypeFilter(AutocompleteFilter):
+    title = "نوع محصول"
+    field_name = "product_type"
+
+
+class CreatedMonthFilter(admin.SimpleListFilter):
+    """
+    Drill-down by year and month of ``created_at``.
+
+    Replaces the admin date hierarchy, whose SELECT DISTINCT of truncated
+    dates reads the whole table: the years come from the first and last
+    dates, read from the ends of the index, and filtering is a range.
+    """
+
+    title = "تاریخ ایجاد"
+    parameter_name = "created"
+
+    def lookups(self, request, model_admin):
+        value = self.value() or ""
+        if value[:4].isdigit():
+            year = int(value[:4])
+            return [(str(year), str(year))] + [
+                (f"{year}-{month:02d}", f"{year}-{month:02d}") for month in range(1, 13)
+            ]
+
+        dates = model_admin.model.objects.aggregate(
+            first=Min("created_at"), last=Max("created_at")
+        )
+        if dates["first"] is None:
+            return []
+        first = timezone.localtime(dates["first"]).year
+        last = timezone.localtime(dates["last"]).year
+        return [(str(year), str(year)) for year in range(last, first - 1, -1)]
+
+    def queryset(self, request, queryset):
+        try:
+            start, end = self.period(self.value())
+        except (TypeError, ValueError):
+            return queryset
+        return queryset.filter(created_at__gte=start, created_at__lt=end)
+
+    @staticmethod
+    def period(value: str):
+        """Return the start and end of a ``YYYY`` or ``YYYY-MM`` period."""
+        if len(value) == 4:
+            year = int(value)
+            return (
+                timezone.make_aware(datetime(year, 1, 1)),
+                timezone.make_aware(datetime(year + 1, 1, 1)),
+            )
+        year, month = map(int, value.split("-"))
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+        return timezone.make_aware(start), timezone.make_aware(end)
+
 
 @admin.register(ProductInstance)
 class ProductInstanceAdmin(admin.ModelAdmin):
@@ -107,6 +318,33 @@ class ProductInstanceAdmin(admin.ModelAdmin):
         "total_price",
         "created_at",
     )
-    list_filter = ("product_type__category", "product_type")
+    list_select_related = ("product_type",)
+    list_filter = ("product_type__category", ProductTypeFilter, CreatedMonthFilter)
     search_fields = ("product_type__name",)
-    date_hierarchy = "created_at"
+    autocomplete_fields = ("product_type", "user")
+    # Served by the created_at index, like the month filter
+    ordering = ("-created_at", "-id")
+    paginator = EstimatedCountPaginator
+    # Avoid a second COUNT(*) of the whole table
+    show_full_result_count = False
+
+    @property
+    def media(self):
+        # Scripts of the autocomplete filter widgets
+        return (
+            super().media
+            + AutocompleteSelect(
+                ProductInstance._meta.get_field("product_type"), self.admin_site
+            ).media
+        )
+
+
+@admin.register(PriceHistory)
+class PriceHistoryAdmin(admin.ModelAdmin):
+    list_display = ("product_type", "user", "price_per_kilo", "unit", "effective_at")
+    list_select_related = ("product_type", "user")
+    raw_id_fields = ("product_type", "user", "product_instance")
+
+    def has_change_permission(self, request, obj=None):
+        # The price history is append-only
+        return False
@@ -6,5 +6,5 @@ class CoreConfig(AppConfig):
     name = "core"
 
     def ready(self):
-        # Import signals when the app is ready
-        pass
+        # Import signals and system checks when the app is ready
+        from . import checks, signals  # noqa: F401
@@ -0,0 +1,419 @@
+from typing import Any, Dict, Iterable, List, Optional
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from .costing import (
+    batched_recipe_recosts,
+    propagate_price_changes,
+    recalculate_recipes,
+)
+from .models import (
+    CollectionVersion,
+    PriceHistory,
+    ProductInstance,
+    ProductType,
+    Recipe,
+    RecipeItem,
+    batched_version_bumps,
+)
+from .pricing import refresh_latest_prices
+from .units import UNIT_CHOICES
+
+# Maximum number of rows in one bulk request
+MAX_BATCH_SIZE = 1000
+
+
+class ProductRowSerializer(serializers.Serializer):
+    """One product instance of a bulk request."""
+
+    id = serializers.IntegerField(required=False)
+    product_type_id = serializers.IntegerField(required=False)
+    total_weight = serializers.FloatField(required=False, min_value=0)
+    price_per_kilo = serializers.FloatField(required=False, min_value=0)
+    unit = serializers.ChoiceField(choices=UNIT_CHOICES, required=False)
+
+
+class RecipeItemRowSerializer(serializers.Serializer):
+    """One recipe item of a bulk request."""
+
+    id = serializers.IntegerField(required=False)
+    recipe = serializers.IntegerField(required=False)
+    product_instance_id = serializers.IntegerField(required=False, allow_null=True)
+    sub_recipe = serializers.IntegerField(required=False, allow_null=True)
+    quantity = serializers.FloatField(required=False, min_value=0)
+    unit = serializers.ChoiceField(
+        choices=UNIT_CHOICES, required=False, allow_blank=True
+    )
+
+
+class BulkValidationError(serializers.ValidationError):
+    """Errors of a rejected bulk request, one entry per row."""
+
+    def __init__(self, errors: List[Dict[str, Any]]):
+        super().__init__({"errors": errors})
+
+
+def _validate_rows(serializer_class, rows, required: Iterable[str]) -> List[dict]:
+    """
+    Validate the fields of every row and check the required ones.
+
+    Raises:
+        BulkValidationError: If any row is invalid, with the errors per row
+    """
+    if not isinstance(rows, list) or not rows:
+        raise serializers.ValidationError({"detail": "A list of rows is required."})
+    if len(rows) > MAX_BATCH_SIZE:
+        raise serializers.ValidationError(
+            {"detail": f"At most {MAX_BATCH_SIZE} rows are allowed per request."}
+        )
+
+    serializer = serializer_class(data=rows, many=True)
+    serializer.is_valid()
+    errors = [dict(row_errors) for row_errors in serializer.errors] or [
+        {} for _ in rows
+    ]
+    for row, row_errors in zip(rows, errors):
+        for field in required:
+            if not isinstance(row, dict) or row.get(field) is None:
+                row_errors.setdefault(field, ["This field is required."])
+    _raise_row_errors(errors)
+    return serializer.validated_data
+
+
+def _owned(queryset, user: User, lookup: str = "user"):
+    """Limit a queryset to the objects of a user, staff can use everything."""
+    if user.is_staff:
+        return queryset
+    return queryset.filter(**{lookup: user})
+
+
+def _raise_row_errors(errors: List[Dict[str, Any]]) -> None:
+    """Reject the batch if any row has errors."""
+    if any(errors):
+        raise BulkValidationError(errors)
+
+
+def _record_prices(products: List[ProductInstance], effective_at=None) -> None:
+    """Append the prices of the products to the price history in one query."""
+    PriceHistory.objects.bulk_create(
+        [
+            PriceHistory(
+                product_type_id=product.product_type_id,
+                user_id=product.user_id,
+                product_instance=product,
+                price_per_kilo=product.price_per_kilo,
+                unit=product.unit,
+                effective_at=effective_at or product.created_at,
+            )
+            for product in products
+        ],
+        batch_size=500,
+    )
+
+
+def bulk_create_products(user: User, rows: list) -> List[ProductInstance]:
+    """
+    Create product instances for a user in one transaction.
+
+    Derived fields are computed in Python and the rows are inserted with
+    ``bulk_create``. The price history and the latest price lookup are
+    maintained with one write each.
+
+    Raises:
+        BulkValidationError: If any row is invalid, nothing is written
+    """
+    data = _validate_rows(ProductRowSerializer, rows, ["product_type_id"])
+    product_types = ProductType.objects.in_bulk(
+        {row["product_type_id"] for row in data}
+    )
+    errors = [
+        (
+            {}
+            if row["product_type_id"] in product_types
+            else {"product_type_id": ["Product type not found."]}
+        )
+        for row in data
+    ]
+    _raise_row_errors(errors)
+
+    products = []
+    for row in data:
+        row.pop("id", None)
+        product = ProductInstance(
+            user=user,
+            product_type=product_types[row.pop("product_type_id")],
+            **row,
+        )
+        product.compute_derived_fields()
+        products.append(product)
+
+    with transaction.atomic():
+        products = ProductInstance.objects.bulk_create(products, batch_size=500)
+        _record_prices(products)
+        refresh_latest_prices(
+            {(product.user_id, product.product_type_id) for product in products}
+        )
+        CollectionVersion.objects.bump(product.user_id for product in products)
+    return products
+
+
+def bulk_update_products(user: User, rows: list) -> List[ProductInstance]:
+    """
+    Update product instances of a user in one transaction.
+
+    Recipes using the products whose price, unit or product type changed
+    are recalculated once at the end.
+
+    Raises:
+        BulkValidationError: If any row is invalid, nothing is written
+    """
+    data = _validate_rows(ProductRowSerializer, rows, ["id"])
+    with transaction.atomic():
+        products = (
+            _owned(ProductInstance.objects, user)
+            .select_related("product_type")
+            .select_for_update(of=("self",))
+            .in_bulk({row["id"] for row in data})
+        )
+        product_types = ProductType.objects.in_bulk(
+            {row["product_type_id"] for row in data if "product_type_id" in row}
+        )
+        errors = []
+        for row in data:
+            row_errors = {}
+            if row["id"] not in products:
+                row_errors["id"] = ["Product not found."]
+            if "product_type_id" in row and row["product_type_id"] not in product_types:
+                row_errors["product_type_id"] = ["Product type not found."]
+            errors.append(row_errors)
+        _raise_row_errors(errors)
+
+        keys = set()
+        retyped = set()
+        for row in data:
+            product = products[row.pop("id")]
+            keys.add((product.user_id, product.product_type_id))
+            if "product_type_id" in row:
+                product_type = product_types[row.pop("product_type_id")]
+                if product_type.pk != product.product_type_id:
+                    retyped.add(product.pk)
+                product.product_type = product_type
+            for field, value in row.items():
+                setattr(product, field, value)
+            product.compute_derived_fields()
+            keys.add((product.user_id, product.product_type_id))
+
+        changed = [product for product in products.values() if product.pricing_changed]
+        ProductInstance.objects.bulk_update(
+            products.values(),
+            [
+                "product_type",
+                "total_weight",
+                "price_per_kilo",
+                "unit",
+                "waste_weight",
+                "net_weight",
+                "total_price",
+            ],
+            batch_size=500,
+        )
+        _record_prices(changed, effective_at=timezone.now())
+        refresh_latest_prices(keys)
+
+        # The cost factors depend on the unit and on the density and package
+        # size of the product type
+        converted = retyped | {
+            product.pk for product in changed if product.unit_changed
+        }
+        if converted:
+            RecipeItem.objects.filter(
+                product_instance_id__in=converted
+            ).refresh_cost_factors()
+        propagate_price_changes(retyped | {product.pk for product in changed})
+        CollectionVersion.objects.bump(user_id for user_id, _ in keys)
+        for product in products.values():
+            product._loaded_pricing = (product.price_per_kilo, product.unit)
+    return list(products.values())
+
+
+def bulk_delete_products(user: User, ids: list) -> int:
+    """
+    Delete product instances of a user in one transaction, recalculating
+    each recipe that used them once.
+
+    Returns:
+        The number of deleted products
+    """
+    products = _owned(ProductInstance.objects, user).filter(pk__in=_ids(ids))
+    with transaction.atomic(), batched_version_bumps(), batched_recipe_recosts():
+        return products.delete()[1].get(ProductInstance._meta.label, 0)
+
+
+def _ids(ids: list) -> List[int]:
+    """Validate the IDs of a bulk delete request."""
+    field = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=MAX_BATCH_SIZE
+    )
+    return field.run_validation(ids)
+
+
+def _item_errors(
+    item: RecipeItem, recipe: Optional[Recipe], product, sub_recipe
+) -> Dict[str, list]:
+    """Check one recipe item against the objects resolved for the batch."""
+    errors = {}
+    if recipe is None:
+        errors["recipe"] = ["Recipe not found."]
+    if item.product_instance_id is not None and product is None:
+        errors["product_instance_id"] = ["Product not found."]
+    if item.sub_recipe_id is not None and sub_recipe is None:
+        errors["sub_recipe"] = ["Recipe not found."]
+    if errors:
+        return errors
+
+    if (item.product_instance_id is None) == (item.sub_recipe_id is None):
+        return {
+            "non_field_errors": [
+                "Exactly one of product_instance_id or sub_recipe is required."
+            ]
+        }
+    if item.sub_recipe_id is not None:
+        item.cost_factor = 1.0
+        if item.unit:
+            return {"unit": ["A unit cannot be set for a sub-recipe."]}
+        if item.creates_cycle():
+            return {"sub_recipe": ["This recipe would create a circular dependency."]}
+    else:
+        factor = item.calculate_cost_factor()
+        if factor is None:
+            return {"unit": ["This unit cannot be converted to the product unit."]}
+        item.cost_factor = factor
+    return {}
+
+
+def _resolve_items(user: User, data: List[dict], items: Dict[int, RecipeItem]):
+    """
+    Apply the rows to recipe items, resolving the recipes, products and
+    sub-recipes of the whole batch with one query each.
+
+    Returns:
+        The items and the errors, one entry per row
+    """
+    result = []
+    for row in data:
+        item = items.get(row.pop("id", None)) or RecipeItem()
+        if "recipe" in row:
+            item.recipe_id = row.pop("recipe")
+        if "product_instance_id" in row:
+            item.product_instance_id = row.pop("product_instance_id")
+        if "sub_recipe" in row:
+            item.sub_recipe_id = row.pop("sub_recipe")
+        for field, value in row.items():
+            setattr(item, field, value)
+        result.append(item)
+
+    recipes = _owned(Recipe.objects, user).in_bulk({item.recipe_id for item in result})
+    products = (
+        _owned(ProductInstance.objects, user)
+        .select_related("product_type")
+        .in_bulk({item.product_instance_id for item in result} - {None})
+    )
+    sub_recipes = _owned(Recipe.objects, user).in_bulk(
+        {item.sub_recipe_id for item in result} - {None}
+    )
+
+    errors = []
+    for item in result:
+        recipe = recipes.get(item.recipe_id)
+        product = products.get(item.product_instance_id)
+        sub_recipe = sub_recipes.get(item.sub_recipe_id)
+        if product is not None:
+            item.product_instance = product
+        if sub_recipe is not None:
+            item.sub_recipe = sub_recipe
+        errors.append(_item_errors(item, recipe, product, sub_recipe))
+    return result, errors
+
+
+def _bump_recipe_owners(items: List[RecipeItem]) -> None:
+    """Bump the collection versions of the owners of the items' recipes."""
+    CollectionVersion.objects.bump(
+        Recipe.objects.filter(pk__in={item.recipe_id for item in items}).values_list(
+            "user_id", flat=True
+        )
+    )
+
+
+def bulk_create_recipe_items(user: User, rows: list) -> List[RecipeItem]:
+    """
+    Add ingredients to recipes of a user in one transaction.
+
+    Ownership of every referenced recipe and product is checked with one
+    query per model, the items are inserted with ``bulk_create`` and each
+    affected recipe is recalculated once at the end.
+
+    Raises:
+        BulkValidationError: If any row is invalid, nothing is written
+    """
+    data = _validate_rows(RecipeItemRowSerializer, rows, ["recipe", "quantity"])
+    items, errors = _resolve_items(user, data, {})
+    _raise_row_errors(errors)
+
+    with transaction.atomic():
+        items = RecipeItem.objects.bulk_create(items, batch_size=500)
+        recalculate_recipes({item.recipe_id for item in items})
+        _bump_recipe_owners(items)
+    return items
+
+
+def bulk_update_recipe_items(user: User, rows: list) -> List[RecipeItem]:
+    """
+    Update ingredients of recipes of a user in one transaction, then
+    recalculate each affected recipe once. Items cannot be moved to another
+    recipe.
+
+    Raises:
+        BulkValidationError: If any row is invalid, nothing is written
+    """
+    data = _validate_rows(RecipeItemRowSerializer, rows, ["id"])
+    for row in data:
+        row.pop("recipe", None)
+
+    with transaction.atomic():
+        items = (
+            _owned(RecipeItem.objects, user, "recipe__user")
+            .select_for_update(of=("self",))
+            .in_bulk({row["id"] for row in data})
+        )
+        missing = [
+            {} if row["id"] in items else {"id": ["Recipe item not found."]}
+            for row in data
+        ]
+        _raise_row_errors(missing)
+
+        updated, errors = _resolve_items(user, data, items)
+        _raise_row_errors(errors)
+        RecipeItem.objects.bulk_update(
+            updated,
+            ["product_instance", "sub_recipe", "quantity", "unit", "cost_factor"],
+            batch_size=500,
+        )
+        recalculate_recipes({item.recipe_id for item in updated})
+        _bump_recipe_owners(updated)
+    return updated
+
+
+def bulk_delete_recipe_items(user: User, ids: list) -> int:
+    """
+    Delete ingredients of recipes of a user in one transaction, recalculating
+    each affected recipe once.
+
+    Returns:
+        The number of deleted items
+    """
+    items = _owned(RecipeItem.objects, user, "recipe__user").filter(pk__in=_ids(ids))
+    with transaction.atomic(), batched_version_bumps(), batched_recipe_recosts():
+        return items.delete()[1].get(RecipeItem._meta.label, 0)
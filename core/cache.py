@@ -0,0 +1,155 @@
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from .models import Category, ProductType
+
+# Key of the version stamp of the reference data in the shared cache
+VERSION_KEY = "reference:version"
+
+# In-process tier of (expiry time, value) pairs, keyed by (version, name)
+_local: "OrderedDict[Tuple[int, str], Tuple[float, Any]]" = OrderedDict()
+_local_lock = Lock()
+
+
+def _version() -> int:
+    """Return the current version stamp, starting a new one if it is missing."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Never reuse a stamp an evicted one may have had
+        cache.add(VERSION_KEY, time.time_ns(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def get_reference(name: str, loader: Callable[[], Any]) -> Any:
+    """
+    Return a piece of reference data from the in-process LRU, then from
+    Django's cache, and only load it from the database on a miss in both.
+
+    Entries are stored under the current version stamp, so bumping the stamp
+    invalidates them in every process sharing the cache backend at once.
+    In-process entries also expire after ``REFERENCE_CACHE_LOCAL_TIMEOUT``
+    seconds.
+    """
+    version = _version()
+    key = (version, name)
+    now = time.monotonic()
+    with _local_lock:
+        entry = _local.get(key)
+        if entry is not None and entry[0] > now:
+            _local.move_to_end(key)
+            return entry[1]
+
+    shared_key = f"reference:{version}:{name}"
+    value = cache.get(shared_key)
+    if value is None:
+        value = loader()
+        cache.set(shared_key, value, settings.REFERENCE_CACHE_TIMEOUT)
+
+    with _local_lock:
+        _local[key] = (now + settings.REFERENCE_CACHE_LOCAL_TIMEOUT, value)
+        _local.move_to_end(key)
+        while len(_local) > settings.REFERENCE_CACHE_LOCAL_SIZE:
+            _local.popitem(last=False)
+    return value
+
+
+def invalidate_reference_data() -> None:
+    """Invalidate the cached reference data in every process."""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # No stamp yet, nothing is cached under one
+        pass
+    with _local_lock:
+        _local.clear()
+
+
+def categories() -> List[Category]:
+    """Return all categories, ordered by ID."""
+    return get_reference("categories", lambda: list(Category.objects.order_by("pk")))
+
+
+def categories_by_id() -> Dict[int, Category]:
+    """Return all categories keyed by ID."""
+    return get_reference(
+        "categories:by_id", lambda: {obj.pk: obj for obj in categories()}
+    )
+
+
+def category(pk: int) -> Optional[Category]:
+    """Return a category by ID, or None if there is none."""
+    return categories_by_id().get(pk)
+
+
+def product_type(pk: int) -> Optional[ProductType]:
+    """
+    Return a product type with its category by ID, or None if there is none.
+
+    Product types are cached one by one, the table is too large to be
+    cached as one value.
+    """
+    return get_reference(
+        f"product_type:{pk}",
+        lambda: ProductType.objects.select_related("category").filter(pk=pk).first(),
+    )
+
+
+class CachedReferenceMixin:
+    """
+    Serve the unfiltered list pages and the detail reads of a reference data
+    viewset from the reference cache.
+
+    List pages are cached as serialized data by URL, so only the requested
+    pages of a large table are ever cached. Viewsets set ``reference_name``
+    and ``reference_object`` to a static method returning an object by ID,
+    or None. Filtered, searched or re-ordered lists and all writes go to the
+    database.
+    """
+
+    reference_name: str
+    reference_object: Callable[[int], Any]
+
+    def is_filtered(self, request) -> bool:
+        """Check whether any filter backend applies to the request."""
+        params = {
+            *getattr(self, "filterset_fields", []),
+            api_settings.SEARCH_PARAM,
+            api_settings.ORDERING_PARAM,
+        }
+        return any(param in request.query_params for param in params)
+
+    def list(self, request, *args, **kwargs):
+        if self.is_filtered(request):
+            return super().list(request, *args, **kwargs)
+
+        def load():
+            return super(CachedReferenceMixin, self).list(request, *args, **kwargs).data
+
+        # The URL holds the page, the page size and the field selection
+        url = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+        return Response(get_reference(f"{self.reference_name}:page:{url}", load))
+
+    def get_object(self):
+        if self.request.method not in SAFE_METHODS:
+            return super().get_object()
+
+        lookup = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+        try:
+            obj = self.reference_object(int(lookup))
+        except ValueError:
+            obj = None
+        if obj is None:
+            raise Http404
+        self.check_object_permissions(self.request, obj)
+        return obj
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+# Cache backends private to each process
+LOCAL_CACHE_BACKENDS = {
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Warn when the default cache is private to each process: invalidations
+    of the reference cache then never reach the other workers.
+    """
+    if settings.CACHES["default"]["BACKEND"] not in LOCAL_CACHE_BACKENDS:
+        return []
+    return [
+        Warning(
+            "The default cache is private to each process, so reference data "
+            "changed in one worker stays cached in the others.",
+            hint="Set CACHE_BACKEND to a shared backend such as Redis or "
+            "Memcached when running more than one worker.",
+            id="core.W001",
+        )
+    ]
@@ -0,0 +1,466 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from threading import local
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import (
+    CollectionVersion,
+    LatestPrice,
+    PriceHistory,
+    ProductInstance,
+    Recipe,
+    RecipeItem,
+    unit_cost,
+)
+
+# Thread local storage for collecting batched recipe recalculations
+_batch = local()
+
+
+def _walk(recipe_ids: Iterable[int], upward: bool) -> Tuple[Set[int], Set[tuple]]:
+    """
+    Walk the sub-recipe graph from the given recipes.
+
+    Args:
+        recipe_ids: IDs of the recipes to start from
+        upward: Walk to the recipes using them instead of their sub-recipes
+
+    Returns:
+        The IDs of the reached recipes (excluding the start unless it is
+        reached again) and the (recipe, sub_recipe) edges that were followed
+    """
+    reached = set()
+    edges = set()
+    frontier = set(recipe_ids)
+    while frontier:
+        if upward:
+            rows = RecipeItem.objects.filter(sub_recipe_id__in=frontier)
+            next_key = 0
+        else:
+            rows = RecipeItem.objects.filter(
+                recipe_id__in=frontier, sub_recipe__isnull=False
+            )
+            next_key = 1
+        found = set(rows.values_list("recipe_id", "sub_recipe_id"))
+        edges |= found
+        frontier = {edge[next_key] for edge in found} - reached
+        reached |= frontier
+    return reached, edges
+
+
+def topological_order(recipe_ids: Set[int], edges: Iterable[tuple]) -> List[int]:
+    """Order recipes so that every sub-recipe comes before the recipes using it."""
+    parents = defaultdict(set)
+    pending = {recipe_id: 0 for recipe_id in recipe_ids}
+    for recipe_id, sub_recipe_id in edges:
+        if recipe_id in pending and sub_recipe_id in pending:
+            if recipe_id not in parents[sub_recipe_id]:
+                parents[sub_recipe_id].add(recipe_id)
+                pending[recipe_id] += 1
+
+    order = [recipe_id for recipe_id, count in pending.items() if count == 0]
+    for recipe_id in order:
+        for parent_id in parents[recipe_id]:
+            pending[parent_id] -= 1
+            if pending[parent_id] == 0:
+                order.append(parent_id)
+    # Recipes caught in a cycle are never ready and are left out
+    return order
+
+
+def _evaluate(recipe_ids: Set[int]) -> int:
+    """
+    Recalculate the totals of the given recipes in topological order.
+
+    Product ingredients use their stored cost. Each sub-recipe's unit cost is
+    computed once and memoized, so a base used by many recipes is costed once.
+
+    Returns:
+        The number of recipes whose total changed
+    """
+    if not recipe_ids:
+        return 0
+
+    with transaction.atomic():
+        recipes = {
+            pk: (total_cost, yield_quantity)
+            for pk, total_cost, yield_quantity in Recipe.objects.select_for_update()
+            .filter(pk__in=recipe_ids)
+            .values_list("pk", "total_cost", "yield_quantity")
+        }
+        items = defaultdict(list)
+        for row in RecipeItem.objects.filter(recipe_id__in=recipe_ids).values_list(
+            "pk", "recipe_id", "sub_recipe_id", "quantity", "cost"
+        ):
+            items[row[1]].append(row)
+
+        # Unit costs of sub-recipes outside the evaluated set are stored values
+        unit_costs: Dict[int, float] = {}
+        outside = {
+            row[2]
+            for rows in items.values()
+            for row in rows
+            if row[2] is not None and row[2] not in recipes
+        }
+        for pk, total_cost, yield_quantity in Recipe.objects.filter(
+            pk__in=outside
+        ).values_list("pk", "total_cost", "yield_quantity"):
+            unit_costs[pk] = unit_cost(total_cost, yield_quantity)
+
+        edges = {
+            (row[1], row[2])
+            for rows in items.values()
+            for row in rows
+            if row[2] is not None
+        }
+        changed_items = []
+        changed_recipes = []
+        for recipe_id in topological_order(set(recipes), edges):
+            total = 0
+            for pk, _, sub_recipe_id, quantity, cost in items[recipe_id]:
+                if sub_recipe_id is not None:
+                    new_cost = quantity * unit_costs.get(sub_recipe_id, 0)
+                    if new_cost != cost:
+                        changed_items.append(RecipeItem(pk=pk, cost=new_cost))
+                    cost = new_cost
+                total += cost
+
+            stored_total, yield_quantity = recipes[recipe_id]
+            unit_costs[recipe_id] = unit_cost(total, yield_quantity)
+            if total != stored_total:
+                changed_recipes.append(
+                    Recipe(
+                        pk=recipe_id,
+                        total_cost=total,
+                        cost_version=F("cost_version") + 1,
+                    )
+                )
+
+        RecipeItem.objects.bulk_update(changed_items, ["cost"], batch_size=500)
+        Recipe.objects.bulk_update(
+            changed_recipes, ["total_cost", "cost_version"], batch_size=500
+        )
+        CollectionVersion.objects.bump(
+            Recipe.objects.filter(
+                pk__in=[recipe.pk for recipe in changed_recipes]
+            ).values_list("user_id", flat=True)
+        )
+    return len(changed_recipes)
+
+
+def propagate_to_parents(recipe_ids: Iterable[int]) -> int:
+    """
+    Recalculate every recipe that uses the given recipes, directly or through
+    other sub-recipes. Only the recipes on affected paths are touched.
+
+    Returns:
+        The number of recipes whose total changed
+    """
+    ancestors, _ = _walk(recipe_ids, upward=True)
+    return _evaluate(ancestors)
+
+
+def reevaluate_recipes(recipe_ids: Iterable[int]) -> int:
+    """
+    Re-cost recipes from their stored ingredient costs and propagate the
+    result to the recipes using them.
+
+    Returns:
+        The number of recipes whose total changed
+    """
+    recipe_ids = set(recipe_ids)
+    return _evaluate(recipe_ids) + propagate_to_parents(recipe_ids)
+
+
+def recalculate_recipes(recipe_ids: Iterable[int]) -> int:
+    """
+    Recalculate recipes from scratch, including all their sub-recipes, and
+    propagate the result to the recipes using them.
+
+    Unit conversion factors are re-derived and product ingredient costs are
+    refreshed with one set-based UPDATE, then the sub-recipe graph is costed in topological order.
+
+    Returns:
+        The number of recipes whose total changed
+    """
+    recipe_ids = set(recipe_ids)
+    descendants, _ = _walk(recipe_ids, upward=False)
+    recipe_ids |= descendants
+
+    items = RecipeItem.objects.filter(recipe_id__in=recipe_ids)
+    items.refresh_cost_factors()
+    items.refresh_costs()
+    changed = _evaluate(recipe_ids)
+    return changed + propagate_to_parents(recipe_ids)
+
+
+def propagate_price_changes(product_instance_ids: Iterable[int]) -> int:
+    """
+    Recalculate the costs of every recipe that uses the given product instances.
+
+    The affected recipes are found through the ProductInstance -> RecipeItem ->
+    Recipe reverse index and updated with two set-based UPDATEs, regardless of
+    how many products or recipes are involved. Recipes using the affected ones
+    as sub-recipes are then updated along the affected paths.
+
+    Args:
+        product_instance_ids: IDs of the product instances whose price changed
+
+    Returns:
+        The number of recipes updated
+    """
+    product_instance_ids = set(product_instance_ids)
+    if not product_instance_ids:
+        return 0
+
+    items = RecipeItem.objects.filter(product_instance_id__in=product_instance_ids)
+    items.refresh_costs()
+    affected = Recipe.objects.filter(pk__in=items.values("recipe_id"))
+    count = affected.recalculate_costs(refresh_items=False)
+    propagate_to_parents(affected.values_list("pk", flat=True))
+    return count
+
+
+@contextmanager
+def batched_recipe_recosts() -> Iterator[None]:
+    """
+    Skip the per-item cost updates of recipe items deleted in the block and
+    recalculate every affected recipe once at the end.
+    """
+    if getattr(_batch, "recipes", None) is not None:
+        # Nested block, the outermost one recalculates
+        yield
+        return
+
+    _batch.recipes = set()
+    try:
+        yield
+        recipes = _batch.recipes
+    finally:
+        _batch.recipes = None
+    recalculate_recipes(recipes)
+
+
+def recost_deferred(recipe_id: int) -> bool:
+    """
+    Record a recipe for recalculation at the end of the current
+    ``batched_recipe_recosts`` block.
+
+    Returns:
+        False outside such a block
+    """
+    recipes = getattr(_batch, "recipes", None)
+    if recipes is None:
+        return False
+    recipes.add(recipe_id)
+    return True
+
+
+def _graph_totals(
+    order: List[int], items: Dict[int, list], yields: Dict[int, float], leaf_cost
+) -> Dict[int, float]:
+    """
+    Calculate recipe totals in topological order, reusing each sub-recipe
+    total once computed.
+
+    Args:
+        order: Recipe IDs with every sub-recipe before the recipes using it
+        items: Ingredient rows by recipe ID, starting with (sub_recipe_id,
+            quantity, ...)
+        yields: Yield quantity by recipe ID
+        leaf_cost: Function returning the cost of a product ingredient row
+
+    Returns:
+        Total cost by recipe ID
+    """
+    totals = {}
+    for recipe_id in order:
+        total = 0
+        for row in items[recipe_id]:
+            if row[0] is not None:
+                sub_total = totals.get(row[0], 0)
+                total += row[1] * unit_cost(sub_total, yields[row[0]])
+            else:
+                total += leaf_cost(row)
+        totals[recipe_id] = total
+    return totals
+
+
+def market_costs(recipe_ids: Iterable[int]) -> Dict[int, float]:
+    """
+    Calculate recipe costs pricing each ingredient at the latest purchase of
+    its product type by the recipe owner, instead of the purchase picked for
+    the recipe. Prices come from the maintained latest price lookup in the
+    same query as the ingredients.
+
+    Returns:
+        Market cost by recipe ID
+    """
+    recipe_ids = set(recipe_ids)
+    closure = recipe_ids | _walk(recipe_ids, upward=False)[0]
+
+    latest = LatestPrice.objects.filter(
+        user_id=OuterRef("recipe__user_id"),
+        product_type_id=OuterRef("product_instance__product_type_id"),
+        unit=OuterRef("product_instance__unit"),
+    ).values("price_per_kilo")[:1]
+    items = defaultdict(list)
+    for row in (
+        RecipeItem.objects.filter(recipe_id__in=closure)
+        .annotate(
+            market_price=Coalesce(
+                Subquery(latest), F("product_instance__price_per_kilo")
+            )
+        )
+        .values_list(
+            "recipe_id",
+            "sub_recipe_id",
+            "quantity",
+            "cost_factor",
+            "market_price",
+        )
+    ):
+        items[row[0]].append(row[1:])
+    yields = dict(
+        Recipe.objects.filter(pk__in=closure).values_list("pk", "yield_quantity")
+    )
+    edges = {
+        (recipe_id, row[0])
+        for recipe_id, rows in items.items()
+        for row in rows
+        if row[0] is not None
+    }
+
+    totals = _graph_totals(
+        topological_order(closure, edges),
+        items,
+        yields,
+        lambda row: row[3] * row[1] * row[2],
+    )
+    return {recipe_id: totals.get(recipe_id, 0) for recipe_id in recipe_ids}
+
+
+def _end_of_day(day: date) -> datetime:
+    """Return the first moment after the given day in the current timezone."""
+    return timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+
+def _prices_before(
+    user_id: int, product_instance_ids: Set[int], moment: datetime
+) -> Dict[int, float]:
+    """
+    Look up, in one query, the latest recorded price of the product type of
+    each product instance before a moment.
+
+    Returns:
+        Prices by product instance ID, for instances with recorded history
+    """
+    latest = (
+        PriceHistory.objects.filter(
+            user_id=user_id,
+            product_type_id=OuterRef("product_type_id"),
+            unit=OuterRef("unit"),
+            effective_at__lt=moment,
+        )
+        .order_by("-effective_at", "-pk")
+        .values("price_per_kilo")[:1]
+    )
+    rows = (
+        ProductInstance.objects.filter(pk__in=product_instance_ids)
+        .annotate(price=Subquery(latest))
+        .values_list("pk", "price")
+    )
+    return {pk: price for pk, price in rows if price is not None}
+
+
+def recipe_cost_trend(recipe: Recipe, start: date, end: date) -> List[tuple]:
+    """
+    Calculate the cost of a recipe at the end of each day in a date range,
+    pricing every ingredient at the latest recorded price of its product type.
+
+    Prices are loaded with one lookup for the start of the range and one
+    range query for the changes inside it, then merged in memory day by day.
+    Ingredients without recorded history use their current price.
+
+    Returns:
+        A list of (day, total cost) tuples
+    """
+    recipe_ids = {recipe.pk} | _walk([recipe.pk], upward=False)[0]
+    items = defaultdict(list)
+    for row in RecipeItem.objects.filter(recipe_id__in=recipe_ids).values_list(
+        "recipe_id",
+        "sub_recipe_id",
+        "quantity",
+        "product_instance_id",
+        "product_instance__product_type_id",
+        "product_instance__unit",
+        "product_instance__price_per_kilo",
+        "cost_factor",
+    ):
+        items[row[0]].append(row[1:])
+    yields = dict(
+        Recipe.objects.filter(pk__in=recipe_ids).values_list("pk", "yield_quantity")
+    )
+    order = topological_order(
+        recipe_ids,
+        {
+            (recipe_id, row[0])
+            for recipe_id, rows in items.items()
+            for row in rows
+            if row[0] is not None
+        },
+    )
+
+    # Product instances by (product type, unit) to apply price changes
+    instances = defaultdict(set)
+    prices = {}
+    for rows in items.values():
+        for _, _, pk, product_type_id, unit, price, _ in rows:
+            if pk is not None:
+                instances[(product_type_id, unit)].add(pk)
+                prices[pk] = price
+
+    days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+    if not days:
+        return []
+    moments = [_end_of_day(day) for day in days]
+    prices.update(_prices_before(recipe.user_id, set(prices), moments[0]))
+    changes = (
+        PriceHistory.objects.filter(
+            user_id=recipe.user_id,
+            product_type_id__in={key[0] for key in instances},
+            effective_at__gte=moments[0],
+            effective_at__lt=moments[-1],
+        )
+        .order_by("effective_at", "pk")
+        .values_list("product_type_id", "unit", "price_per_kilo", "effective_at")
+    )
+
+    trend = []
+    changes = iter(changes)
+    change = next(changes, None)
+    for day, moment in zip(days, moments):
+        while change is not None and change[3] < moment:
+            for pk in instances.get((change[0], change[1]), ()):
+                prices[pk] = change[2]
+            change = next(changes, None)
+
+        totals = _graph_totals(
+            order,
+            items,
+            yields,
+            lambda row: prices[row[2]] * row[1] * row[6],
+        )
+        trend.append((day, totals.get(recipe.pk, 0)))
+    return trend
+
+
+def recipe_cost_as_of(recipe: Recipe, day: date) -> float:
+    """Calculate what a recipe cost at the end of a day."""
+    return recipe_cost_trend(recipe, day, day)[0][1]
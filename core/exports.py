@@ -0,0 +1,182 @@
+import csv
+import json
+from itertools import groupby
+from typing import Any, Dict, Iterable, Iterator, List
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Case, F, When
+
+from .models import unit_cost
+
+# Supported export formats
+FORMAT_CSV = "csv"
+FORMAT_NDJSON = "ndjson"
+EXPORT_FORMATS = {
+    FORMAT_CSV: "text/csv",
+    FORMAT_NDJSON: "application/x-ndjson",
+}
+
+# Rows fetched per round trip of the server-side cursor
+CHUNK_SIZE = 2000
+
+PRODUCT_COLUMNS = [
+    "id",
+    "product_type",
+    "category",
+    "total_weight",
+    "unit",
+    "price_per_kilo",
+    "waste_weight",
+    "net_weight",
+    "total_price",
+    "created_at",
+]
+
+RECIPE_COLUMNS = [
+    "id",
+    "name",
+    "total_cost",
+    "selling_price",
+    "yield_quantity",
+    "unit_cost",
+]
+
+INGREDIENT_COLUMNS = [
+    "ingredient_id",
+    "ingredient",
+    "sub_recipe_id",
+    "quantity",
+    "unit",
+    "cost",
+    "cost_share",
+]
+
+
+def product_rows(queryset) -> Iterator[Dict[str, Any]]:
+    """Yield one flat row per product instance."""
+    rows = (
+        queryset.prefetch_related(None)
+        .order_by("pk")
+        .values(
+            "id",
+            "total_weight",
+            "unit",
+            "price_per_kilo",
+            "waste_weight",
+            "net_weight",
+            "total_price",
+            "created_at",
+            product_type_name=F("product_type__name"),
+            category=F("product_type__category__name"),
+        )
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    for row in rows:
+        row["product_type"] = row.pop("product_type_name")
+        yield row
+
+
+def recipe_rows(queryset) -> Iterator[Dict[str, Any]]:
+    """
+    Yield one row per recipe with its cost breakdown under ``ingredients``.
+
+    Recipes and their ingredients are read in one ordered LEFT JOIN and
+    grouped as they stream by, so only one recipe is held in memory.
+    """
+    rows = (
+        queryset.prefetch_related(None)
+        .order_by("pk", "recipe_items__pk")
+        .values(
+            "id",
+            "name",
+            "total_cost",
+            "selling_price",
+            "yield_quantity",
+            ingredient_id=F("recipe_items__pk"),
+            sub_recipe_id=F("recipe_items__sub_recipe_id"),
+            quantity=F("recipe_items__quantity"),
+            cost=F("recipe_items__cost"),
+            ingredient=Case(
+                When(
+                    recipe_items__sub_recipe__isnull=False,
+                    then=F("recipe_items__sub_recipe__name"),
+                ),
+                default=F("recipe_items__product_instance__product_type__name"),
+            ),
+            ingredient_unit=Case(
+                When(
+                    recipe_items__unit="",
+                    then=F("recipe_items__product_instance__unit"),
+                ),
+                default=F("recipe_items__unit"),
+            ),
+        )
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    for _, group in groupby(rows, key=lambda row: row["id"]):
+        group = list(group)
+        first = group[0]
+        total_cost = first["total_cost"]
+        recipe = {column: first[column] for column in RECIPE_COLUMNS if column in first}
+        recipe["unit_cost"] = unit_cost(total_cost, first["yield_quantity"])
+        recipe["ingredients"] = [
+            {
+                "ingredient_id": row["ingredient_id"],
+                "ingredient": row["ingredient"],
+                "sub_recipe_id": row["sub_recipe_id"],
+                "quantity": row["quantity"],
+                "unit": row["ingredient_unit"] or "",
+                "cost": row["cost"],
+                "cost_share": (row["cost"] / total_cost * 100) if total_cost else 0,
+            }
+            for row in group
+            if row["ingredient_id"] is not None
+        ]
+        yield recipe
+
+
+class _Echo:
+    """File-like object returning what is written, for streaming csv output."""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def render_csv(rows: Iterable[Dict[str, Any]], columns: List[str]) -> Iterator[str]:
+    """Render rows as CSV lines, starting with a header."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([row.get(column) for column in columns])
+
+
+def render_ndjson(rows: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    """Render rows as newline delimited JSON."""
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + "\n"
+
+
+def _flatten_recipes(recipes: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """One CSV row per ingredient, a single row for recipes without any."""
+    for recipe in recipes:
+        ingredients = recipe.pop("ingredients")
+        if not ingredients:
+            yield recipe
+        for ingredient in ingredients:
+            yield {**recipe, **ingredient}
+
+
+def export_products(queryset, file_format: str) -> Iterator[str]:
+    """Stream the products of a queryset in the given format."""
+    rows = product_rows(queryset)
+    if file_format == FORMAT_CSV:
+        return render_csv(rows, PRODUCT_COLUMNS)
+    return render_ndjson(rows)
+
+
+def export_recipes(queryset, file_format: str) -> Iterator[str]:
+    """Stream the recipes of a queryset with their cost breakdown."""
+    rows = recipe_rows(queryset)
+    if file_format == FORMAT_CSV:
+        return render_csv(_flatten_recipes(rows), RECIPE_COLUMNS + INGREDIENT_COLUMNS)
+    return render_ndjson(rows)
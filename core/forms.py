@@ -2,10 +2,42 @@ from typing import Any, Optional
 
 from django import forms
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.forms.models import ModelChoiceIterator
+from django.urls import reverse_lazy
 
 from .models import ProductInstance, Recipe, RecipeItem
 
 
+class AutocompleteSelect(forms.Select):
+    """
+    Select whose options are loaded page by page by a Select2 autocomplete.
+
+    Only the selected options are rendered, so the page does not preload
+    every object of the field's queryset.
+    """
+
+    def __init__(self, url, attrs: Optional[dict] = None) -> None:
+        attrs = {**(attrs or {}), "data-ajax--url": url, "data-ajax--delay": 250}
+        super().__init__(attrs)
+
+    def optgroups(self, name, value, attrs=None):
+        choices = self.choices
+        if isinstance(choices, ModelChoiceIterator):
+            selected = [pk for pk in value if pk]
+            try:
+                objects = list(choices.queryset.filter(pk__in=selected))
+            except (ValueError, ValidationError):
+                objects = []
+            self.choices = [("", choices.field.empty_label or "")] + [
+                choices.choice(obj) for obj in objects
+            ]
+        try:
+            return super().optgroups(name, value, attrs)
+        finally:
+            self.choices = choices
+
+
 class ProductForm(forms.ModelForm):
     """
     Form for creating and editing product instances.
@@ -14,6 +46,12 @@ class ProductForm(forms.ModelForm):
     class Meta:
         model = ProductInstance
         fields = ["product_type", "total_weight", "unit", "price_per_kilo"]
+        widgets = {
+            # Results carry the unit of each product type
+            "product_type": AutocompleteSelect(
+                reverse_lazy("product_type_autocomplete")
+            ),
+        }
 
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         """
@@ -32,7 +70,7 @@ class RecipeForm(forms.ModelForm):
 
     class Meta:
         model = Recipe
-        fields = ["name", "description", "selling_price"]
+        fields = ["name", "description", "selling_price", "yield_quantity"]
         widgets = {
             "name": forms.TextInput(
                 attrs={"class": "form-control", "placeholder": "نام غذا را وارد کنید"}
@@ -47,6 +85,9 @@ class RecipeForm(forms.ModelForm):
             "selling_price": forms.NumberInput(
                 attrs={"class": "form-control", "placeholder": "قیمت فروش"}
             ),
+            "yield_quantity": forms.NumberInput(
+                attrs={"class": "form-control", "step": "0.01", "min": "0"}
+            ),
         }
 
 
@@ -57,14 +98,17 @@ class RecipeItemForm(forms.ModelForm):
 
     class Meta:
         model = RecipeItem
-        fields = ["product_instance", "quantity"]
+        fields = ["product_instance", "sub_recipe", "quantity", "unit"]
         widgets = {
-            "product_instance": forms.Select(
-                attrs={"class": "form-control recipe-product-select"}
+            "product_instance": AutocompleteSelect(
+                reverse_lazy("product_autocomplete"),
+                attrs={"class": "form-control recipe-product-select"},
             ),
+            "sub_recipe": forms.Select(attrs={"class": "form-control"}),
             "quantity": forms.NumberInput(
                 attrs={"class": "form-control", "step": "0.01", "min": "0"}
             ),
+            "unit": forms.Select(attrs={"class": "form-control"}),
         }
 
     def __init__(self, user: Optional[User] = None, *args: Any, **kwargs: Any) -> None:
@@ -79,7 +123,12 @@ class RecipeItemForm(forms.ModelForm):
             # Only show products belonging to the current user
             self.fields["product_instance"].queryset = ProductInstance.objects.filter(
                 user=user
-            )
+            ).select_related("product_type")
+            # Only the user's recipes can be used as sub-recipes
+            sub_recipes = Recipe.objects.filter(user=user)
+            if self.instance.recipe_id:
+                sub_recipes = sub_recipes.exclude(pk=self.instance.recipe_id)
+            self.fields["sub_recipe"].queryset = sub_recipes
 
             # Modify how products are displayed in the dropdown - show only product name
             self.fields["product_instance"].label_from_instance = (
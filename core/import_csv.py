@@ -1,11 +1,8 @@
-import csv
 import os
 import sys
 
 import django
 
-from core.models import Category, ProductType
-
 # Add the project directory to the Python path
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
@@ -15,72 +12,23 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "db_fa.settings")
 django.setup()
 
 # Import after Django setup
+from core.importer import import_file  # noqa: E402 isort: skip
 
 
-def import_csv_data(csv_file_path):
+def import_csv_data(csv_file_path, dry_run=False):
     """
     Import product types from CSV file
     """
-    # Import from CSV
-    with open(csv_file_path, "r", encoding="utf-8") as f:
-        csv_reader = csv.reader(f)
-        # Skip header row
-        next(csv_reader)
-
-        current_category = None
-
-        for row in csv_reader:
-            if not row or len(row) < 3:
-                continue
-
-            product_name = row[0].strip()
-            base_weight_str = row[1].strip() if len(row) > 1 else ""
-            waste_str = row[2].strip() if len(row) > 2 else ""
-
-            try:
-                # Check if this is a category row (no values in other columns)
-                if base_weight_str == "" and waste_str == "":
-                    # This is a category
-                    if product_name:
-                        category, created = Category.objects.get_or_create(
-                            name=product_name
-                        )
-                        current_category = category
-                        print(
-                            f"Category {'created' if created else 'retrieved'}: {product_name}"
-                        )
-                else:
-                    # This is a product
-                    if product_name:
-                        try:
-                            base_weight = (
-                                float(base_weight_str) if base_weight_str else 0
-                            )
-                            waste = float(waste_str) if waste_str else 0
-
-                            # Check if product already exists
-                            try:
-                                product = ProductType.objects.get(name=product_name)
-                                product.base_weight = base_weight
-                                product.waste = waste
-                                if current_category:
-                                    product.category = current_category
-                                product.save()
-                                print(f"Product type updated: {product_name}")
-                            except ProductType.DoesNotExist:
-                                ProductType.objects.create(
-                                    name=product_name,
-                                    base_weight=base_weight,
-                                    waste=waste,
-                                    category=current_category,
-                                )
-                                print(f"Product type created: {product_name}")
-                        except ValueError as e:
-                            print(
-                                f"Error converting numeric values for product {product_name}: {str(e)}"
-                            )
-            except Exception as e:
-                print(f"Error processing row {row}: {str(e)}")
+    result = import_file(csv_file_path, dry_run=dry_run)
+    for error in result.errors:
+        print(error)
+    print(
+        f"Categories created: {len(result.categories_created)}, "
+        f"product types created: {len(result.product_types_created)}, "
+        f"updated: {len(result.product_types_updated)}, "
+        f"unchanged: {result.unchanged}"
+    )
+    return result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,710 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+from threading import Thread
+from typing import (
+    IO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from openpyxl import load_workbook
+
+from .cache import invalidate_reference_data
+from .models import (
+    Category,
+    CollectionVersion,
+    ImportedFile,
+    ImportJob,
+    ProductInstance,
+    ProductType,
+    SearchTerm,
+    batched_version_bumps,
+)
+from .search import index_objects
+from .units import GRAM, PIECE, UNITS
+
+logger = logging.getLogger(__name__)
+
+# Default units by product or category name, for rows without a unit
+DEFAULT_UNITS = {
+    "پروتیئن": GRAM,
+    "راسته گوساله": GRAM,
+    "فیله گوساله": GRAM,
+    "سبزیجات": GRAM,
+    "کاهو": GRAM,
+    "گوجه فرنگی": GRAM,
+    "خیار": GRAM,
+    "نوشیدنی": PIECE,  # Default for drinks is piece/unit
+    "آب پرتقال": PIECE,
+    "نوشابه": PIECE,
+    "آب معدنی": PIECE,
+}
+
+# Extensions of the files that can be imported
+IMPORT_EXTENSIONS = ["csv", "xlsx"]
+
+# Rows per bulk INSERT or UPDATE
+CHUNK_SIZE = 2000
+
+# Rows between two progress reports
+PROGRESS_ROWS = 5000
+
+# Job fields updated by progress reports
+PROGRESS_FIELDS = [
+    "bytes_read",
+    "rows_processed",
+    "categories_created",
+    "product_types_created",
+    "product_types_updated",
+    "rows_unchanged",
+    "error_count",
+    "errors",
+    "updated_at",
+]
+
+# Product type fields an import sets
+IMPORTED_FIELDS = ["base_weight", "waste", "unit", "category"]
+
+
+class ImportResult:
+    """Outcome of a product type import, or of a dry run of one."""
+
+    def __init__(self, dry_run: bool = False):
+        self.dry_run = dry_run
+        # Set when the file was already imported
+        self.skipped = False
+        self.rows = 0
+        self.unchanged = 0
+        self.categories_created: List[str] = []
+        self.product_types_created: List[str] = []
+        self.product_types_updated: List[str] = []
+        self.errors: List[str] = []
+
+    def summary(self) -> str:
+        """Describe the outcome in one paragraph per count."""
+        if self.skipped:
+            return "این فایل قبلاً وارد شده است و از وارد کردن دوباره آن صرف‌نظر شد."
+        title = (
+            "پیش‌نمایش وارد کردن انواع محصول (بدون ذخیره):"
+            if self.dry_run
+            else "عملیات وارد کردن انواع محصول به پایان رسید."
+        )
+        return f"""{title}
+تعداد سطرهای پردازش شده: {self.rows}
+تعداد دسته‌بندی‌های جدید: {len(self.categories_created)}
+تعداد محصولات جدید: {len(self.product_types_created)}
+تعداد محصولات به‌روزرسانی شده: {len(self.product_types_updated)}
+تعداد محصولات بدون تغییر: {self.unchanged}
+تعداد خطاها: {len(self.errors)}"""
+
+
+def read_csv(file: IO[str]) -> Iterator[List[str]]:
+    """Return the rows of a CSV file after its header row."""
+    reader = csv.reader(file)
+    next(reader, None)
+    return reader
+
+
+def _cell_text(value) -> str:
+    """Return the text of a spreadsheet cell as it would appear in a CSV."""
+    return "" if value is None else str(value).strip()
+
+
+def read_xlsx(sheet) -> Iterator[List[str]]:
+    """
+    Return the rows of a worksheet after its header row, as text.
+
+    Rows are padded to the width of the header, since streamed rows end at
+    their last non-empty cell.
+    """
+    rows = sheet.iter_rows(values_only=True)
+    width = len(next(rows, ()))
+    for row in rows:
+        cells = [_cell_text(value) for value in row]
+        yield cells + [""] * (width - len(cells))
+
+
+@contextmanager
+def open_rows(path: str) -> Iterator[Tuple[Iterator[List[str]], Callable[[], float]]]:
+    """
+    Open a CSV or Excel (.xlsx) file for an import, without loading it.
+
+    CSV files are decoded as they are read. Workbooks are opened in
+    read-only mode, which streams the rows of the first sheet from the
+    archive, so memory use does not depend on the size of the sheet.
+
+    Yields:
+        The rows after the header row, and a function returning the share
+        of the file read so far
+    """
+    if os.path.splitext(path)[1].lower() == ".xlsx":
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            sheet = workbook.active
+            # Declared by the sheet, missing in some generated files
+            total = sheet.max_row or 0
+            rows = read_xlsx(sheet)
+            read = [0]
+
+            def counted() -> Iterator[List[str]]:
+                for index, row in enumerate(rows, start=2):
+                    read[0] = index
+                    yield row
+
+            yield counted(), lambda: min(read[0] / total, 1) if total else 0
+        finally:
+            workbook.close()
+        return
+
+    size = os.path.getsize(path)
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        yield read_csv(f), lambda: f.buffer.tell() / size if size else 0
+
+
+def _chunks(items: list, size: int) -> Iterator[list]:
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+def _parse_number(value: str) -> float:
+    return float(value) if value else 0
+
+
+def fingerprint(
+    name: str, base_weight: float, waste: float, unit: str, category: str
+) -> str:
+    """Return the fingerprint of a parsed product type row."""
+    key = json.dumps([name, base_weight, waste, unit, category], ensure_ascii=False)
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """Return the SHA-256 of the content of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _Row(NamedTuple):
+    """A parsed product type row for an existing product type."""
+
+    base_weight: float
+    waste: float
+    unit: str
+    category: Optional[Category]
+    fingerprint: str
+
+
+def _write_batch(
+    result: ImportResult,
+    new_categories: List[Category],
+    created: Dict[str, ProductType],
+    changes: Dict[int, _Row],
+    known: Dict[str, Tuple[Optional[int], str]],
+    touched: Set[int],
+    dry_run: bool,
+    chunk_size: int,
+) -> None:
+    """
+    Compare a batch of imported rows to their product types and write it.
+
+    The batch is written in one transaction, with its side effects. The new
+    product types and fingerprints are recorded in ``known``, and the
+    product types created or updated so far in ``touched``, so that names
+    repeated in later batches are only counted once.
+    """
+    # Compare the rows without a matching fingerprint to their product types
+    updated: Dict[int, ProductType] = {}
+    fingerprinted: List[ProductType] = []
+    for chunk in _chunks(list(changes), chunk_size):
+        for product_type in ProductType.objects.filter(pk__in=chunk):
+            change = changes[product_type.pk]
+            unit = change.unit or product_type.unit
+            moved = change.category is not None and (
+                change.category.pk is None
+                or change.category.pk != product_type.category_id
+            )
+            product_type.import_fingerprint = change.fingerprint
+            if not moved and (
+                product_type.base_weight,
+                product_type.waste,
+                product_type.unit,
+            ) == (change.base_weight, change.waste, unit):
+                result.unchanged += 1
+                fingerprinted.append(product_type)
+                continue
+            product_type.base_weight = change.base_weight
+            product_type.waste = change.waste
+            product_type.unit = unit
+            if change.category is not None:
+                product_type.category = change.category
+            updated[product_type.pk] = product_type
+
+    result.categories_created += [category.name for category in new_categories]
+    result.product_types_created += list(created)
+    result.product_types_updated += [
+        obj.name for pk, obj in updated.items() if pk not in touched
+    ]
+    touched.update(updated)
+    if dry_run:
+        for name, product_type in created.items():
+            known[name] = (None, product_type.import_fingerprint)
+        return
+    if not (new_categories or created or updated or fingerprinted):
+        return
+
+    with transaction.atomic():
+        Category.objects.bulk_create(new_categories, batch_size=chunk_size)
+        ProductType.objects.bulk_create(created.values(), batch_size=chunk_size)
+        # Upsert on the primary key: one INSERT ... ON CONFLICT DO UPDATE per
+        # chunk, much cheaper than the CASE expressions of bulk_update
+        for objects, fields in [
+            (updated.values(), [*IMPORTED_FIELDS, "import_fingerprint"]),
+            (fingerprinted, ["import_fingerprint"]),
+        ]:
+            ProductType.objects.bulk_create(
+                objects,
+                batch_size=chunk_size,
+                update_conflicts=True,
+                unique_fields=["id"],
+                update_fields=fields,
+            )
+        for obj in [*created.values(), *updated.values(), *fingerprinted]:
+            known[obj.name] = (obj.pk, obj.import_fingerprint)
+        touched.update(obj.pk for obj in created.values())
+        if not (new_categories or created or updated):
+            # Only fingerprints were stored
+            return
+
+        waste_changed = [
+            pk
+            for pk, obj in updated.items()
+            if obj._loaded_waste != (obj.base_weight, obj.waste)
+        ]
+        with batched_version_bumps():
+            for chunk in _chunks(waste_changed, chunk_size):
+                ProductInstance.objects.filter(
+                    product_type__in=chunk
+                ).recompute_derived_fields()
+            # Products embed their product type and category
+            for chunk in _chunks(list(updated), chunk_size):
+                CollectionVersion.objects.bump(
+                    ProductInstance.objects.filter(product_type__in=chunk)
+                    .values_list("user_id", flat=True)
+                    .distinct()
+                )
+        for chunk in _chunks(list(created.values()), chunk_size):
+            index_objects(SearchTerm.KIND_PRODUCT_TYPE, chunk)
+        invalidate_reference_data()
+
+
+def import_product_types(
+    rows: Iterable[Sequence[str]],
+    dry_run: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+    progress: Optional[Callable[[ImportResult], None]] = None,
+) -> ImportResult:
+    """
+    Create and update categories and product types from CSV rows.
+
+    Rows are ``name, base_weight, waste[, unit]``. A row without base weight
+    and waste starts a category, which the following product types belong
+    to. Product types are matched to existing ones by name; those without a
+    unit keep theirs, or get the default of their name or category when new.
+
+    Every imported row is fingerprinted, and the fingerprint stored on its
+    product type. Only the ids and fingerprints of the existing product
+    types are kept, by name: rows with the stored fingerprint are skipped,
+    and just the product types of the other rows are loaded and compared,
+    so the work follows the size of the change rather than of the catalog.
+    Saving a product type outside imports clears its fingerprint.
+
+    The changes are written while the rows are read, once ``chunk_size``
+    product types are pending, so memory use does not grow with the file.
+    Each batch is written with ``bulk_create`` calls in its own transaction,
+    upserting the updated product types on their primary key; an import
+    that fails part way keeps the batches written before, and importing the
+    file again skips them by fingerprint. Since bulk writes send no signals,
+    the instances of product types whose waste changed are re-derived, the
+    search terms of new product types indexed, and the affected collection
+    versions and the reference cache bumped here.
+
+    Args:
+        rows: CSV rows, without the header row
+        dry_run: Only report what would be created and updated
+        chunk_size: Number of product types per batch and per bulk query
+        progress: Called with the partial result every ``PROGRESS_ROWS``
+            rows and once all rows are imported
+
+    Returns:
+        The counts of the import, or of the planned import in a dry run
+    """
+    result = ImportResult(dry_run)
+
+    categories: Dict[str, Category] = {}
+    for category in Category.objects.order_by("pk"):
+        categories.setdefault(category.name, category)
+    # Product types created in a dry run have no id
+    known: Dict[str, Tuple[Optional[int], str]] = {}
+    for pk, name, stored in ProductType.objects.order_by("pk").values_list(
+        "pk", "name", "import_fingerprint"
+    ):
+        known.setdefault(name, (pk, stored))
+    touched: Set[int] = set()
+
+    new_categories: List[Category] = []
+    created: Dict[str, ProductType] = {}
+    changes: Dict[int, _Row] = {}
+    current_category: Optional[Category] = None
+
+    for line, row in enumerate(rows, start=2):
+        if len(created) + len(changes) >= chunk_size:
+            _write_batch(
+                result,
+                new_categories,
+                created,
+                changes,
+                known,
+                touched,
+                dry_run,
+                chunk_size,
+            )
+            new_categories, created, changes = [], {}, {}
+        if len(row) < 3:
+            continue
+        result.rows += 1
+        if progress is not None and result.rows % PROGRESS_ROWS == 0:
+            progress(result)
+        name = row[0].strip()
+        base_weight_str = row[1].strip()
+        waste_str = row[2].strip()
+        unit = row[3].strip() if len(row) > 3 else ""
+
+        if not base_weight_str and not waste_str:
+            # Category row
+            if name:
+                current_category = categories.get(name)
+                if current_category is None:
+                    current_category = categories[name] = Category(name=name)
+                    new_categories.append(current_category)
+            continue
+        if not name:
+            continue
+
+        try:
+            base_weight = _parse_number(base_weight_str)
+            waste = _parse_number(waste_str)
+        except ValueError as e:
+            result.errors.append(
+                f"سطر {line}: خطا در تبدیل مقادیر عددی برای محصول {name}: {e}"
+            )
+            continue
+        if unit and unit not in UNITS:
+            result.errors.append(f"سطر {line}: واحد نامعتبر برای محصول {name}: {unit}")
+            continue
+
+        row_fingerprint = fingerprint(
+            name,
+            base_weight,
+            waste,
+            unit,
+            current_category.name if current_category else "",
+        )
+        if name in known:
+            pk, stored = known[name]
+            if pk is None:
+                # Repeated in the file, counted when first created
+                continue
+            if stored == row_fingerprint and pk not in changes:
+                result.unchanged += 1
+            else:
+                changes[pk] = _Row(
+                    base_weight, waste, unit, current_category, row_fingerprint
+                )
+            continue
+
+        product_type = created.get(name)
+        if product_type is None:
+            created[name] = ProductType(
+                name=name,
+                base_weight=base_weight,
+                waste=waste,
+                category=current_category,
+                unit=unit
+                or DEFAULT_UNITS.get(
+                    name,
+                    DEFAULT_UNITS.get(
+                        current_category.name if current_category else "", GRAM
+                    ),
+                ),
+                import_fingerprint=row_fingerprint,
+            )
+            continue
+        # Repeated in the file, the last row wins
+        product_type.base_weight = base_weight
+        product_type.waste = waste
+        product_type.unit = unit or product_type.unit
+        if current_category is not None:
+            product_type.category = current_category
+        product_type.import_fingerprint = row_fingerprint
+
+    _write_batch(
+        result,
+        new_categories,
+        created,
+        changes,
+        known,
+        touched,
+        dry_run,
+        chunk_size,
+    )
+    if progress is not None:
+        progress(result)
+    return result
+
+
+def import_file(
+    path: str,
+    dry_run: bool = False,
+    force: bool = False,
+    progress: Optional[Callable[[ImportResult, float], None]] = None,
+    name: str = "",
+) -> ImportResult:
+    """
+    Import the product types of a UTF-8 CSV or an Excel (.xlsx) file.
+
+    Files are identified by the hash of their content. A file that was
+    already imported is skipped, unless forced.
+
+    Args:
+        progress: Called with the partial result and the share of the file
+            read so far
+        name: Name of the file to record, defaults to the name in the path
+    """
+    digest = file_digest(path)
+    if not force and ImportedFile.objects.filter(sha256=digest).exists():
+        result = ImportResult(dry_run)
+        result.skipped = True
+        return result
+
+    with open_rows(path) as (rows, share_read):
+
+        def _report(result: ImportResult) -> None:
+            progress(result, share_read())
+
+        report = _report if progress is not None else None
+        result = import_product_types(rows, dry_run=dry_run, progress=report)
+
+    if not dry_run:
+        ImportedFile.objects.update_or_create(
+            sha256=digest,
+            defaults={
+                "file_name": name or os.path.basename(path),
+                "rows": result.rows,
+                "imported_at": timezone.now(),
+            },
+        )
+    return result
+
+
+def save_upload(upload) -> str:
+    """
+    Stream an uploaded file to a new file in ``IMPORT_UPLOAD_DIR`` chunk by
+    chunk.
+
+    Returns:
+        The path of the new file
+    """
+    os.makedirs(settings.IMPORT_UPLOAD_DIR, exist_ok=True)
+    # The extension tells the file format apart
+    suffix = os.path.splitext(upload.name)[1].lower()
+    with tempfile.NamedTemporaryFile(
+        dir=settings.IMPORT_UPLOAD_DIR, prefix="import-", suffix=suffix, delete=False
+    ) as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
+    return f.name
+
+
+def create_import_job(
+    upload, user=None, dry_run: bool = False, force: bool = False
+) -> ImportJob:
+    """Save an uploaded file and start a background job importing it."""
+    job = ImportJob.objects.create(
+        user=user,
+        file_name=upload.name,
+        path=save_upload(upload),
+        dry_run=dry_run,
+        force=force,
+        bytes_total=upload.size,
+    )
+    start_import_job(job)
+    return job
+
+
+def _record_progress(job: ImportJob, result: ImportResult, bytes_read: int) -> None:
+    """Copy the counters of a partial or final result to a job."""
+    job.bytes_read = bytes_read
+    job.rows_processed = result.rows
+    job.categories_created = len(result.categories_created)
+    job.product_types_created = len(result.product_types_created)
+    job.product_types_updated = len(result.product_types_updated)
+    job.rows_unchanged = result.unchanged
+    job.error_count = len(result.errors)
+    job.errors = result.errors[: ImportJob.MAX_STORED_ERRORS]
+
+
+def run_import_job(job_id: int) -> bool:
+    """
+    Claim a pending import job and run it, recording its progress on the job
+    as the file is read. The uploaded file is removed afterwards.
+
+    Returns:
+        Whether the job was claimed, jobs claimed by another worker are
+        skipped
+    """
+    with transaction.atomic():
+        job = (
+            ImportJob.objects.select_for_update(skip_locked=True)
+            .filter(pk=job_id, status=ImportJob.STATUS_PENDING)
+            .first()
+        )
+        if job is None:
+            return False
+        job.status = ImportJob.STATUS_RUNNING
+        job.started_at = timezone.now()
+        job.save(update_fields=["status", "started_at", "updated_at"])
+
+    try:
+
+        def report(result: ImportResult, share_read: float) -> None:
+            _record_progress(job, result, int(job.bytes_total * share_read))
+            job.save(update_fields=PROGRESS_FIELDS)
+
+        result = import_file(
+            job.path,
+            dry_run=job.dry_run,
+            force=job.force,
+            progress=report,
+            name=job.file_name,
+        )
+    except Exception as e:
+        logger.exception("Import job %s failed", job.pk)
+        job.status = ImportJob.STATUS_FAILED
+        job.message = str(e)
+    else:
+        _record_progress(job, result, job.bytes_total)
+        job.status = ImportJob.STATUS_DONE
+        job.message = result.summary()
+    finally:
+        job.finished_at = timezone.now()
+        job.save()
+        try:
+            os.remove(job.path)
+        except OSError:
+            pass
+    return True
+
+
+def _work(job_id: int) -> None:
+    """Background thread running one import job."""
+    try:
+        run_import_job(job_id)
+    except Exception:
+        logger.exception("Import job %s failed", job_id)
+    finally:
+        close_old_connections()
+
+
+def start_import_job(job: ImportJob) -> None:
+    """
+    Run an import job in a background thread once the current transaction
+    commits, or right away with ``IMPORT_ASYNC`` disabled.
+    """
+    if not settings.IMPORT_ASYNC:
+        run_import_job(job.pk)
+        return
+    transaction.on_commit(
+        lambda: Thread(
+            target=_work, args=(job.pk,), name=f"import-job-{job.pk}", daemon=True
+        ).start()
+    )
+
+
+def fail_stale_import_jobs() -> int:
+    """
+    Fail the running import jobs that reported no progress for
+    ``IMPORT_STALE_SECONDS``, since their thread or worker died with its
+    process. Their uploaded file is kept, so they can be retried.
+
+    Returns:
+        The number of jobs failed
+    """
+    now = timezone.now()
+    return ImportJob.objects.filter(
+        status=ImportJob.STATUS_RUNNING,
+        updated_at__lt=now - timedelta(seconds=settings.IMPORT_STALE_SECONDS),
+    ).update(
+        status=ImportJob.STATUS_FAILED,
+        message="اجرای این کار متوقف شد، برای مثال با راه‌اندازی دوباره سرور.",
+        finished_at=now,
+        updated_at=now,
+    )
+
+
+def retry_import_job(job: ImportJob) -> bool:
+    """
+    Queue a failed import job again and start it. Rows written before the
+    failure are skipped by their fingerprints.
+
+    Returns:
+        Whether the job was queued, jobs whose uploaded file was removed
+        cannot be retried
+    """
+    if not os.path.exists(job.path):
+        return False
+    queued = ImportJob.objects.filter(pk=job.pk, status=ImportJob.STATUS_FAILED).update(
+        status=ImportJob.STATUS_PENDING,
+        message="",
+        started_at=None,
+        finished_at=None,
+        updated_at=timezone.now(),
+    )
+    if queued:
+        start_import_job(job)
+    return bool(queued)
+
+
+def run_pending_import_jobs() -> int:
+    """
+    Run the import jobs that are still pending, oldest first, after failing
+    the stale running ones.
+
+    Returns:
+        The number of jobs run
+    """
+    fail_stale_import_jobs()
+    job_ids = ImportJob.objects.filter(status=ImportJob.STATUS_PENDING).order_by(
+        "created_at"
+    )
+    return sum(run_import_job(pk) for pk in list(job_ids.values_list("pk", flat=True)))
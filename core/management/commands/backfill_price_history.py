@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+
+from core.models import PriceHistory, ProductInstance
+
+
+class Command(BaseCommand):
+    help = "Adds price history entries for product instances recorded before it existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of entries written per query",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+
+        products = (
+            ProductInstance.objects.filter(price_history__isnull=True)
+            .values_list(
+                "pk",
+                "product_type_id",
+                "user_id",
+                "price_per_kilo",
+                "unit",
+                "created_at",
+            )
+            .order_by("pk")
+        )
+
+        count = 0
+        batch = []
+        for (
+            pk,
+            product_type_id,
+            user_id,
+            price_per_kilo,
+            unit,
+            created_at,
+        ) in products.iterator(chunk_size=batch_size):
+            batch.append(
+                PriceHistory(
+                    product_type_id=product_type_id,
+                    user_id=user_id,
+                    product_instance_id=pk,
+                    price_per_kilo=price_per_kilo,
+                    unit=unit,
+                    effective_at=created_at,
+                )
+            )
+            if len(batch) >= batch_size:
+                PriceHistory.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        PriceHistory.objects.bulk_create(batch)
+        count += len(batch)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Successfully added {count} price history entries")
+        )
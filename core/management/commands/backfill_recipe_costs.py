@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.costing import recalculate_recipes
+from core.models import Recipe
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-derive the stored cost factors and costs of all recipe items and "
+        "recalculate every recipe. Run once after upgrading from a version "
+        "without stored item costs, before reconcile_recipe_costs."
+    )
+
+    def handle(self, *args, **options):
+        # Re-derives the cost factors, which new columns default to 1
+        changed = recalculate_recipes(Recipe.objects.values_list("pk", flat=True))
+        self.stdout.write(
+            self.style.SUCCESS(f"Recalculated recipe costs, {changed} totals changed")
+        )
@@ -0,0 +1,85 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core.models import ProductInstance, ProductType
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the render time of the product instance admin changelist "
+        "on synthetic rows. Everything is rolled back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=5_000_000)
+        parser.add_argument("--product-types", type=int, default=500)
+        parser.add_argument("--chunk-size", type=int, default=10_000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        now = timezone.now()
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            user = User.objects.create_superuser("changelist-benchmark")
+            product_types = ProductType.objects.bulk_create(
+                ProductType(name=f"Product {index}", base_weight=100, waste=10)
+                for index in range(options["product_types"])
+            )
+            remaining = options["rows"]
+            while remaining > 0:
+                chunk = []
+                for _ in range(min(options["chunk_size"], remaining)):
+                    product = ProductInstance(
+                        product_type=rng.choice(product_types),
+                        user=user,
+                        total_weight=rng.randint(100, 10_000),
+                        price_per_kilo=rng.randint(10_000, 1_000_000),
+                    )
+                    product.compute_derived_fields()
+                    chunk.append(product)
+                ProductInstance.objects.bulk_create(chunk)
+                # Spread the purchases over three years, a day per chunk
+                ProductInstance.objects.filter(
+                    pk__gte=chunk[0].pk, pk__lte=chunk[-1].pk
+                ).update(created_at=now - timedelta(days=rng.randrange(1095)))
+                remaining -= len(chunk)
+            self.stdout.write(
+                f"Created {options['rows']} rows in "
+                f"{time.perf_counter() - started:.1f} s"
+            )
+
+            model_admin = admin.site._registry[ProductInstance]
+            factory = RequestFactory()
+            for query in [
+                "",
+                "?p=100",
+                f"?created={now.year}",
+                f"?created={now.year}-{now.month:02d}",
+                f"?product_type__id__exact={product_types[0].pk}",
+                "?q=Product 1",
+            ]:
+                timings = []
+                for _ in range(options["repeat"]):
+                    request = factory.get(f"/admin/core/productinstance/{query}")
+                    request.user = user
+                    started = time.perf_counter()
+                    with CaptureQueriesContext(connection) as queries:
+                        model_admin.changelist_view(request).render()
+                    timings.append((time.perf_counter() - started) * 1000)
+                self.stdout.write(
+                    f"{query or '(all)'}: best {min(timings):.1f} ms, "
+                    f"{len(queries)} queries"
+                )
+            transaction.set_rollback(True)
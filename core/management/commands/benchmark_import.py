@@ -0,0 +1,99 @@
+import csv
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from typing import Iterator
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from openpyxl import Workbook
+
+from core.importer import import_file, open_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the product type import on a synthetic CSV or Excel file: "
+        "reading it, a dry run, an import of new rows and re-imports updating "
+        "them. Everything is rolled back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=500_000)
+        parser.add_argument("--categories", type=int, default=50)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--format", choices=["csv", "xlsx"], default="csv")
+
+    def rows(self, options, waste_offset: float) -> Iterator[list]:
+        rng = random.Random(options["seed"])
+        per_category = max(options["rows"] // options["categories"], 1)
+        yield ["نوع", "وزن پایه", "دور ریز", "واحد"]
+        for row in range(options["rows"]):
+            if row % per_category == 0:
+                yield [f"دسته {row // per_category}", None, None, None]
+            yield [
+                f"محصول {row}",
+                rng.choice([500, 800, 1000, 1500]),
+                rng.randint(0, 100) + waste_offset,
+                rng.choice(["gram", "piece", None]),
+            ]
+
+    def write_file(self, path: str, options, waste_offset: float) -> None:
+        rows = self.rows(options, waste_offset)
+        if options["format"] == "xlsx":
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet()
+            for row in rows:
+                sheet.append(row)
+            workbook.save(path)
+            return
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            csv.writer(f).writerows(rows)
+
+    def read(self, path: str, rows: int) -> None:
+        """Only read the file, tracing the memory the reader uses."""
+        tracemalloc.start()
+        started = time.perf_counter()
+        with open_rows(path) as (reader, _):
+            for _ in reader:
+                pass
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.stdout.write(
+            f"Read: {rows / elapsed:,.0f} rows/s ({elapsed:.1f} s, "
+            f"peak {peak / 2**20:.1f} MB)"
+        )
+
+    def run(
+        self, label: str, path: str, rows: int, dry_run: bool = False, force=True
+    ) -> None:
+        started = time.perf_counter()
+        result = import_file(path, dry_run=dry_run, force=force)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{label}: {rows / elapsed:,.0f} rows/s ({elapsed:.1f} s, "
+            f"{len(result.product_types_created)} created, "
+            f"{len(result.product_types_updated)} updated)"
+        )
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        with tempfile.TemporaryDirectory() as directory:
+            extension = options["format"]
+            new_path = os.path.join(directory, f"new.{extension}")
+            changed_path = os.path.join(directory, f"changed.{extension}")
+            self.write_file(new_path, options, 0)
+            self.write_file(changed_path, options, 0.5)
+
+            self.read(new_path, rows)
+            with transaction.atomic():
+                self.run("Dry run", new_path, rows, dry_run=True)
+                self.run("Insert", new_path, rows)
+                self.run("Update", changed_path, rows)
+                self.run("Unchanged", changed_path, rows)
+                self.run("Same file", changed_path, rows, force=False)
+                transaction.set_rollback(True)
+        self.stdout.write(self.style.SUCCESS("Done, all changes rolled back."))
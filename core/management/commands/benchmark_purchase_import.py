@@ -0,0 +1,73 @@
+import csv
+import os
+import random
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import ProductType
+from core.purchases import derive, import_purchases, read_purchases
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the purchase import on a synthetic CSV file: reading it, "
+        "computing the derived fields and importing it. Everything is rolled "
+        "back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--product-types", type=int, default=200)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def write_file(self, path: str, options) -> None:
+        rng = random.Random(options["seed"])
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["نوع", "مقدار", "واحد", "قیمت"])
+            for _ in range(options["rows"]):
+                writer.writerow(
+                    [
+                        f"محصول {rng.randrange(options['product_types'])}",
+                        rng.choice([250, 500, 1000, 2000]),
+                        rng.choice(["gram", "piece", ""]),
+                        rng.randint(10, 5000) * 100,
+                    ]
+                )
+
+    def report(self, label: str, rows: int, started: float) -> None:
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"{label}: {rows / elapsed:,.0f} rows/s ({elapsed:.1f} s)")
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        with tempfile.TemporaryDirectory() as directory, transaction.atomic():
+            user = User.objects.create(username="benchmark-purchase-import")
+            ProductType.objects.bulk_create(
+                ProductType(name=f"محصول {index}", base_weight=1000, waste=index % 100)
+                for index in range(options["product_types"])
+            )
+            path = os.path.join(directory, "purchases.csv")
+            self.write_file(path, options)
+
+            started = time.perf_counter()
+            product_types = {
+                name: (pk, 0.0)
+                for pk, name in ProductType.objects.values_list("pk", "name")
+            }
+            for frame in read_purchases(path):
+                derive(frame, product_types)
+            self.report("Read and derive", rows, started)
+
+            started = time.perf_counter()
+            result = import_purchases(path, user)
+            self.report("Import", rows, started)
+            self.stdout.write(
+                f"{result.created:,} created, {result.error_count:,} errors"
+            )
+            transaction.set_rollback(True)
+        self.stdout.write(self.style.SUCCESS("Done, all changes rolled back."))
@@ -0,0 +1,79 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import ProductType, SearchTerm
+from core.search import index_texts, search
+
+# Letters the synthetic product type names are made of
+CONSONANTS = list("بپتجچخدرزسشفقکگلمنه") + list("bcdfgklmnprst")
+VOWELS = list("اوی") + list("aeiou")
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure product type search lookups on synthetic rows. "
+        "Everything is rolled back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--chunk-size", type=int, default=10_000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def word(self, rng: random.Random) -> str:
+        return "".join(
+            rng.choice(CONSONANTS) + rng.choice(VOWELS) + rng.choice(["", *CONSONANTS])
+            for _ in range(rng.randint(2, 3))
+        )
+
+    def name(self, rng: random.Random) -> str:
+        return " ".join(self.word(rng) for _ in range(rng.randint(1, 3)))
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        kind = SearchTerm.KIND_PRODUCT_TYPE
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            names = []
+            remaining = options["rows"]
+            while remaining > 0:
+                chunk = [
+                    ProductType(name=self.name(rng), base_weight=1, waste=0)
+                    for _ in range(min(options["chunk_size"], remaining))
+                ]
+                # bulk_create sends no signals, index the chunk explicitly
+                ProductType.objects.bulk_create(chunk)
+                index_texts(kind, {obj.pk: obj.name for obj in chunk})
+                names.extend(obj.name for obj in chunk[:100])
+                remaining -= len(chunk)
+            self.stdout.write(
+                f"Indexed {options['rows']} rows in "
+                f"{time.perf_counter() - started:.1f} s"
+            )
+
+            timings = []
+            for _ in range(options["queries"]):
+                word = rng.choice(rng.choice(names).split())
+                start = rng.randrange(len(word))
+                end = start + rng.randint(3, 6)
+                query = word[start:end]
+                started = time.perf_counter()
+                list(search(ProductType.objects.all(), kind, query)[:20])
+                timings.append((time.perf_counter() - started) * 1000)
+
+            timings.sort()
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{len(timings)} lookups: "
+                    f"p50 {statistics.median(timings):.2f} ms, "
+                    f"p95 {timings[int(len(timings) * 0.95) - 1]:.2f} ms, "
+                    f"max {timings[-1]:.2f} ms"
+                )
+            )
+            transaction.set_rollback(True)
@@ -0,0 +1,50 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from core.exports import EXPORT_FORMATS, FORMAT_CSV, export_products, export_recipes
+from core.models import ProductInstance, Recipe
+
+EXPORTS = {
+    "products": (ProductInstance, export_products),
+    "recipes": (Recipe, export_recipes),
+}
+
+
+class Command(BaseCommand):
+    help = "Stream products or recipes with their cost breakdown as CSV or NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=sorted(EXPORTS), help="What to export")
+        parser.add_argument(
+            "--file-format",
+            choices=sorted(EXPORT_FORMATS),
+            default=FORMAT_CSV,
+            help="Output format",
+        )
+        parser.add_argument("--user", help="Only export the data of this username")
+        parser.add_argument(
+            "--output", help="File to write to, standard output by default"
+        )
+
+    def handle(self, *args, **options):
+        model, export = EXPORTS[options["kind"]]
+        queryset = model.objects.all()
+        if options["user"]:
+            try:
+                user = User.objects.get(username=options["user"])
+            except User.DoesNotExist:
+                raise CommandError(f'User "{options["user"]}" does not exist')
+            queryset = queryset.filter(user=user)
+
+        chunks = export(queryset, options["file_format"])
+        if not options["output"]:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
+            return
+
+        with open(options["output"], "w", encoding="utf-8", newline="") as output:
+            for chunk in chunks:
+                output.write(chunk)
+        self.stderr.write(
+            self.style.SUCCESS(f'Exported {options["kind"]} to {options["output"]}')
+        )
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from db_fa.schema import code_version, generate_schema, write_schema_file
+
+
+class Command(BaseCommand):
+    help = "Generate the API schema once and store it for the schema views"
+
+    def handle(self, *args, **options):
+        write_schema_file(generate_schema())
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Successfully wrote the schema of {code_version()} "
+                f"to {settings.SCHEMA_FILE}"
+            )
+        )
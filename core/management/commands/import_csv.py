@@ -1,17 +1,26 @@
-import csv
 import os
 
 from django.core.management.base import BaseCommand, CommandError
 
-from core.models import Category, ProductType
+from core.importer import import_file
 
 
 class Command(BaseCommand):
-    help = "Import product types from CSV file"
+    help = "Import product types from a CSV or Excel (.xlsx) file"
 
     def add_arguments(self, parser):
         parser.add_argument(
-            "csv_file", nargs="?", type=str, help="Path to the CSV file"
+            "csv_file", nargs="?", type=str, help="Path to the CSV or .xlsx file"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report the changes without saving them",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Import the file even if the same content was already imported",
         )
 
     def handle(self, *args, **options):
@@ -33,129 +42,17 @@ class Command(BaseCommand):
 
         # Import from CSV
         self.stdout.write(self.style.SUCCESS(f"شروع واردات از فایل: {csv_file_path}"))
+        result = import_file(
+            csv_file_path, dry_run=options["dry_run"], force=options["force"]
+        )
 
-        # Dictionary mapping category names to default units
-        category_to_unit = {
-            "پروتیئن": ProductType.UNIT_GRAM,
-            "راسته گوساله": ProductType.UNIT_GRAM,
-            "فیله گوساله": ProductType.UNIT_GRAM,
-            "سبزیجات": ProductType.UNIT_GRAM,
-            "کاهو": ProductType.UNIT_GRAM,
-            "گوجه فرنگی": ProductType.UNIT_GRAM,
-            "خیار": ProductType.UNIT_GRAM,
-            "نوشیدنی": ProductType.UNIT_PIECE,  # Default for drinks is piece/unit
-            "آب پرتقال": ProductType.UNIT_PIECE,
-            "نوشابه": ProductType.UNIT_PIECE,
-            "آب معدنی": ProductType.UNIT_PIECE,
-        }
-
-        with open(csv_file_path, "r", encoding="utf-8") as f:
-            csv_reader = csv.reader(f)
-            # Skip header row
-            next(csv_reader)
-
-            current_category = None
-            rows_processed = 0
-            products_added = 0
-            products_updated = 0
-            categories_added = 0
-
-            for row in csv_reader:
-                if not row or len(row) < 3:
-                    continue
-
-                rows_processed += 1
-                product_name = row[0].strip()
-                base_weight_str = row[1].strip() if len(row) > 1 else ""
-                waste_str = row[2].strip() if len(row) > 2 else ""
-
-                # Try to get the unit from the CSV file (column 4 if exists)
-                unit_str = row[3].strip() if len(row) > 3 and row[3].strip() else None
-
-                try:
-                    # Check if this is a category row (no values in other columns)
-                    if base_weight_str == "" and waste_str == "":
-                        # This is a category
-                        if product_name:
-                            category, created = Category.objects.get_or_create(
-                                name=product_name
-                            )
-                            current_category = category
-                            if created:
-                                categories_added += 1
-                            self.stdout.write(
-                                f"دسته‌بندی {'ایجاد' if created else 'دریافت'} شد: {product_name}"
-                            )
-                    else:
-                        # This is a product
-                        if product_name:
-                            try:
-                                base_weight = (
-                                    float(base_weight_str) if base_weight_str else 0
-                                )
-                                waste = float(waste_str) if waste_str else 0
-
-                                # Determine the unit
-                                unit = (
-                                    unit_str
-                                    if unit_str
-                                    else category_to_unit.get(
-                                        product_name,
-                                        category_to_unit.get(
-                                            (
-                                                current_category.name
-                                                if current_category
-                                                else ""
-                                            ),
-                                            ProductType.UNIT_GRAM,
-                                        ),
-                                    )
-                                )
-
-                                # Check if product already exists
-                                try:
-                                    product = ProductType.objects.get(name=product_name)
-                                    product.base_weight = base_weight
-                                    product.waste = waste
-                                    product.unit = unit
-                                    if current_category:
-                                        product.category = current_category
-                                    product.save()
-                                    products_updated += 1
-                                    self.stdout.write(
-                                        f"نوع محصول به‌روزرسانی شد: {product_name} (واحد: {product.get_unit_display()})"
-                                    )
-                                except ProductType.DoesNotExist:
-                                    ProductType.objects.create(
-                                        name=product_name,
-                                        base_weight=base_weight,
-                                        waste=waste,
-                                        category=current_category,
-                                        unit=unit,
-                                    )
-                                    products_added += 1
-                                    self.stdout.write(
-                                        f"نوع محصول ایجاد شد: {product_name} (واحد: {dict(ProductType.UNIT_CHOICES).get(unit)})"
-                                    )
-                            except ValueError as e:
-                                self.stdout.write(
-                                    self.style.ERROR(
-                                        f"خطا در تبدیل مقادیر عددی برای محصول {product_name}: {str(e)}"
-                                    )
-                                )
-                except Exception as e:
-                    self.stdout.write(
-                        self.style.ERROR(f"خطا در پردازش سطر {row}: {str(e)}")
-                    )
-
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f"""
-عملیات وارد کردن انواع محصول به پایان رسید.
-تعداد سطرهای پردازش شده: {rows_processed}
-تعداد دسته‌بندی‌های جدید: {categories_added}
-تعداد محصولات جدید: {products_added}
-تعداد محصولات به‌روزرسانی شده: {products_updated}
-"""
-                )
-            )
+        if options["verbosity"] > 1:
+            for name in result.categories_created:
+                self.stdout.write(f"دسته‌بندی ایجاد شد: {name}")
+            for name in result.product_types_created:
+                self.stdout.write(f"نوع محصول ایجاد شد: {name}")
+            for name in result.product_types_updated:
+                self.stdout.write(f"نوع محصول به‌روزرسانی شد: {name}")
+        for error in result.errors:
+            self.stdout.write(self.style.ERROR(error))
+        self.stdout.write(self.style.SUCCESS(result.summary()))
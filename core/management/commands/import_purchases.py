@@ -0,0 +1,45 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from core.purchases import import_purchases
+
+
+class Command(BaseCommand):
+    help = (
+        "Import the purchases of a user from a CSV or Excel (.xlsx) file of "
+        "product type, weight, unit and price rows"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", type=str, help="Path to the CSV or .xlsx file")
+        parser.add_argument(
+            "--user", required=True, help="Username of the owner of the purchases"
+        )
+
+    def handle(self, *args, **options):
+        path = options["file"]
+        if not os.path.exists(path):
+            raise CommandError(f"فایل در مسیر {path} یافت نشد.")
+        try:
+            user = User.objects.get(username=options["user"])
+        except User.DoesNotExist:
+            raise CommandError(f"کاربر {options['user']} یافت نشد.")
+
+        try:
+            result = import_purchases(path, user)
+        except ValueError as e:
+            raise CommandError(f"فایل قابل خواندن نیست: {e}")
+        for error in result.errors:
+            self.stdout.write(self.style.ERROR(error))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"""
+عملیات وارد کردن خریدها به پایان رسید.
+تعداد سطرهای پردازش شده: {result.rows}
+تعداد خریدهای ثبت شده: {result.created}
+تعداد خطاها: {result.error_count}
+"""
+            )
+        )
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.importer import run_pending_import_jobs
+
+
+class Command(BaseCommand):
+    help = "Run the pending product type import jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep polling for new jobs instead of exiting when none is pending",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait between polls when no job is pending",
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            processed = run_pending_import_jobs()
+            total += processed
+            if processed:
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+
+        self.stdout.write(self.style.SUCCESS(f"Ran {total} import jobs"))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import RecostTask
+from core.tasks import run_due_tasks
+
+
+class Command(BaseCommand):
+    help = "Run the queued background recipe recosts that are due"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep polling the queue instead of exiting when it is drained",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait between polls of an idle queue",
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            processed = run_due_tasks()
+            total += processed
+            if processed:
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Recosted {total} recipes, {RecostTask.objects.count()} still queued"
+            )
+        )
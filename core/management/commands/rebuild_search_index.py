@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from core.models import SearchTerm
+from core.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the normalized search index of product types and recipes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--kind",
+            choices=[kind for kind, _ in SearchTerm.KIND_CHOICES],
+            nargs="*",
+            dest="kinds",
+            help="Only rebuild the index of these kinds",
+        )
+
+    def handle(self, *args, **options):
+        for kind in options["kinds"] or [kind for kind, _ in SearchTerm.KIND_CHOICES]:
+            count = rebuild_index(kind)
+            self.stdout.write(
+                self.style.SUCCESS(f"Successfully indexed {count} {kind} terms")
+            )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core.models import ProductInstance
+
+
+class Command(BaseCommand):
+    help = "Re-derive waste weight, net weight and total price of product instances"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--product-type",
+            type=int,
+            nargs="*",
+            dest="product_types",
+            help="Only recompute instances of these product type IDs",
+        )
+
+    def handle(self, *args, **options):
+        products = ProductInstance.objects.all()
+        if options["product_types"]:
+            products = products.filter(product_type_id__in=options["product_types"])
+
+        count = products.recompute_derived_fields()
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Successfully recomputed {count} product instances")
+        )
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+
+from core.costing import recalculate_recipes
+from core.models import Recipe
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare stored recipe costs with a full recalculation and report drift. "
+        "The stored unit conversion factors of the items are trusted, run "
+        "backfill_recipe_costs first after an upgrade."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.01,
+            help="Maximum allowed difference between stored and computed cost",
+        )
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Recalculate the costs of recipes that have drifted",
+        )
+
+    def handle(self, *args, **options):
+        tolerance = options["tolerance"]
+
+        drifted = (
+            Recipe.objects.with_computed_cost()
+            .annotate(drift=F("total_cost") - F("computed_cost"))
+            .filter(Q(drift__gt=tolerance) | Q(drift__lt=-tolerance))
+            .order_by("pk")
+        )
+
+        drifted_ids = []
+        for recipe in drifted:
+            drifted_ids.append(recipe.pk)
+            self.stdout.write(
+                self.style.WARNING(
+                    f'Recipe {recipe.pk} "{recipe.name}": stored {recipe.total_cost}, '
+                    f"computed {recipe.computed_cost} (drift {recipe.drift})"
+                )
+            )
+
+        if not drifted_ids:
+            self.stdout.write(self.style.SUCCESS("No cost drift found"))
+            return
+
+        if options["fix"]:
+            recalculate_recipes(drifted_ids)
+            self.stdout.write(
+                self.style.SUCCESS(f"Recalculated costs of {len(drifted_ids)} recipes")
+            )
+        else:
+            self.stdout.write(
+                self.style.ERROR(f"{len(drifted_ids)} recipes have drifted costs")
+            )
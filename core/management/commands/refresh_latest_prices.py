@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.pricing import refresh_latest_prices
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the latest purchase price lookup per user and product type"
+
+    def handle(self, *args, **options):
+        count = refresh_latest_prices()
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Successfully stored {count} latest prices")
+        )
@@ -1,5 +1,23 @@
+from contextlib import contextmanager
+from threading import local
+from typing import Iterable, Iterator, Optional
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .units import (
+    GRAM,
+    UNIT_CHOICES,
+    UnitChoices,
+    cost_factor,
+    price_factor,
+    price_factor_expression,
+    unit_label,
+)
 
 
 # Create your models here.
@@ -16,22 +34,9 @@ class Category(models.Model):
         verbose_name_plural = "دسته‌بندی‌ها"
 
 
-class ProductType(models.Model):
+class ProductType(UnitChoices, models.Model):
     """Model for storing product types with fixed values."""
 
-    # Measurement unit constants
-    UNIT_GRAM = "gram"
-    UNIT_PIECE = "piece"
-    UNIT_LITER = "liter"
-    UNIT_METER = "meter"
-
-    UNIT_CHOICES = [
-        (UNIT_GRAM, "گرم"),
-        (UNIT_PIECE, "عدد"),
-        (UNIT_LITER, "لیتر"),
-        (UNIT_METER, "متر"),
-    ]
-
     name = models.CharField(max_length=100, verbose_name="نوع محصول")
     base_weight = models.FloatField(verbose_name="وزن پایه")
     waste = models.FloatField(verbose_name="دور ریز")
@@ -44,7 +49,19 @@ class ProductType(models.Model):
         verbose_name="دسته‌بندی",
     )
     unit = models.CharField(
-        max_length=10, choices=UNIT_CHOICES, default=UNIT_GRAM, verbose_name="واحد"
+        max_length=10, choices=UNIT_CHOICES, default=GRAM, verbose_name="واحد"
+    )
+    # Unit conversion properties, used to convert ingredient quantities
+    density = models.FloatField(
+        null=True, blank=True, verbose_name="چگالی (گرم بر میلی‌لیتر)"
+    )
+    package_size = models.FloatField(
+        null=True, blank=True, verbose_name="تعداد در هر بسته"
+    )
+    # Fingerprint of the row this product type was last imported from,
+    # cleared when it is saved outside imports
+    import_fingerprint = models.CharField(
+        max_length=32, blank=True, editable=False, verbose_name="اثر انگشت وارد کردن"
     )
 
     @property
@@ -54,37 +71,113 @@ class ProductType(models.Model):
             return self.waste / self.base_weight
         return 0
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded waste figures to detect changes on save
+        instance._loaded_waste = (
+            instance.__dict__.get("base_weight"),
+            instance.__dict__.get("waste"),
+        )
+        instance._loaded_conversion = (
+            instance.__dict__.get("density"),
+            instance.__dict__.get("package_size"),
+        )
+        return instance
+
+    def save(self, *args, **kwargs) -> None:
+        """
+        Save and re-derive the computed fields of instances if waste changed,
+        and the costs of ingredients if the unit conversions changed.
+        """
+        loaded_waste = getattr(self, "_loaded_waste", None)
+        loaded_conversion = getattr(self, "_loaded_conversion", None)
+        # Changed outside an import, the next import has to compare it
+        self.import_fingerprint = ""
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "import_fingerprint"}
+        super().save(*args, **kwargs)
+        self._loaded_waste = (self.base_weight, self.waste)
+        self._loaded_conversion = (self.density, self.package_size)
+
+        if loaded_waste is not None and loaded_waste != self._loaded_waste:
+            self.productinstance_set.recompute_derived_fields()
+        if (
+            loaded_conversion is not None
+            and loaded_conversion != self._loaded_conversion
+        ):
+            from .costing import propagate_price_changes
+
+            RecipeItem.objects.filter(
+                product_instance__product_type=self
+            ).refresh_cost_factors()
+            propagate_price_changes(
+                self.productinstance_set.values_list("pk", flat=True)
+            )
+
     def __str__(self) -> str:
         return self.name
 
     class Meta:
         verbose_name = "نوع محصول"
         verbose_name_plural = "انواع محصولات"
+        indexes = [
+            # Prefix search of names (LIKE 'term%') for the autocomplete
+            models.Index(
+                fields=["name"],
+                name="core_producttype_name_idx",
+                opclasses=["varchar_pattern_ops"],
+            ),
+        ]
+
+
+class ProductInstanceQuerySet(models.QuerySet):
+    """Bulk operations for product instances."""
+
+    def recompute_derived_fields(self) -> int:
+        """
+        Re-derive waste weight, net weight and total price from the current
+        product type waste ratio with a single UPDATE.
+
+        Rows are not loaded into Python and no save signals are sent.
+
+        Returns:
+            The number of updated instances
+        """
+        waste_ratio = Subquery(
+            ProductType.objects.filter(pk=OuterRef("product_type_id"))
+            .annotate(
+                ratio=Case(
+                    When(base_weight__gt=0, then=F("waste") / F("base_weight")),
+                    default=Value(0.0),
+                    output_field=models.FloatField(),
+                )
+            )
+            .values("ratio")[:1]
+        )
+        waste_weight = F("total_weight") * waste_ratio
+        unit_price = F("price_per_kilo") * price_factor_expression("unit")
+        count = self.update(
+            waste_weight=waste_weight,
+            net_weight=F("total_weight") - waste_weight,
+            total_price=unit_price * F("total_weight") + unit_price * waste_weight,
+        )
+        CollectionVersion.objects.bump(
+            self.values_list("user_id", flat=True).distinct()
+        )
+        return count
 
 
-class ProductInstance(models.Model):
+class ProductInstance(UnitChoices, models.Model):
     """Product instance with price and calculated values."""
 
-    # Measurement unit constants - same as ProductType
-    UNIT_GRAM = "gram"
-    UNIT_PIECE = "piece"
-    UNIT_LITER = "liter"
-    UNIT_METER = "meter"
-
-    UNIT_CHOICES = [
-        (UNIT_GRAM, "گرم"),
-        (UNIT_PIECE, "عدد"),
-        (UNIT_LITER, "لیتر"),
-        (UNIT_METER, "متر"),
-    ]
-
     product_type = models.ForeignKey(
         ProductType, on_delete=models.CASCADE, verbose_name="نوع محصول"
     )
     total_weight = models.FloatField(default=1000, verbose_name="مقدار")
     price_per_kilo = models.FloatField(default=10000, verbose_name="قیمت هر واحد")
     unit = models.CharField(
-        max_length=10, choices=UNIT_CHOICES, default=UNIT_GRAM, verbose_name="واحد"
+        max_length=10, choices=UNIT_CHOICES, default=GRAM, verbose_name="واحد"
     )
 
     # Calculated values
@@ -100,8 +193,38 @@ class ProductInstance(models.Model):
         null=True,
     )
 
+    objects = ProductInstanceQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded pricing to detect price changes on save
+        instance._loaded_pricing = (
+            instance.__dict__.get("price_per_kilo"),
+            instance.__dict__.get("unit"),
+        )
+        return instance
+
+    @property
+    def pricing_changed(self) -> bool:
+        """Check whether the price or unit differs from the loaded values."""
+        loaded = getattr(self, "_loaded_pricing", None)
+        return loaded is not None and loaded != (self.price_per_kilo, self.unit)
+
+    @property
+    def unit_changed(self) -> bool:
+        """Check whether the unit differs from the loaded value."""
+        loaded = getattr(self, "_loaded_pricing", None)
+        return loaded is not None and loaded[1] != self.unit
+
     def save(self, *args, **kwargs) -> None:
         """Calculate waste weight, net weight and total price before saving."""
+        self.compute_derived_fields()
+        super().save(*args, **kwargs)
+        self._loaded_pricing = (self.price_per_kilo, self.unit)
+
+    def compute_derived_fields(self) -> None:
+        """Calculate waste weight, net weight and total price."""
         # Calculate waste weight based on product type waste ratio
         waste_ratio = self.product_type.waste_ratio
         self.waste_weight = self.total_weight * waste_ratio
@@ -109,22 +232,215 @@ class ProductInstance(models.Model):
         # Calculate net weight
         self.net_weight = self.total_weight - self.waste_weight
 
-        # Calculate total price considering waste
+        # Calculate total price considering waste, the price is quoted per
+        # kilo for gram items and per unit otherwise
+        unit_price = self.price_per_kilo * price_factor(self.unit)
         # Price based on total weight
-        self.total_price = (self.price_per_kilo * self.total_weight) / 1000
+        self.total_price = unit_price * self.total_weight
 
         # Additional cost for waste
-        waste_cost = (self.price_per_kilo * self.waste_weight) / 1000
+        waste_cost = unit_price * self.waste_weight
         self.total_price += waste_cost
 
-        super().save(*args, **kwargs)
-
     def __str__(self) -> str:
-        return f"{self.product_type.name} - {self.total_weight} گرم - {self.created_at.strftime('%Y-%m-%d')}"
+        return f"{self.product_type.name} - {self.total_weight} {unit_label(self.unit)} - {self.created_at.strftime('%Y-%m-%d')}"
 
     class Meta:
         verbose_name = "محصول"
         verbose_name_plural = "محصولات"
+        indexes = [
+            # Latest purchase of a product type per user
+            models.Index(
+                fields=["user", "product_type", "-created_at"],
+                name="core_product_latest_idx",
+            ),
+            # Keyset pagination of a user's products
+            models.Index(
+                fields=["user", "-created_at", "-id"],
+                name="core_product_keyset_idx",
+            ),
+            # Admin list ordering and date filters across users
+            models.Index(
+                fields=["-created_at", "-id"],
+                name="core_product_created_idx",
+            ),
+        ]
+
+
+class LatestPrice(models.Model):
+    """Latest purchase price of each product type per user."""
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="latest_prices",
+        verbose_name="کاربر",
+        null=True,
+    )
+    product_type = models.ForeignKey(
+        ProductType,
+        on_delete=models.CASCADE,
+        related_name="latest_prices",
+        verbose_name="نوع محصول",
+    )
+    product_instance = models.OneToOneField(
+        ProductInstance,
+        on_delete=models.CASCADE,
+        related_name="latest_price",
+        verbose_name="محصول",
+    )
+    price_per_kilo = models.FloatField(verbose_name="قیمت هر واحد")
+    unit = models.CharField(
+        max_length=10,
+        choices=ProductInstance.UNIT_CHOICES,
+        default=ProductInstance.UNIT_GRAM,
+        verbose_name="واحد",
+    )
+    purchased_at = models.DateTimeField(verbose_name="تاریخ خرید")
+
+    def __str__(self) -> str:
+        return f"{self.product_type_id} - {self.price_per_kilo}"
+
+    class Meta:
+        verbose_name = "آخرین قیمت"
+        verbose_name_plural = "آخرین قیمت‌ها"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "product_type"], name="core_latestprice_unique"
+            ),
+        ]
+
+
+class PriceHistory(models.Model):
+    """Append-only record of product type prices over time."""
+
+    product_type = models.ForeignKey(
+        ProductType,
+        on_delete=models.CASCADE,
+        related_name="price_history",
+        verbose_name="نوع محصول",
+    )
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="price_history",
+        verbose_name="کاربر",
+        null=True,
+    )
+    product_instance = models.ForeignKey(
+        ProductInstance,
+        on_delete=models.SET_NULL,
+        related_name="price_history",
+        null=True,
+        blank=True,
+        verbose_name="محصول",
+    )
+    price_per_kilo = models.FloatField(verbose_name="قیمت هر واحد")
+    unit = models.CharField(
+        max_length=10,
+        choices=ProductInstance.UNIT_CHOICES,
+        default=ProductInstance.UNIT_GRAM,
+        verbose_name="واحد",
+    )
+    effective_at = models.DateTimeField(verbose_name="تاریخ اعمال")
+
+    def save(self, *args, **kwargs) -> None:
+        """Only allow new entries, the history is append-only."""
+        if self.pk is not None:
+            raise ValueError("Price history entries cannot be changed.")
+        super().save(*args, **kwargs)
+
+    def __str__(self) -> str:
+        return f"{self.product_type_id} - {self.price_per_kilo} - {self.effective_at:%Y-%m-%d}"
+
+    class Meta:
+        verbose_name = "سابقه قیمت"
+        verbose_name_plural = "سوابق قیمت"
+        indexes = [
+            models.Index(
+                fields=["product_type", "user", "effective_at"],
+                name="core_pricehistory_lookup_idx",
+            ),
+        ]
+
+
+def unit_cost(total_cost: float, yield_quantity: float) -> float:
+    """Calculate the cost of one unit of a recipe yield."""
+    if yield_quantity > 0:
+        return total_cost / yield_quantity
+    return total_cost
+
+
+class RecipeQuerySet(models.QuerySet):
+    """Set-based cost operations for recipes."""
+
+    def with_computed_cost(self) -> "RecipeQuerySet":
+        """
+        Annotate each recipe with its cost computed from current prices.
+
+        Sub-recipe ingredients are costed at the stored unit cost of the
+        sub-recipe.
+        """
+        sub_recipe_cost = Case(
+            When(
+                sub_recipe__yield_quantity__gt=0,
+                then=F("quantity")
+                * F("sub_recipe__total_cost")
+                / F("sub_recipe__yield_quantity"),
+            ),
+            default=F("quantity") * F("sub_recipe__total_cost"),
+            output_field=models.FloatField(),
+        )
+        items = (
+            RecipeItem.objects.filter(recipe=OuterRef("pk"))
+            .values("recipe")
+            .annotate(
+                cost_sum=Sum(
+                    Case(
+                        When(sub_recipe__isnull=False, then=sub_recipe_cost),
+                        default=F("product_instance__price_per_kilo")
+                        * F("quantity")
+                        * F("cost_factor"),
+                    )
+                )
+            )
+            .values("cost_sum")
+        )
+        return self.annotate(
+            computed_cost=Coalesce(
+                Subquery(items, output_field=models.FloatField()), Value(0.0)
+            )
+        )
+
+    def recalculate_costs(self, refresh_items: bool = True) -> int:
+        """
+        Recalculate the total costs of all recipes with one aggregate UPDATE.
+
+        Stored sub-recipe ingredient costs are summed as they are; use
+        ``core.costing.recalculate_recipes`` to walk the sub-recipe graph.
+
+        Args:
+            refresh_items: Also re-derive the stored item costs from current
+                product prices first (one more UPDATE)
+        """
+        if refresh_items:
+            RecipeItem.objects.filter(recipe__in=self.values("pk")).refresh_costs()
+        items = (
+            RecipeItem.objects.filter(recipe=OuterRef("pk"))
+            .values("recipe")
+            .annotate(cost_sum=Sum("cost"))
+            .values("cost_sum")
+        )
+        count = self.update(
+            total_cost=Coalesce(
+                Subquery(items, output_field=models.FloatField()), Value(0.0)
+            ),
+            cost_version=F("cost_version") + 1,
+        )
+        CollectionVersion.objects.bump(
+            self.values_list("user_id", flat=True).distinct()
+        )
+        return count
 
 
 class Recipe(models.Model):
@@ -140,38 +456,86 @@ class Recipe(models.Model):
     # Calculated final price
     total_cost = models.FloatField(default=0, verbose_name="هزینه کل")
     selling_price = models.FloatField(blank=True, null=True, verbose_name="قیمت فروش")
+    # Quantity produced, used to cost the recipe as an ingredient of others
+    yield_quantity = models.FloatField(default=1, verbose_name="مقدار تولید")
+    # Incremented on every stored cost change, so clients can poll for updates
+    cost_version = models.PositiveIntegerField(default=0, verbose_name="نسخه هزینه")
 
-    def calculate_total_cost(self) -> float:
-        """Calculate total cost based on ingredients."""
-        total = 0
-        for item in self.recipe_items.all():
-            # Calculate price of each ingredient based on quantity and price
-            if item.product_instance.unit == ProductType.UNIT_GRAM:
-                # For weight-based items (grams)
-                item_cost = (
-                    item.product_instance.price_per_kilo * item.quantity
-                ) / 1000
-            else:
-                # For other units (piece, liter, meter)
-                item_cost = item.product_instance.price_per_kilo * item.quantity
+    objects = RecipeQuerySet.as_manager()
+
+    @property
+    def unit_cost(self) -> float:
+        """Cost of one unit of this recipe when used as an ingredient."""
+        return unit_cost(self.total_cost, self.yield_quantity)
 
-            total += item_cost
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded yield to detect changes on save
+        instance._loaded_yield = instance.__dict__.get("yield_quantity")
+        return instance
 
-        self.total_cost = total
-        self.save()
-        return total
+    def save(self, *args, **kwargs) -> None:
+        """Save and update recipes using this one if its yield changed."""
+        loaded = getattr(self, "_loaded_yield", None)
+        super().save(*args, **kwargs)
+        self._loaded_yield = self.yield_quantity
+
+        if loaded is not None and loaded != self.yield_quantity:
+            from .tasks import schedule_parent_recost
 
-    def calculate_profit(self) -> float:
-        """Calculate net profit."""
+            schedule_parent_recost([self.pk])
+
+    def calculate_total_cost(self) -> float:
+        """Recalculate total cost from scratch based on current ingredient prices."""
+        from .costing import recalculate_recipes
+
+        recalculate_recipes([self.pk])
+        self.refresh_from_db(fields=["total_cost"])
+        return self.total_cost
+
+    def depends_on(self, recipe_id: int) -> bool:
+        """Check whether this recipe uses a recipe, directly or indirectly."""
+        seen = set()
+        frontier = {self.pk}
+        while frontier:
+            if recipe_id in frontier:
+                return True
+            seen |= frontier
+            frontier = (
+                set(
+                    RecipeItem.objects.filter(
+                        recipe_id__in=frontier, sub_recipe__isnull=False
+                    ).values_list("sub_recipe_id", flat=True)
+                )
+                - seen
+            )
+        return False
+
+    @staticmethod
+    def apply_cost_delta(recipe_id: int, delta: float) -> None:
+        """Atomically add ``delta`` to the stored total cost of a recipe."""
+        if delta:
+            Recipe.objects.filter(pk=recipe_id).update(
+                total_cost=F("total_cost") + delta,
+                cost_version=F("cost_version") + 1,
+            )
+
+    def calculate_profit(self, total_cost: Optional[float] = None) -> float:
+        """Calculate net profit, optionally for another total cost."""
+        if total_cost is None:
+            total_cost = self.total_cost
         if not self.selling_price:
             return 0
-        return self.selling_price - self.total_cost
+        return self.selling_price - total_cost
 
-    def calculate_profit_percentage(self) -> float:
-        """Calculate profit percentage."""
-        if not self.selling_price or self.total_cost == 0:
+    def calculate_profit_percentage(self, total_cost: Optional[float] = None) -> float:
+        """Calculate profit percentage, optionally for another total cost."""
+        if total_cost is None:
+            total_cost = self.total_cost
+        if not self.selling_price or total_cost == 0:
             return 0
-        return (self.selling_price - self.total_cost) / self.total_cost * 100
+        return (self.selling_price - total_cost) / total_cost * 100
 
     def __str__(self) -> str:
         return self.name
@@ -179,6 +543,65 @@ class Recipe(models.Model):
     class Meta:
         verbose_name = "دستور غذا"
         verbose_name_plural = "دستورهای غذا"
+        indexes = [
+            # Keyset pagination of a user's recipes
+            models.Index(
+                fields=["user", "-created_at", "-id"],
+                name="core_recipe_keyset_idx",
+            ),
+        ]
+
+
+class RecipeItemQuerySet(models.QuerySet):
+    """Set-based cost operations for recipe items."""
+
+    def refresh_costs(self) -> int:
+        """
+        Re-derive the stored cost of every product item from current prices.
+
+        Sub-recipe items are left alone, they are costed by walking the
+        sub-recipe graph in ``core.costing``.
+        """
+        price = ProductInstance.objects.filter(
+            pk=OuterRef("product_instance_id")
+        ).values("price_per_kilo")[:1]
+        return self.filter(product_instance__isnull=False).update(
+            cost=Subquery(price, output_field=models.FloatField())
+            * F("quantity")
+            * F("cost_factor")
+        )
+
+    def refresh_cost_factors(self) -> int:
+        """
+        Re-derive the stored cost factor of every product item from the
+        current units, densities and package sizes. Items whose unit can no
+        longer be converted fall back to the unit of their product.
+
+        Costs are not changed, use ``refresh_costs`` afterwards.
+
+        Returns:
+            The number of updated items
+        """
+        changed = []
+        for pk, unit, price_unit, density, package_size, factor in self.filter(
+            product_instance__isnull=False
+        ).values_list(
+            "pk",
+            "unit",
+            "product_instance__unit",
+            "product_instance__product_type__density",
+            "product_instance__product_type__package_size",
+            "cost_factor",
+        ):
+            new_factor = cost_factor(
+                unit or price_unit, price_unit, density, package_size
+            )
+            if new_factor is None:
+                unit, new_factor = "", price_factor(price_unit)
+            if new_factor != factor:
+                changed.append(RecipeItem(pk=pk, unit=unit, cost_factor=new_factor))
+        RecipeItem.objects.bulk_update(changed, ["unit", "cost_factor"], batch_size=500)
+        return len(changed)
 
 
 class RecipeItem(models.Model):
@@ -191,17 +614,135 @@ class RecipeItem(models.Model):
         verbose_name="دستور غذا",
     )
     product_instance = models.ForeignKey(
-        ProductInstance, on_delete=models.CASCADE, verbose_name="ماده اولیه"
+        ProductInstance,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        verbose_name="ماده اولیه",
+    )
+    # A recipe used as an ingredient (sauce, dough, stock, ...)
+    sub_recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name="used_in",
+        null=True,
+        blank=True,
+        verbose_name="دستور غذای فرعی",
     )
     quantity = models.FloatField(default=1, verbose_name="مقدار")
+    # Unit of the quantity, the unit of the product when empty
+    unit = models.CharField(
+        max_length=10, choices=UNIT_CHOICES, blank=True, verbose_name="واحد"
+    )
+    # Precomputed factor for the unit conversion, cost = price * quantity * factor
+    cost_factor = models.FloatField(default=1, verbose_name="ضریب هزینه")
+    # Cost of this ingredient, kept in sync with the recipe total
+    cost = models.FloatField(default=0, verbose_name="هزینه")
+
+    objects = RecipeItemQuerySet.as_manager()
+
+    def calculate_cost(self) -> float:
+        """Calculate the cost of this ingredient."""
+        if self.sub_recipe_id is not None:
+            # Read the stored total, it may have changed since the sub-recipe
+            # was loaded
+            total_cost, yield_quantity = Recipe.objects.values_list(
+                "total_cost", "yield_quantity"
+            ).get(pk=self.sub_recipe_id)
+            return self.quantity * unit_cost(total_cost, yield_quantity)
+        return self.product_instance.price_per_kilo * self.quantity * self.cost_factor
+
+    def calculate_cost_factor(self) -> Optional[float]:
+        """
+        Calculate the factor costing the quantity at the product price, or
+        None if the item unit cannot be converted to the product unit.
+        """
+        if self.product_instance_id is None:
+            return 1.0
+        product = self.product_instance
+        return cost_factor(
+            self.unit or product.unit,
+            product.unit,
+            product.product_type.density,
+            product.product_type.package_size,
+        )
+
+    def clean(self) -> None:
+        """Validate the ingredient source and reject circular sub-recipes."""
+        if (self.product_instance_id is None) == (self.sub_recipe_id is None):
+            raise ValidationError(
+                "یکی از ماده اولیه یا دستور غذای فرعی باید انتخاب شود."
+            )
+        if self.creates_cycle():
+            raise ValidationError(
+                {"sub_recipe": "این دستور غذا باعث ایجاد وابستگی چرخشی می‌شود."}
+            )
+        if self.sub_recipe_id is not None and self.unit:
+            raise ValidationError(
+                {"unit": "برای دستور غذای فرعی واحد قابل انتخاب نیست."}
+            )
+        if self.calculate_cost_factor() is None:
+            raise ValidationError(
+                {"unit": "این واحد قابل تبدیل به واحد ماده اولیه نیست."}
+            )
+
+    def creates_cycle(self) -> bool:
+        """Check whether the sub-recipe depends on the recipe of this item."""
+        if self.sub_recipe_id is None or self.recipe_id is None:
+            return False
+        return self.sub_recipe_id == self.recipe_id or self.sub_recipe.depends_on(
+            self.recipe_id
+        )
+
+    def save(self, *args, **kwargs) -> None:
+        """Store the ingredient cost and apply its delta to the recipe total."""
+        with transaction.atomic():
+            previous = None
+            if self.pk is not None:
+                # Lock the row so concurrent edits of this item are serialized
+                previous = (
+                    RecipeItem.objects.select_for_update()
+                    .filter(pk=self.pk)
+                    .values_list("recipe_id", "cost")
+                    .first()
+                )
+
+            factor = self.calculate_cost_factor()
+            if factor is None:
+                raise ValueError(
+                    f"Cannot convert {self.unit} to {self.product_instance.unit}."
+                )
+            self.cost_factor = factor
+            self.cost = self.calculate_cost()
+            if kwargs.get("update_fields") is not None:
+                # The stored cost has to match the delta applied to the recipe
+                kwargs["update_fields"] = {
+                    *kwargs["update_fields"],
+                    "cost",
+                    "cost_factor",
+                }
+            super().save(*args, **kwargs)
+
+            changed = [self.recipe_id]
+            if previous is None:
+                Recipe.apply_cost_delta(self.recipe_id, self.cost)
+            elif previous[0] != self.recipe_id:
+                # Item moved to another recipe
+                Recipe.apply_cost_delta(previous[0], -previous[1])
+                Recipe.apply_cost_delta(self.recipe_id, self.cost)
+                changed.append(previous[0])
+            else:
+                Recipe.apply_cost_delta(self.recipe_id, self.cost - previous[1])
+
+            from .tasks import schedule_parent_recost
+
+            schedule_parent_recost(changed)
 
     def __str__(self) -> str:
-        unit_display = {
-            "gram": "گرم",
-            "piece": "عدد",
-            "liter": "لیتر",
-            "meter": "متر",
-        }.get(self.product_instance.unit, "واحد")
+        if self.sub_recipe_id is not None:
+            return f"{self.quantity} {self.sub_recipe.name}"
+
+        unit_display = unit_label(self.unit or self.product_instance.unit)
 
         return (
             f"{self.quantity} {unit_display} {self.product_instance.product_type.name}"
@@ -210,3 +751,265 @@ class RecipeItem(models.Model):
     class Meta:
         verbose_name = "ماده تشکیل‌دهنده"
         verbose_name_plural = "مواد تشکیل‌دهنده"
+        indexes = [
+            # Reverse index for finding the recipes that use a product
+            models.Index(
+                fields=["product_instance", "recipe"],
+                name="core_recipeitem_product_idx",
+            ),
+            # Reverse index for walking up the sub-recipe graph
+            models.Index(
+                fields=["sub_recipe", "recipe"],
+                name="core_recipeitem_sub_recipe_idx",
+            ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(product_instance__isnull=False, sub_recipe__isnull=True)
+                | Q(product_instance__isnull=True, sub_recipe__isnull=False),
+                name="core_recipeitem_single_source",
+            ),
+        ]
+
+
+class RecostTask(models.Model):
+    """
+    Pending background recalculation of a recipe cost.
+
+    One row per recipe, so repeated requests for the same recipe coalesce into
+    a single task, due one debounce window after the first request.
+    """
+
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name="recost_task",
+        verbose_name="دستور پخت",
+    )
+    due_at = models.DateTimeField(db_index=True, verbose_name="زمان اجرا")
+
+    def __str__(self) -> str:
+        return f"{self.recipe_id} @ {self.due_at}"
+
+    class Meta:
+        verbose_name = "محاسبه مجدد هزینه"
+        verbose_name_plural = "محاسبه‌های مجدد هزینه"
+
+
+# Thread local storage for the users whose version bumps are batched
+_bumps = local()
+
+
+@contextmanager
+def batched_version_bumps() -> Iterator[None]:
+    """Collect the collection version bumps in the block and apply them once."""
+    if getattr(_bumps, "users", None) is not None:
+        # Nested block, the outermost one bumps
+        yield
+        return
+
+    _bumps.users = set()
+    try:
+        yield
+        users = _bumps.users
+    finally:
+        _bumps.users = None
+    CollectionVersion.objects.bump(users)
+
+
+class CollectionVersionQuerySet(models.QuerySet):
+    """Bulk operations for collection versions."""
+
+    def bump(self, user_ids: Iterable[Optional[int]]) -> None:
+        """
+        Increment the collection versions of the given users, creating the
+        missing ones, with two queries whatever the number of users. Inside
+        a ``batched_version_bumps`` block the users are only recorded.
+        """
+        user_ids = set(user_ids) - {None}
+        if not user_ids:
+            return
+        pending = getattr(_bumps, "users", None)
+        if pending is not None:
+            pending.update(user_ids)
+            return
+        now = timezone.now()
+        self.bulk_create(
+            [CollectionVersion(user_id=pk, updated_at=now) for pk in user_ids],
+            ignore_conflicts=True,
+        )
+        self.filter(user_id__in=user_ids).update(
+            version=F("version") + 1, updated_at=now
+        )
+
+
+class CollectionVersion(models.Model):
+    """
+    Version of the products, recipes and recipe items of a user, bumped on
+    every write to them. Drives conditional GETs of the user's collections.
+    """
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="collection_version",
+        verbose_name="کاربر",
+    )
+    version = models.PositiveBigIntegerField(default=0, verbose_name="نسخه")
+    updated_at = models.DateTimeField(verbose_name="آخرین تغییر")
+
+    objects = CollectionVersionQuerySet.as_manager()
+
+    def __str__(self) -> str:
+        return f"{self.user_id} v{self.version}"
+
+    class Meta:
+        verbose_name = "نسخه داده‌های کاربر"
+        verbose_name_plural = "نسخه‌های داده‌های کاربران"
+
+
+class SearchTerm(models.Model):
+    """
+    Normalized search term of a product type or recipe.
+
+    Every suffix of every normalized word of the searchable text is stored,
+    so substring searches become indexed prefix searches on ``term``.
+    """
+
+    KIND_PRODUCT_TYPE = "product_type"
+    KIND_RECIPE = "recipe"
+
+    KIND_CHOICES = [
+        (KIND_PRODUCT_TYPE, "نوع محصول"),
+        (KIND_RECIPE, "غذا"),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, verbose_name="نوع")
+    object_id = models.PositiveIntegerField(verbose_name="شناسه")
+    term = models.CharField(max_length=32, verbose_name="عبارت")
+
+    def __str__(self) -> str:
+        return f"{self.kind} {self.object_id}: {self.term}"
+
+    class Meta:
+        verbose_name = "عبارت جستجو"
+        verbose_name_plural = "عبارات جستجو"
+        indexes = [
+            # Prefix search of terms (LIKE 'term%')
+            models.Index(
+                fields=["kind", "term"],
+                name="core_searchterm_term_idx",
+                opclasses=["varchar_pattern_ops", "varchar_pattern_ops"],
+            ),
+            # Re-indexing of an object
+            models.Index(
+                fields=["kind", "object_id"], name="core_searchterm_object_idx"
+            ),
+        ]
+
+
+class ImportJob(models.Model):
+    """Background import of an uploaded product type file, with its progress."""
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "در صف"),
+        (STATUS_RUNNING, "در حال اجرا"),
+        (STATUS_DONE, "انجام شد"),
+        (STATUS_FAILED, "ناموفق"),
+    ]
+
+    # Per-row errors kept on the job, the rest are only counted
+    MAX_STORED_ERRORS = 500
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="import_jobs",
+        verbose_name="کاربر",
+    )
+    file_name = models.CharField(max_length=255, verbose_name="نام فایل")
+    path = models.CharField(max_length=500, verbose_name="مسیر فایل موقت")
+    dry_run = models.BooleanField(default=False, verbose_name="فقط پیش‌نمایش")
+    force = models.BooleanField(
+        default=False, verbose_name="وارد کردن دوباره فایل تکراری"
+    )
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=STATUS_PENDING,
+        db_index=True,
+        verbose_name="وضعیت",
+    )
+    bytes_total = models.PositiveBigIntegerField(default=0, verbose_name="حجم فایل")
+    bytes_read = models.PositiveBigIntegerField(
+        default=0, verbose_name="حجم خوانده شده"
+    )
+    rows_processed = models.PositiveIntegerField(
+        default=0, verbose_name="سطرهای پردازش شده"
+    )
+    categories_created = models.PositiveIntegerField(
+        default=0, verbose_name="دسته‌بندی‌های جدید"
+    )
+    product_types_created = models.PositiveIntegerField(
+        default=0, verbose_name="محصولات جدید"
+    )
+    product_types_updated = models.PositiveIntegerField(
+        default=0, verbose_name="محصولات به‌روزرسانی شده"
+    )
+    rows_unchanged = models.PositiveIntegerField(
+        default=0, verbose_name="محصولات بدون تغییر"
+    )
+    error_count = models.PositiveIntegerField(default=0, verbose_name="تعداد خطاها")
+    errors = models.JSONField(default=list, blank=True, verbose_name="خطاها")
+    message = models.TextField(blank=True, verbose_name="پیام")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="تاریخ ایجاد")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="شروع")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="پایان")
+    # Touched by every progress report of a running job
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="آخرین به‌روزرسانی")
+
+    @property
+    def finished(self) -> bool:
+        """Check whether the job has stopped, successfully or not."""
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    @property
+    def percent(self) -> int:
+        """Share of the file read so far, in percent."""
+        if self.status == self.STATUS_DONE:
+            return 100
+        if not self.bytes_total:
+            return 0
+        return min(100, self.bytes_read * 100 // self.bytes_total)
+
+    def __str__(self) -> str:
+        return f"{self.file_name} ({self.get_status_display()})"
+
+    class Meta:
+        verbose_name = "وارد کردن فایل"
+        verbose_name_plural = "وارد کردن فایل‌ها"
+        ordering = ["-created_at"]
+
+
+class ImportedFile(models.Model):
+    """Content hash of a product type file that was imported."""
+
+    sha256 = models.CharField(max_length=64, unique=True, verbose_name="SHA-256")
+    file_name = models.CharField(max_length=255, verbose_name="نام فایل")
+    rows = models.PositiveIntegerField(default=0, verbose_name="تعداد سطرها")
+    imported_at = models.DateTimeField(verbose_name="تاریخ وارد کردن")
+
+    def __str__(self) -> str:
+        return self.file_name
+
+    class Meta:
+        verbose_name = "فایل وارد شده"
+        verbose_name_plural = "فایل‌های وارد شده"
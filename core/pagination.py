@@ -0,0 +1,110 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import List, Optional
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination on the ``keyset_ordering`` of a view.
+
+    Each page continues after the ordering key of the last row of the
+    previous page with an indexed range condition, so there is no COUNT(*)
+    and no OFFSET: late pages cost the same as the first one.
+    """
+
+    cursor_query_param = "cursor"
+
+    def __init__(self, page_size: int):
+        self.page_size = page_size
+
+    def paginate_queryset(self, queryset, request, view=None) -> List:
+        self.request = request
+        self.ordering = view.keyset_ordering
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self._after(queryset.model, cursor))
+
+        rows = list(queryset[: self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[: self.page_size]
+        return self.page
+
+    def _after(self, model, cursor: str) -> Q:
+        """Build the condition selecting the rows after a cursor."""
+        try:
+            values = json.loads(urlsafe_b64decode(cursor.encode()))
+            names = [field.lstrip("-") for field in self.ordering]
+            values = [
+                model._meta.get_field(name).to_python(value)
+                for name, value in zip(names, values, strict=True)
+            ]
+        except Exception:
+            raise NotFound("Invalid cursor.")
+
+        # (a, b) after (x, y) is: a after x, or a = x and b after y
+        condition = Q()
+        equal = Q()
+        for field, name, value in zip(self.ordering, names, values):
+            lookup = "lt" if field.startswith("-") else "gt"
+            condition |= equal & Q(**{f"{name}__{lookup}": value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def _encode(self, row) -> str:
+        """Encode the ordering key of a row as a cursor."""
+        values = [getattr(row, field.lstrip("-")) for field in self.ordering]
+        return urlsafe_b64encode(
+            # Full precision datetimes, DjangoJSONEncoder cuts microseconds
+            json.dumps(values, default=lambda value: value.isoformat()).encode()
+        ).decode()
+
+    def get_next_link(self) -> Optional[str]:
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self._encode(self.page[-1]),
+        )
+
+    def get_paginated_response(self, data) -> Response:
+        return Response({"next": self.get_next_link(), "results": data})
+
+
+class KeysetOrPageNumberPagination(PageNumberPagination):
+    """
+    Page number pagination, with opt-in keyset pagination for views that
+    define a ``keyset_ordering``: requests with ``?cursor=`` (empty for the
+    first page) are paginated by key instead. Keyset pages always follow
+    the ``keyset_ordering``, so ``?ordering=`` is rejected with them.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if KeysetPagination.cursor_query_param in request.query_params and getattr(
+            view, "keyset_ordering", None
+        ):
+            if api_settings.ORDERING_PARAM in request.query_params:
+                raise ValidationError(
+                    {
+                        api_settings.ORDERING_PARAM: "Ordering is not supported "
+                        "with cursor pagination, use page numbers instead."
+                    }
+                )
+            self.keyset = KeysetPagination(self.get_page_size(request))
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -0,0 +1,101 @@
+from typing import Iterable, Tuple
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+
+from .models import LatestPrice, ProductInstance
+
+
+def refresh_latest_prices(keys: Iterable[Tuple[int, int]] = None) -> int:
+    """
+    Rebuild the latest price lookup from the purchase history.
+
+    The latest purchase of each (user, product type) is found with an indexed
+    correlated subquery and upserted in one statement, so the full purchase
+    history is never loaded.
+
+    Args:
+        keys: (user ID, product type ID) pairs to refresh, or None for all
+
+    Returns:
+        The number of lookup rows written
+    """
+    products = ProductInstance.objects.all()
+    condition = None
+    if keys is not None:
+        keys = set(keys)
+        if not keys:
+            return 0
+        condition = Q()
+        for user_id, product_type_id in keys:
+            condition |= Q(user_id=user_id, product_type_id=product_type_id)
+        products = products.filter(condition)
+
+    latest = (
+        ProductInstance.objects.filter(
+            user_id=OuterRef("user_id"), product_type_id=OuterRef("product_type_id")
+        )
+        .order_by("-created_at", "-pk")
+        .values("pk")[:1]
+    )
+    rows = (
+        products.annotate(latest_pk=Subquery(latest))
+        .filter(pk=F("latest_pk"))
+        .values_list(
+            "pk", "user_id", "product_type_id", "price_per_kilo", "unit", "created_at"
+        )
+    )
+    # Readers never see the lookup emptied, nor left half rebuilt on failure
+    with transaction.atomic():
+        stale = LatestPrice.objects.all()
+        if condition is not None:
+            stale = stale.filter(condition)
+        stale.delete()
+        return len(
+            LatestPrice.objects.bulk_create(
+                [
+                    LatestPrice(
+                        product_instance_id=pk,
+                        user_id=user_id,
+                        product_type_id=product_type_id,
+                        price_per_kilo=price_per_kilo,
+                        unit=unit,
+                        purchased_at=created_at,
+                    )
+                    for pk, user_id, product_type_id, price_per_kilo, unit, created_at in rows
+                ],
+                batch_size=1000,
+            )
+        )
+
+
+def record_latest_price(product: ProductInstance, created: bool) -> None:
+    """Keep the latest price lookup in sync with a saved product instance."""
+    if created:
+        # A new purchase is always the latest one of its product type
+        LatestPrice.objects.update_or_create(
+            user_id=product.user_id,
+            product_type_id=product.product_type_id,
+            defaults={
+                "product_instance": product,
+                "price_per_kilo": product.price_per_kilo,
+                "unit": product.unit,
+                "purchased_at": product.created_at,
+            },
+        )
+        return
+
+    latest = LatestPrice.objects.filter(product_instance=product).first()
+    if latest is None:
+        return
+    if latest.product_type_id != product.product_type_id:
+        refresh_latest_prices(
+            [
+                (product.user_id, latest.product_type_id),
+                (product.user_id, product.product_type_id),
+            ]
+        )
+    elif (latest.price_per_kilo, latest.unit) != (product.price_per_kilo, product.unit):
+        latest.price_per_kilo = product.price_per_kilo
+        latest.unit = product.unit
+        latest.save(update_fields=["price_per_kilo", "unit"])
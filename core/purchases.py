@@ -0,0 +1,262 @@
+import os
+from itertools import islice
+from typing import Dict, Iterator, List, Tuple
+from zipfile import BadZipFile
+
+import numpy as np
+import pandas as pd
+from django.contrib.auth.models import User
+from django.db import transaction
+from openpyxl.utils.exceptions import InvalidFileException
+
+from .importer import open_rows
+from .models import (
+    CollectionVersion,
+    LatestPrice,
+    PriceHistory,
+    ProductInstance,
+    ProductType,
+)
+from .units import GRAM, PRICE_FACTORS
+
+# Columns of a purchase file, in order, after its header row
+COLUMNS = ["product_type", "total_weight", "unit", "price_per_kilo"]
+
+# Rows read and derived at once
+CHUNK_ROWS = 50_000
+
+# Rows per bulk INSERT
+BATCH_SIZE = 5000
+
+# Per-row errors kept in a result, the rest are only counted
+MAX_ERRORS = 1000
+
+
+class PurchaseImportResult:
+    """Outcome of a purchase import."""
+
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.error_count = 0
+        self.errors: List[str] = []
+
+    def add_errors(self, errors: List[str]) -> None:
+        """Count errors, keeping the first ``MAX_ERRORS`` of them."""
+        self.error_count += len(errors)
+        self.errors.extend(errors[: MAX_ERRORS - len(self.errors)])
+
+    def as_dict(self) -> dict:
+        return {
+            "rows": self.rows,
+            "created": self.created,
+            "error_count": self.error_count,
+            "errors": self.errors,
+        }
+
+
+def read_purchases(path: str, chunk_rows: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """
+    Read a CSV or Excel (.xlsx) purchase file in frames of ``chunk_rows``
+    rows of text, indexed by their row number in the file.
+
+    CSV files are parsed by pandas in chunks, workbooks are streamed in
+    read-only mode, so only one frame is in memory at a time.
+
+    Raises:
+        ValueError: If the file cannot be parsed, e.g. it has fewer columns
+            than ``COLUMNS``
+    """
+    if os.path.splitext(path)[1].lower() != ".xlsx":
+        frames = pd.read_csv(
+            path,
+            header=None,
+            skiprows=1,
+            names=COLUMNS,
+            usecols=range(len(COLUMNS)),
+            dtype=str,
+            keep_default_na=False,
+            encoding="utf-8-sig",
+            chunksize=chunk_rows,
+        )
+        for frame in frames:
+            frame.index += 2
+            yield frame
+        return
+
+    width = len(COLUMNS)
+    try:
+        with open_rows(path) as (rows, _):
+            line = 2
+            while True:
+                chunk = [
+                    (row + [""] * width)[:width] for row in islice(rows, chunk_rows)
+                ]
+                if not chunk:
+                    return
+                frame = pd.DataFrame(
+                    chunk, columns=COLUMNS, index=range(line, line + len(chunk))
+                )
+                line += len(chunk)
+                # Blank rows, which the CSV parser skips
+                yield frame[(frame != "").any(axis=1)]
+    except (BadZipFile, InvalidFileException) as e:
+        raise ValueError(f"Not a valid .xlsx workbook: {e}") from e
+
+
+def derive(
+    frame: pd.DataFrame, product_types: Dict[str, Tuple[int, float]]
+) -> Tuple[pd.DataFrame, List[str]]:
+    """
+    Validate a frame of purchase rows and compute their derived fields for
+    the whole frame at once, as ``ProductInstance.compute_derived_fields``
+    does for one instance.
+
+    Args:
+        product_types: ID and waste ratio of the product types by name
+
+    Returns:
+        The valid rows with the ProductInstance fields as columns, and the
+        errors of the other rows
+    """
+    names = frame["product_type"].str.strip()
+    product_type_ids = names.map({name: pk for name, (pk, _) in product_types.items()})
+    waste_ratio = names.map({name: ratio for name, (_, ratio) in product_types.items()})
+    total_weight = pd.to_numeric(frame["total_weight"].str.strip(), errors="coerce")
+    price = pd.to_numeric(frame["price_per_kilo"].str.strip(), errors="coerce")
+    unit = frame["unit"].str.strip().replace("", GRAM)
+    factor = unit.map(PRICE_FACTORS)
+
+    checks = [
+        (product_type_ids.isna(), "نوع محصول {name} یافت نشد"),
+        (~(total_weight >= 0), "مقدار نامعتبر برای محصول {name}"),
+        (~(price >= 0), "قیمت نامعتبر برای محصول {name}"),
+        (factor.isna(), "واحد نامعتبر برای محصول {name}"),
+    ]
+    invalid = np.zeros(len(frame), dtype=bool)
+    errors = []
+    for mask, message in checks:
+        # One error per row, for the first check it fails
+        mask = mask.to_numpy() & ~invalid
+        errors.extend(
+            (line, message.format(name=name)) for line, name in names[mask].items()
+        )
+        invalid |= mask
+
+    valid = ~invalid
+    total_weight = total_weight[valid].to_numpy(dtype=float)
+    price = price[valid].to_numpy(dtype=float)
+    waste_weight = total_weight * waste_ratio[valid].to_numpy(dtype=float)
+    unit_price = price * factor[valid].to_numpy(dtype=float)
+    derived = pd.DataFrame(
+        {
+            "product_type_id": product_type_ids[valid].to_numpy(dtype=np.int64),
+            "total_weight": total_weight,
+            "price_per_kilo": price,
+            "unit": unit[valid].to_numpy(),
+            "waste_weight": waste_weight,
+            "net_weight": total_weight - waste_weight,
+            "total_price": unit_price * total_weight + unit_price * waste_weight,
+        },
+        index=frame.index[valid],
+    )
+    return derived, [f"سطر {line}: {message}" for line, message in sorted(errors)]
+
+
+def _product_types() -> Dict[str, Tuple[int, float]]:
+    """Return the ID and waste ratio of every product type by name."""
+    product_types = {}
+    for pk, name, base_weight, waste in ProductType.objects.order_by("pk").values_list(
+        "pk", "name", "base_weight", "waste"
+    ):
+        ratio = waste / base_weight if base_weight > 0 else 0
+        product_types.setdefault(name, (pk, ratio))
+    return product_types
+
+
+def import_purchases(
+    path: str,
+    user: User,
+    chunk_rows: int = CHUNK_ROWS,
+    batch_size: int = BATCH_SIZE,
+) -> PurchaseImportResult:
+    """
+    Create the purchases (product instances) of a user from a CSV or Excel
+    file of ``product type, weight, unit, price`` rows.
+
+    The file is read in frames whose derived fields are computed with
+    vectorized pandas operations. The product instances are inserted with
+    chunked ``bulk_create`` calls in a single transaction, and their price
+    history from the returned objects. The latest prices and the collection
+    version of the user are updated once at the end, as the signals of a
+    saved product would. Invalid rows are reported and skipped.
+
+    Raises:
+        ValueError: If the file cannot be parsed
+
+    Returns:
+        The counts of the import and the errors of the skipped rows
+    """
+    result = PurchaseImportResult()
+    product_types = _product_types()
+    # Last imported product of each product type
+    latest: Dict[int, ProductInstance] = {}
+
+    with transaction.atomic():
+        for frame in read_purchases(path, chunk_rows):
+            result.rows += len(frame)
+            derived, errors = derive(frame, product_types)
+            result.add_errors(errors)
+            if derived.empty:
+                continue
+
+            products = ProductInstance.objects.bulk_create(
+                [
+                    ProductInstance(user_id=user.pk, **row)
+                    for row in derived.to_dict("records")
+                ],
+                batch_size=batch_size,
+            )
+            PriceHistory.objects.bulk_create(
+                [
+                    PriceHistory(
+                        product_type_id=product.product_type_id,
+                        user_id=user.pk,
+                        product_instance_id=product.pk,
+                        price_per_kilo=product.price_per_kilo,
+                        unit=product.unit,
+                        effective_at=product.created_at,
+                    )
+                    for product in products
+                ],
+                batch_size=batch_size,
+            )
+            latest.update((product.product_type_id, product) for product in products)
+            result.created += len(products)
+
+        if latest:
+            # A new purchase is always the latest one of its product type
+            LatestPrice.objects.bulk_create(
+                [
+                    LatestPrice(
+                        product_instance_id=product.pk,
+                        user_id=user.pk,
+                        product_type_id=product.product_type_id,
+                        price_per_kilo=product.price_per_kilo,
+                        unit=product.unit,
+                        purchased_at=product.created_at,
+                    )
+                    for product in latest.values()
+                ],
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=["user", "product_type"],
+                update_fields=[
+                    "product_instance",
+                    "price_per_kilo",
+                    "unit",
+                    "purchased_at",
+                ],
+            )
+            CollectionVersion.objects.bump([user.pk])
+    return result
@@ -0,0 +1,179 @@
+import re
+from typing import Dict, Iterable, List, Set
+
+from django.db import connection, transaction
+from django.db.models import Q
+from rest_framework.filters import SearchFilter
+
+from .models import ProductType, Recipe, SearchTerm
+
+# Arabic variants folded to their Persian form, Persian and Arabic digits to
+# ASCII ones. Diacritics, tatweel and zero-width joiners are dropped, so
+# "می‌خواهم" and "میخواهم" are the same word.
+_FOLD = str.maketrans(
+    {
+        "ي": "ی",
+        "ى": "ی",
+        "ئ": "ی",
+        "ك": "ک",
+        "ة": "ه",
+        "ۀ": "ه",
+        "أ": "ا",
+        "إ": "ا",
+        "آ": "ا",
+        "ٱ": "ا",
+        "ؤ": "و",
+        **{chr(0x06F0 + digit): str(digit) for digit in range(10)},
+        **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+        **{chr(code): None for code in range(0x064B, 0x0660)},
+        "\u0670": None,  # Superscript alef
+        "\u0640": None,  # Tatweel
+        "\u200c": None,  # Zero-width non-joiner
+        "\u200d": None,  # Zero-width joiner
+    }
+)
+
+_WORD_SEPARATORS = re.compile(r"[\W_]+")
+
+# Longest stored term, longer search words are compared on their beginning
+MAX_TERM_LENGTH = SearchTerm._meta.get_field("term").max_length
+
+# Words of a query that are looked up, the rest are ignored
+MAX_QUERY_WORDS = 5
+
+
+def normalize(text: str) -> str:
+    """Normalize text for searching: fold character variants and case."""
+    return " ".join(words(text))
+
+
+def words(text: str) -> List[str]:
+    """Split text into normalized words."""
+    if not text:
+        return []
+    text = text.translate(_FOLD).casefold()
+    return [word for word in _WORD_SEPARATORS.split(text) if word]
+
+
+def terms(text: str) -> Set[str]:
+    """Return the suffixes of the normalized words of a text."""
+    return {
+        word[start:][:MAX_TERM_LENGTH]
+        for word in words(text)
+        for start in range(len(word))
+    }
+
+
+def _product_type_text(product_type: ProductType) -> str:
+    return product_type.name
+
+
+def _recipe_text(recipe: Recipe) -> str:
+    return f"{recipe.name} {recipe.description or ''}"
+
+
+# Searchable text of the indexed models
+INDEXED = {
+    SearchTerm.KIND_PRODUCT_TYPE: (ProductType, ["name"], _product_type_text),
+    SearchTerm.KIND_RECIPE: (Recipe, ["name", "description"], _recipe_text),
+}
+
+
+def index_texts(kind: str, texts: Dict[int, str]) -> int:
+    """
+    Replace the search terms of objects.
+
+    Args:
+        kind: The ``SearchTerm`` kind of the objects
+        texts: Searchable text by object ID
+
+    Returns:
+        The number of stored terms
+    """
+    rows = [
+        SearchTerm(kind=kind, object_id=pk, term=term)
+        for pk, text in texts.items()
+        for term in terms(text)
+    ]
+    with transaction.atomic():
+        SearchTerm.objects.filter(kind=kind, object_id__in=list(texts)).delete()
+        SearchTerm.objects.bulk_create(rows, batch_size=2000)
+    return len(rows)
+
+
+def index_objects(kind: str, objects: Iterable) -> int:
+    """Replace the search terms of product types or recipes."""
+    text = INDEXED[kind][2]
+    return index_texts(kind, {obj.pk: text(obj) for obj in objects})
+
+
+def rebuild_index(kind: str, chunk_size: int = 2000) -> int:
+    """
+    Rebuild the search terms of every object of a kind.
+
+    Returns:
+        The number of stored terms
+    """
+    model, fields, _ = INDEXED[kind]
+    SearchTerm.objects.filter(kind=kind).delete()
+    count = 0
+    chunk = []
+    for obj in model.objects.only("pk", *fields).iterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk) == chunk_size:
+            count += index_objects(kind, chunk)
+            chunk = []
+    return count + index_objects(kind, chunk)
+
+
+def _prefix(word: str) -> Q:
+    """Condition selecting the terms starting with a word."""
+    if connection.vendor == "postgresql":
+        # LIKE 'word%' is served by the varchar_pattern_ops index
+        return Q(term__startswith=word)
+    # Other backends only use the index for a range in binary order
+    return Q(term__gte=word, term__lt=word + "\U0010ffff")
+
+
+def matching(kind: str, query: str):
+    """
+    Return the querysets of the object IDs matching each word of a query.
+
+    A word matches an object if it occurs in one of its words, after
+    normalization. Each lookup is a prefix range scan on the term index.
+    """
+    return [
+        SearchTerm.objects.filter(_prefix(word[:MAX_TERM_LENGTH]), kind=kind).values(
+            "object_id"
+        )
+        for word in words(query)[:MAX_QUERY_WORDS]
+    ]
+
+
+def search(queryset, kind: str, query: str, lookup: str = "pk"):
+    """
+    Filter a queryset to the objects whose indexed text contains every word
+    of a query.
+
+    Args:
+        lookup: Field of the queryset holding the ID of the indexed object
+    """
+    for object_ids in matching(kind, query):
+        queryset = queryset.filter(**{f"{lookup}__in": object_ids})
+    return queryset
+
+
+class NormalizedSearchFilter(SearchFilter):
+    """
+    Search filter using the normalized search index for views with a
+    ``search_index``, a ``(kind, lookup)`` pair, and ``search_fields``
+    otherwise.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        index = getattr(view, "search_index", None)
+        query = request.query_params.get(self.search_param, "")
+        if index is None or not query.strip():
+            return super().filter_queryset(request, queryset, view)
+        kind, lookup = index
+        return search(queryset, kind, query, lookup)
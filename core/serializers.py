@@ -1,15 +1,142 @@
+from typing import FrozenSet, List, NamedTuple, Optional
+
 from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+from core.models import (
+    Category,
+    ProductInstance,
+    ProductType,
+    Recipe,
+    RecipeItem,
+    RecostTask,
+    unit_cost,
+)
+
+
+class FieldSelection(NamedTuple):
+    """
+    Fields and nested relations requested with ``?fields=`` and ``?expand=``.
+
+    ``fields`` limits the top-level fields, None keeps them all. ``expand``
+    lists the nested relations to embed, with dotted paths for deeper
+    levels; None embeds every relation as before.
+    """
+
+    fields: Optional[FrozenSet[str]] = None
+    expand: Optional[FrozenSet[str]] = None
+
+    @classmethod
+    def from_request(cls, request) -> "FieldSelection":
+        """Parse the selection of a read request, writes always get everything."""
+        if request is None or request.method not in SAFE_METHODS:
+            return cls()
+        params = request.query_params
+        fields = expand = None
+        if "fields" in params:
+            fields = frozenset(_split(params["fields"]))
+        if "expand" in params:
+            # Expanding a path also expands every relation on the way
+            expand = frozenset(
+                ".".join(parts[: depth + 1])
+                for parts in (path.split(".") for path in _split(params["expand"]))
+                for depth in range(len(parts))
+            )
+        return cls(fields, expand)
+
+    def includes(self, name: str) -> bool:
+        """Check whether a top-level field is requested."""
+        return self.fields is None or name in self.fields
+
+    def expands(self, path: str) -> bool:
+        """Check whether a (dotted) relation path is embedded."""
+        return self.expand is None or path in self.expand
+
+    def nested(self, name: str) -> "FieldSelection":
+        """Return the selection for the serializer of a nested relation."""
+        if self.expand is None:
+            return FieldSelection()
+        prefix = f"{name}."
+        return FieldSelection(
+            expand=frozenset(
+                path.removeprefix(prefix)
+                for path in self.expand
+                if path.startswith(prefix)
+            )
+        )
+
+    def select_related(self, *path: str) -> Optional[str]:
+        """
+        Return the longest embedded prefix of a relation path as a
+        ``select_related`` lookup, or None if the relation is not needed.
+        """
+        if not self.includes(path[0]):
+            return None
+        selected = []
+        for name in path:
+            if not self.expands(".".join(selected + [name])):
+                break
+            selected.append(name)
+        return "__".join(selected) or None
+
+
+def _split(value: str) -> List[str]:
+    """Split a comma separated query parameter."""
+    return [part.strip() for part in value.split(",") if part.strip()]
+
+
+class DynamicFieldsMixin:
+    """
+    Serializer mixin for sparse fieldsets and flat/expand modes.
+
+    ``?fields=id,name`` returns only the listed fields. When ``?expand=`` is
+    given, nested relations are returned as plain IDs unless listed in it,
+    e.g. ``?expand=recipe_items.product_instance``. Without it relations are
+    embedded as before.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selection = getattr(self, "_selection", None)
+        if selection is None:
+            if not self._is_root():
+                return fields
+            selection = FieldSelection.from_request(self.context.get("request"))
+            if selection.fields is not None:
+                fields = {
+                    name: field
+                    for name, field in fields.items()
+                    if field.write_only or name in selection.fields
+                }
+
+        for name, field in list(fields.items()):
+            many = isinstance(field, serializers.ListSerializer)
+            nested = field.child if many else field
+            if not isinstance(nested, DynamicFieldsMixin):
+                continue
+            if selection.expands(name):
+                nested._selection = selection.nested(name)
+            else:
+                fields[name] = serializers.PrimaryKeyRelatedField(
+                    source=field.source, many=many, read_only=True
+                )
+        return fields
 
-from core.models import Category, ProductInstance, ProductType, Recipe, RecipeItem
+    def _is_root(self) -> bool:
+        """Check whether this is the top-level serializer of the response."""
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = "__all__"
 
 
-class ProductTypeSerializer(serializers.ModelSerializer):
+class ProductTypeSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     category = CategorySerializer(read_only=True)
     category_id = serializers.PrimaryKeyRelatedField(
         queryset=Category.objects.all(),
@@ -29,11 +156,13 @@ class ProductTypeSerializer(serializers.ModelSerializer):
             "category",
             "category_id",
             "unit",
+            "density",
+            "package_size",
             "waste_ratio",
         ]
 
 
-class ProductInstanceSerializer(serializers.ModelSerializer):
+class ProductInstanceSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     product_type = ProductTypeSerializer(read_only=True)
     product_type_id = serializers.PrimaryKeyRelatedField(
         queryset=ProductType.objects.all(), source="product_type", write_only=True
@@ -63,24 +192,91 @@ class ProductInstanceSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class RecipeItemSerializer(serializers.ModelSerializer):
+class RecipeItemSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     product_instance = ProductInstanceSerializer(read_only=True)
     product_instance_id = serializers.PrimaryKeyRelatedField(
         queryset=ProductInstance.objects.all(),
         source="product_instance",
         write_only=True,
+        required=False,
+        allow_null=True,
+    )
+    recipe = serializers.PrimaryKeyRelatedField(queryset=Recipe.objects.all())
+    sub_recipe = serializers.PrimaryKeyRelatedField(
+        queryset=Recipe.objects.all(), required=False, allow_null=True
     )
 
     class Meta:
         model = RecipeItem
-        fields = ["id", "product_instance", "product_instance_id", "quantity"]
+        fields = [
+            "id",
+            "recipe",
+            "product_instance",
+            "product_instance_id",
+            "sub_recipe",
+            "quantity",
+            "unit",
+            "cost",
+        ]
+        read_only_fields = ["cost"]
+
+    def validate(self, attrs):
+        item = RecipeItem(
+            recipe=attrs.get("recipe", getattr(self.instance, "recipe", None)),
+            product_instance=attrs.get(
+                "product_instance", getattr(self.instance, "product_instance", None)
+            ),
+            sub_recipe=attrs.get(
+                "sub_recipe", getattr(self.instance, "sub_recipe", None)
+            ),
+            unit=attrs.get("unit", getattr(self.instance, "unit", "")),
+        )
+        if (item.product_instance is None) == (item.sub_recipe is None):
+            raise serializers.ValidationError(
+                "Exactly one of product_instance_id or sub_recipe is required."
+            )
 
+        request = self.context.get("request")
+        if (
+            "recipe" in attrs
+            and request is not None
+            and item.recipe.user != request.user
+            and not request.user.is_staff
+        ):
+            raise serializers.ValidationError(
+                {"recipe": "You do not have permission to add items to this recipe."}
+            )
+        if (
+            item.sub_recipe is not None
+            and request is not None
+            and item.sub_recipe.user != request.user
+            and not request.user.is_staff
+        ):
+            raise serializers.ValidationError(
+                {"sub_recipe": "You do not have permission to use this recipe."}
+            )
+        if item.creates_cycle():
+            raise serializers.ValidationError(
+                {"sub_recipe": "This recipe would create a circular dependency."}
+            )
+        if item.sub_recipe is not None and item.unit:
+            raise serializers.ValidationError(
+                {"unit": "A unit cannot be set for a sub-recipe."}
+            )
+        if item.calculate_cost_factor() is None:
+            raise serializers.ValidationError(
+                {"unit": "This unit cannot be converted to the product unit."}
+            )
+        return attrs
 
-class RecipeSerializer(serializers.ModelSerializer):
+
+class RecipeSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     recipe_items = RecipeItemSerializer(many=True, read_only=True)
     user = serializers.PrimaryKeyRelatedField(read_only=True)
     profit = serializers.SerializerMethodField()
     profit_percentage = serializers.SerializerMethodField()
+    unit_cost = serializers.FloatField(read_only=True)
+    cost_pending = serializers.SerializerMethodField()
 
     class Meta:
         model = Recipe
@@ -92,19 +288,71 @@ class RecipeSerializer(serializers.ModelSerializer):
             "user",
             "total_cost",
             "selling_price",
+            "yield_quantity",
+            "unit_cost",
+            "cost_version",
+            "cost_pending",
             "recipe_items",
             "profit",
             "profit_percentage",
         ]
-        read_only_fields = ["created_at", "total_cost"]
+        read_only_fields = ["created_at", "total_cost", "cost_version"]
 
     def create(self, validated_data):
         # Set the current user
         validated_data["user"] = self.context["request"].user
         return super().create(validated_data)
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+
+        # Replace stored costs with market costs in market pricing mode
+        market_costs = self.context.get("market_costs")
+        if market_costs is not None and instance.pk in market_costs:
+            total_cost = market_costs[instance.pk]
+            market = {
+                "total_cost": total_cost,
+                "unit_cost": unit_cost(total_cost, instance.yield_quantity),
+                "profit": instance.calculate_profit(total_cost),
+                "profit_percentage": instance.calculate_profit_percentage(total_cost),
+            }
+            # Only the requested fields
+            data.update({key: value for key, value in market.items() if key in data})
+        return data
+
+    def get_cost_pending(self, obj):
+        # Annotated by RecipeViewSet; queried for instances loaded elsewhere
+        pending = getattr(obj, "cost_pending", None)
+        if pending is None:
+            pending = RecostTask.objects.filter(recipe=obj).exists()
+        return pending
+
     def get_profit(self, obj):
         return obj.calculate_profit()
 
     def get_profit_percentage(self, obj):
         return obj.calculate_profit_percentage()
+
+
+class PriceShockSerializer(serializers.Serializer):
+    """A price change applied to a category or a product type."""
+
+    category = serializers.IntegerField(required=False)
+    product_type = serializers.IntegerField(required=False)
+    percent = serializers.FloatField(required=False, min_value=-100)
+    price = serializers.FloatField(required=False, min_value=0)
+
+    def validate(self, attrs):
+        if ("category" in attrs) == ("product_type" in attrs):
+            raise serializers.ValidationError(
+                "Exactly one of category or product_type is required."
+            )
+        if ("percent" in attrs) == ("price" in attrs):
+            raise serializers.ValidationError(
+                "Exactly one of percent or price is required."
+            )
+        return attrs
+
+
+class PriceSimulationSerializer(serializers.Serializer):
+    shocks = PriceShockSerializer(many=True)
@@ -1,10 +1,26 @@
 from threading import local
 
-from django.db.models.signals import pre_save
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.deprecation import MiddlewareMixin
 
-from .models import ProductInstance
+from .cache import invalidate_reference_data
+from .costing import propagate_price_changes, recost_deferred
+from .models import (
+    Category,
+    CollectionVersion,
+    PriceHistory,
+    ProductInstance,
+    ProductType,
+    Recipe,
+    RecipeItem,
+    SearchTerm,
+)
+from .pricing import record_latest_price, refresh_latest_prices
+from .search import INDEXED, index_objects
+from .tasks import schedule_parent_recost
 
 # Thread local storage to store the current user
 _thread_locals = local()
@@ -25,6 +41,11 @@ class CurrentUserMiddleware(MiddlewareMixin):
     def process_request(self, request):
         _thread_locals.user = getattr(request, "user", None)
 
+    def process_response(self, request, response):
+        # Do not leak the user to code running later in this thread
+        _thread_locals.user = None
+        return response
+
 
 @receiver(pre_save, sender=ProductInstance)
 def set_product_user(sender, instance, **kwargs):
@@ -36,3 +57,181 @@ def set_product_user(sender, instance, **kwargs):
         current_user = get_current_user()
         if current_user and current_user.is_authenticated:
             instance.user = current_user
+
+
+@receiver(post_save, sender=ProductInstance)
+def record_price_history(sender, instance, created, **kwargs):
+    """
+    Signal to append the price of a ProductInstance to the price history
+    when it is created or its price or unit changes.
+    """
+    if created or instance.pricing_changed:
+        PriceHistory.objects.create(
+            product_type_id=instance.product_type_id,
+            user_id=instance.user_id,
+            product_instance=instance,
+            price_per_kilo=instance.price_per_kilo,
+            unit=instance.unit,
+            effective_at=instance.created_at if created else timezone.now(),
+        )
+
+
+@receiver(post_save, sender=ProductInstance)
+def update_latest_price(sender, instance, created, **kwargs):
+    """
+    Signal to keep the latest price per (user, product type) in sync with
+    a saved ProductInstance.
+    """
+    record_latest_price(instance, created)
+
+
+@receiver(post_delete, sender=ProductInstance)
+def remove_latest_price(sender, instance, **kwargs):
+    """
+    Signal to fall back to the previous purchase in the latest price lookup
+    when a ProductInstance is deleted.
+    """
+    refresh_latest_prices([(instance.user_id, instance.product_type_id)])
+
+
+@receiver(post_save, sender=ProductInstance)
+def propagate_product_price(sender, instance, created, **kwargs):
+    """
+    Signal to update the costs of recipes using a ProductInstance
+    when its price or unit changes.
+    """
+    if not created and instance.pricing_changed:
+        if instance.unit_changed:
+            # The stored unit conversion factors of its ingredients are stale
+            RecipeItem.objects.filter(product_instance=instance).refresh_cost_factors()
+        propagate_price_changes([instance.pk])
+
+
+def _deleting_user(origin, user_id) -> bool:
+    """Check whether an object is deleted because its owner is deleted."""
+    return isinstance(origin, User) and origin.pk == user_id
+
+
+def _deleting_own_recipe(instance, origin) -> bool:
+    """Check whether a RecipeItem is deleted because its recipe is deleted."""
+    return isinstance(origin, Recipe) and origin.pk == instance.recipe_id
+
+
+@receiver(pre_delete, sender=RecipeItem)
+def lock_recipe_item_cost(sender, instance, origin=None, **kwargs):
+    """
+    Signal to lock a RecipeItem before deletion and read its latest stored
+    cost, so a concurrent edit of the item is not lost.
+    """
+    if _deleting_own_recipe(instance, origin) or recost_deferred(instance.recipe_id):
+        return
+    cost = (
+        RecipeItem.objects.select_for_update()
+        .filter(pk=instance.pk)
+        .values_list("cost", flat=True)
+        .first()
+    )
+    if cost is not None:
+        instance.cost = cost
+
+
+@receiver(post_delete, sender=RecipeItem)
+def subtract_recipe_item_cost(sender, instance, origin=None, **kwargs):
+    """
+    Signal to subtract the cost of a deleted RecipeItem from its recipe and
+    update the recipes using it. Skipped when the recipe itself is deleted,
+    and in batches, which recalculate the affected recipes once at the end.
+    """
+    if _deleting_own_recipe(instance, origin) or recost_deferred(instance.recipe_id):
+        return
+    Recipe.apply_cost_delta(instance.recipe_id, -instance.cost)
+    schedule_parent_recost([instance.recipe_id])
+
+
+@receiver(post_save, sender=ProductInstance)
+@receiver(post_delete, sender=ProductInstance)
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def bump_owner_collection_version(sender, instance, origin=None, **kwargs):
+    """
+    Signal to bump the collection version of the owner of a saved or
+    deleted ProductInstance or Recipe. Skipped when the owner itself is
+    deleted, along with its collection version.
+    """
+    if _deleting_user(origin, instance.user_id):
+        return
+    CollectionVersion.objects.bump([instance.user_id])
+
+
+@receiver(post_save, sender=RecipeItem)
+@receiver(post_delete, sender=RecipeItem)
+def bump_recipe_collection_version(sender, instance, **kwargs):
+    """
+    Signal to bump the collection version of the owner of the recipe of a
+    saved or deleted RecipeItem. Skipped in batches, which bump when they
+    recalculate the affected recipes.
+    """
+    if kwargs.get("signal") is post_delete and recost_deferred(instance.recipe_id):
+        return
+    owners = Recipe.objects.filter(pk=instance.recipe_id).values_list(
+        "user_id", flat=True
+    )
+    origin = kwargs.get("origin")
+    if isinstance(origin, User):
+        owners = owners.exclude(user_id=origin.pk)
+    CollectionVersion.objects.bump(owners)
+
+
+@receiver(post_save, sender=ProductType)
+@receiver(post_delete, sender=ProductType)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def bump_catalog_collection_versions(sender, instance, **kwargs):
+    """
+    Signal to bump the collection versions of the users with products of a
+    saved or deleted ProductType or Category, which their products embed.
+    """
+    lookup = "product_type" if sender is ProductType else "product_type__category"
+    CollectionVersion.objects.bump(
+        ProductInstance.objects.filter(**{lookup: instance.pk})
+        .values_list("user_id", flat=True)
+        .distinct()
+    )
+
+
+@receiver(post_save, sender=ProductType)
+@receiver(post_delete, sender=ProductType)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_reference_cache(sender, instance, **kwargs):
+    """
+    Signal to invalidate the cached categories and product types when one
+    of them is saved or deleted.
+    """
+    invalidate_reference_data()
+
+
+def _search_kind(sender) -> str:
+    """Return the search term kind of an indexed model."""
+    if sender is ProductType:
+        return SearchTerm.KIND_PRODUCT_TYPE
+    return SearchTerm.KIND_RECIPE
+
+
+@receiver(post_save, sender=ProductType)
+@receiver(post_save, sender=Recipe)
+def index_search_terms(sender, instance, update_fields=None, **kwargs):
+    """
+    Signal to keep the search terms of a ProductType or Recipe in sync with
+    its searchable text.
+    """
+    kind = _search_kind(sender)
+    if update_fields is None or set(update_fields) & set(INDEXED[kind][1]):
+        index_objects(kind, [instance])
+
+
+@receiver(post_delete, sender=ProductType)
+@receiver(post_delete, sender=Recipe)
+def remove_search_terms(sender, instance, **kwargs):
+    """Signal to remove the search terms of a deleted ProductType or Recipe."""
+    SearchTerm.objects.filter(kind=_search_kind(sender), object_id=instance.pk).delete()
@@ -0,0 +1,153 @@
+from typing import Any, Dict, Iterable, List
+
+import numpy as np
+
+from .costing import topological_order
+from .models import Recipe, RecipeItem, unit_cost
+
+
+def simulate_recipe_costs(
+    recipes, shocks: Iterable[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Calculate recipe costs and profits under price shocks without writing.
+
+    The recipe x ingredient matrix is loaded once into NumPy arrays and the
+    whole scenario is evaluated as one vectorized computation, using the
+    stored unit conversion factor of each ingredient. Sub-recipes are
+    evaluated level by level up the sub-recipe graph.
+
+    Args:
+        recipes: Queryset of the recipes to simulate
+        shocks: Price shocks applied in order. Each one targets a ``category``
+            or ``product_type`` ID and either changes prices by ``percent``
+            or sets them to ``price``.
+
+    Returns:
+        A list of simulated costs and profits, one entry per recipe
+    """
+    recipe_rows = list(
+        recipes.order_by("pk").values_list(
+            "pk", "name", "total_cost", "selling_price", "yield_quantity"
+        )
+    )
+    if not recipe_rows:
+        return []
+
+    recipe_ids = np.array([row[0] for row in recipe_rows], dtype=np.int64)
+    items = list(
+        RecipeItem.objects.filter(recipe__in=recipes).values_list(
+            "recipe_id",
+            "product_instance__product_type_id",
+            "product_instance__product_type__category_id",
+            "cost_factor",
+            "product_instance__price_per_kilo",
+            "quantity",
+            "sub_recipe_id",
+        )
+    )
+    product_items = [item for item in items if item[6] is None]
+    sub_recipe_items = [item for item in items if item[6] is not None]
+
+    if product_items:
+        columns = list(zip(*product_items))
+        recipe_index = np.searchsorted(recipe_ids, np.array(columns[0], dtype=np.int64))
+        product_types = np.array(columns[1], dtype=np.int64)
+        categories = np.array(
+            [-1 if category is None else category for category in columns[2]],
+            dtype=np.int64,
+        )
+        factors = np.array(columns[3], dtype=np.float64)
+        prices = np.array(columns[4], dtype=np.float64)
+        quantities = np.array(columns[5], dtype=np.float64)
+    else:
+        recipe_index = product_types = categories = np.empty(0, dtype=np.int64)
+        factors = prices = quantities = np.empty(0, dtype=np.float64)
+
+    for shock in shocks:
+        if shock.get("category") is not None:
+            mask = categories == shock["category"]
+        else:
+            mask = product_types == shock["product_type"]
+
+        if shock.get("price") is not None:
+            prices[mask] = shock["price"]
+        else:
+            prices[mask] *= 1 + shock["percent"] / 100
+
+    item_costs = prices * quantities * factors
+    costs = np.bincount(recipe_index, weights=item_costs, minlength=len(recipe_rows))
+
+    if sub_recipe_items:
+        costs = _add_sub_recipe_costs(costs, recipe_rows, sub_recipe_items)
+
+    selling_prices = np.array([row[3] or 0 for row in recipe_rows], dtype=np.float64)
+    has_price = selling_prices != 0
+    profits = np.where(has_price, selling_prices - costs, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        profit_percentages = np.where(
+            has_price & (costs != 0), (selling_prices - costs) / costs * 100, 0
+        )
+
+    return [
+        {
+            "id": recipe_id,
+            "name": name,
+            "current_cost": current_cost,
+            "total_cost": float(costs[index]),
+            "selling_price": selling_price,
+            "profit": float(profits[index]),
+            "profit_percentage": float(profit_percentages[index]),
+        }
+        for index, (recipe_id, name, current_cost, selling_price, _) in enumerate(
+            recipe_rows
+        )
+    ]
+
+
+def _add_sub_recipe_costs(costs, recipe_rows, sub_recipe_items):
+    """
+    Add the cost of sub-recipe ingredients, one vectorized step per level of
+    the sub-recipe graph so every sub-recipe is costed before its users.
+    """
+    positions = {row[0]: index for index, row in enumerate(recipe_rows)}
+    yields = np.array([row[4] for row in recipe_rows], dtype=np.float64)
+
+    # Sub-recipes outside the simulated set keep their stored unit cost
+    outside = {
+        pk: unit_cost(total_cost, yield_quantity)
+        for pk, total_cost, yield_quantity in Recipe.objects.filter(
+            pk__in={item[6] for item in sub_recipe_items} - set(positions)
+        ).values_list("pk", "total_cost", "yield_quantity")
+    }
+
+    # Level of each recipe: one above its deepest simulated sub-recipe
+    edges = {(item[0], item[6]) for item in sub_recipe_items}
+    children = {}
+    for recipe_id, sub_recipe_id in edges:
+        children.setdefault(recipe_id, []).append(sub_recipe_id)
+    levels = {}
+    for recipe_id in topological_order(set(positions), edges):
+        levels[recipe_id] = 1 + max(
+            (levels.get(child, 0) for child in children.get(recipe_id, [])),
+            default=-1,
+        )
+
+    parents = np.array([positions[item[0]] for item in sub_recipe_items])
+    item_levels = np.array([levels.get(item[0], -1) for item in sub_recipe_items])
+    quantities = np.array([item[5] for item in sub_recipe_items], dtype=np.float64)
+    inside = np.array([item[6] in positions for item in sub_recipe_items])
+    children_index = np.array([positions.get(item[6], 0) for item in sub_recipe_items])
+    outside_costs = np.array(
+        [outside.get(item[6], 0.0) for item in sub_recipe_items], dtype=np.float64
+    )
+
+    costs = costs.copy()
+    for level in range(1, max(levels.values(), default=0) + 1):
+        mask = item_levels == level
+        unit_costs = np.where(
+            yields > 0, costs / np.where(yields > 0, yields, 1), costs
+        )
+        sub_costs = np.where(inside, unit_costs[children_index], outside_costs)
+        np.add.at(costs, parents[mask], quantities[mask] * sub_costs[mask])
+    return costs
@@ -0,0 +1,131 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .costing import propagate_to_parents, reevaluate_recipes
+from .models import CollectionVersion, Recipe, RecipeItem, RecostTask
+
+logger = logging.getLogger(__name__)
+
+# In-process worker threads, started on the first queued recost
+_workers: List[Thread] = []
+_workers_lock = Lock()
+
+
+def schedule_recost(recipe_ids: Iterable[int]) -> None:
+    """
+    Queue recipes for re-costing after the debounce window.
+
+    Requests for a recipe that is already queued coalesce into the existing
+    task and keep its due time, so a recipe whose prices keep changing is
+    still re-costed at most one window after the first request. With
+    ``RECOST_ASYNC`` disabled the recipes are re-costed immediately.
+    """
+    recipe_ids = set(recipe_ids)
+    if not recipe_ids:
+        return
+    if not settings.RECOST_ASYNC:
+        reevaluate_recipes(recipe_ids)
+        return
+
+    due_at = timezone.now() + timedelta(seconds=settings.RECOST_DEBOUNCE_SECONDS)
+    RecostTask.objects.bulk_create(
+        [RecostTask(recipe_id=pk, due_at=due_at) for pk in recipe_ids],
+        ignore_conflicts=True,
+    )
+    _bump_owners(recipe_ids)
+    start_workers()
+
+
+def schedule_parent_recost(recipe_ids: Iterable[int]) -> None:
+    """
+    Update the recipes using the given recipes as sub-recipes.
+
+    The recipes themselves are expected to be up to date already. With
+    ``RECOST_ASYNC`` enabled their direct parents are queued; the worker
+    propagates further up when it re-costs them.
+    """
+    recipe_ids = set(recipe_ids)
+    if not settings.RECOST_ASYNC:
+        propagate_to_parents(recipe_ids)
+        return
+
+    schedule_recost(
+        RecipeItem.objects.filter(sub_recipe_id__in=recipe_ids).values_list(
+            "recipe_id", flat=True
+        )
+    )
+
+
+def run_due_tasks(now: Optional[datetime] = None, limit: int = 100) -> int:
+    """
+    Claim the recost tasks that are due and re-cost their recipes.
+
+    Tasks are claimed with ``SKIP LOCKED`` so several workers, in this or in
+    other processes, never run the same task. Claimed tasks are re-queued if
+    re-costing fails.
+
+    Returns:
+        The number of recipes re-costed
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        recipe_ids = list(
+            RecostTask.objects.select_for_update(skip_locked=True)
+            .filter(due_at__lte=now)
+            .order_by("due_at")
+            .values_list("recipe_id", flat=True)[:limit]
+        )
+        RecostTask.objects.filter(recipe_id__in=recipe_ids).delete()
+    if not recipe_ids:
+        return 0
+
+    try:
+        reevaluate_recipes(recipe_ids)
+    except Exception:
+        RecostTask.objects.bulk_create(
+            [RecostTask(recipe_id=pk, due_at=now) for pk in recipe_ids],
+            ignore_conflicts=True,
+        )
+        raise
+    # Recipes whose cost did not change are no longer pending either
+    _bump_owners(recipe_ids)
+    return len(recipe_ids)
+
+
+def _bump_owners(recipe_ids: Iterable[int]) -> None:
+    """Bump the collection versions of the owners of recipes."""
+    CollectionVersion.objects.bump(
+        Recipe.objects.filter(pk__in=recipe_ids).values_list("user_id", flat=True)
+    )
+
+
+def _work() -> None:
+    """Worker loop: run due tasks, sleep while the queue is idle."""
+    while True:
+        processed = 0
+        try:
+            processed = run_due_tasks()
+        except Exception:
+            logger.exception("Background recost failed")
+        finally:
+            close_old_connections()
+        if not processed:
+            time.sleep(settings.RECOST_POLL_SECONDS)
+
+
+def start_workers() -> None:
+    """Start the in-process recost workers once per process."""
+    with _workers_lock:
+        if _workers:
+            return
+        for index in range(settings.RECOST_WORKERS):
+            worker = Thread(target=_work, name=f"recost-worker-{index}", daemon=True)
+            worker.start()
+            _workers.append(worker)
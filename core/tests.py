@@ -1,9 +1,50 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
 from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest.mock import patch
 
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from openpyxl import Workbook
+from rest_framework.test import APIClient
 
-from .models import Category, ProductInstance, ProductType, Recipe
+from db_fa import schema
+
+from .admin import EstimatedCountPaginator
+from .cache import VERSION_KEY, _local, get_reference, invalidate_reference_data
+from .checks import check_shared_cache
+from .costing import propagate_price_changes, recipe_cost_as_of
+from .forms import ProductForm, RecipeItemForm
+from .importer import import_file, import_product_types
+from .models import (
+    Category,
+    CollectionVersion,
+    ImportJob,
+    LatestPrice,
+    PriceHistory,
+    ProductInstance,
+    ProductType,
+    Recipe,
+    RecipeItem,
+    RecostTask,
+    SearchTerm,
+)
+from .pricing import refresh_latest_prices
+from .purchases import import_purchases
+from .search import normalize
+from .tasks import run_due_tasks, schedule_recost
+from .units import conversion_factor, cost_factor
+from .views import ProductTypeListView
 
 
 class CategoryModelTest(TestCase):
@@ -117,6 +158,57 @@ class ProductInstanceModelTest(TestCase):
         self.assertIn(str(self.product_instance.total_weight), str_repr)
 
 
+class ProductInstanceBulkRecomputeTest(TestCase):
+    """Test cases for bulk re-derivation of product instance fields."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.product_type = ProductType.objects.create(
+            name="Test Product", base_weight=100, waste=10, unit="gram"
+        )
+        self.product_instance = ProductInstance.objects.create(
+            product_type=self.product_type, total_weight=1000, price_per_kilo=10000
+        )
+
+    def assertDerivedFields(self, waste_weight):
+        """Assert the derived fields of the instance for a waste weight."""
+        self.product_instance.refresh_from_db()
+        self.assertAlmostEqual(self.product_instance.waste_weight, waste_weight)
+        self.assertAlmostEqual(
+            self.product_instance.net_weight, 1000 - waste_weight, places=2
+        )
+        self.assertAlmostEqual(
+            self.product_instance.total_price, 10000 + 10 * waste_weight, places=2
+        )
+
+    def test_waste_change_recomputes_instances(self):
+        """Test that editing product type waste updates existing instances."""
+        product_type = ProductType.objects.get(pk=self.product_type.pk)
+        product_type.waste = 25
+        product_type.save()
+        self.assertDerivedFields(250)
+
+    def test_recompute_matches_save_calculation(self):
+        """Test that the bulk UPDATE gives the same values as save()."""
+        ProductInstance.objects.filter(pk=self.product_instance.pk).update(
+            waste_weight=None, net_weight=None, total_price=None
+        )
+        count = ProductInstance.objects.all().recompute_derived_fields()
+        self.assertEqual(count, 1)
+        self.assertDerivedFields(100)
+
+    def test_recompute_command(self):
+        """Test the recompute management command."""
+        ProductType.objects.filter(pk=self.product_type.pk).update(base_weight=0)
+        call_command(
+            "recompute_product_instances",
+            "--product-type",
+            str(self.product_type.pk),
+            stdout=StringIO(),
+        )
+        self.assertDerivedFields(0)
+
+
 class RecipeModelTest(TestCase):
     """Test cases for Recipe model."""
 
@@ -176,6 +268,2181 @@ class RecipeModelTest(TestCase):
         self.assertEqual(percentage, 0)
 
 
+class RecipeCostMaintenanceTest(TestCase):
+    """Test cases for incremental recipe cost maintenance."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.product_type = ProductType.objects.create(
+            name="Test Product", base_weight=100, waste=10, unit="gram"
+        )
+        self.product = ProductInstance.objects.create(
+            product_type=self.product_type,
+            price_per_kilo=10000,
+            unit="gram",
+            user=self.user,
+        )
+        self.recipe = Recipe.objects.create(name="Test Recipe", user=self.user)
+
+    def test_adding_item_increments_total_cost(self):
+        """Test that saving a new item adds its cost to the recipe."""
+        item = RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=200
+        )
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(item.cost, 2000)
+        self.assertAlmostEqual(self.recipe.total_cost, 2000)
+
+    def test_updating_item_applies_delta(self):
+        """Test that updating an item applies only the cost difference."""
+        item = RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=200
+        )
+        item.quantity = 300
+        item.save()
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 3000)
+
+    def test_update_fields_store_the_cost(self):
+        """Test that a save with update_fields stores the new cost too."""
+        item = RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=200
+        )
+        item.quantity = 400
+        item.save(update_fields=["quantity"])
+        item.refresh_from_db()
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(item.cost, 4000)
+        self.assertAlmostEqual(self.recipe.total_cost, 4000)
+        self.assertAlmostEqual(self.recipe.calculate_total_cost(), 4000)
+
+    def test_deleting_item_subtracts_cost(self):
+        """Test that deleting an item subtracts its cost from the recipe."""
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=200
+        )
+        item = RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=100
+        )
+        item.delete()
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 2000)
+
+    def test_full_recalculation_matches_incremental_cost(self):
+        """Test that a full recalculation agrees with the maintained total."""
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=250
+        )
+        self.recipe.refresh_from_db()
+        incremental = self.recipe.total_cost
+        self.assertAlmostEqual(self.recipe.calculate_total_cost(), incremental)
+
+    def test_reconcile_command_reports_and_fixes_drift(self):
+        """Test that the reconcile command detects and fixes drifted totals."""
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=200
+        )
+        Recipe.objects.filter(pk=self.recipe.pk).update(total_cost=1)
+
+        out = StringIO()
+        call_command("reconcile_recipe_costs", stdout=out)
+        self.assertIn("1 recipes have drifted costs", out.getvalue())
+
+        call_command("reconcile_recipe_costs", "--fix", stdout=StringIO())
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 2000)
+
+    def test_backfill_command(self):
+        """Test that legacy items without stored costs are backfilled."""
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=200
+        )
+        # As stored before the cost and cost_factor columns were added
+        RecipeItem.objects.update(cost=0, cost_factor=1)
+        Recipe.objects.update(total_cost=0)
+
+        call_command("backfill_recipe_costs", stdout=StringIO())
+        item = RecipeItem.objects.get()
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(item.cost_factor, 0.001)
+        self.assertAlmostEqual(item.cost, 2000)
+        self.assertAlmostEqual(self.recipe.total_cost, 2000)
+
+
+class PriceChangePropagationTest(TestCase):
+    """Test cases for propagating product price changes to recipes."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        product_type = ProductType.objects.create(
+            name="Test Product", base_weight=100, waste=10, unit="gram"
+        )
+        self.meat = ProductInstance.objects.create(
+            product_type=product_type, price_per_kilo=10000, user=self.user
+        )
+        self.bread = ProductInstance.objects.create(
+            product_type=product_type, price_per_kilo=2000, user=self.user
+        )
+        self.burger = Recipe.objects.create(name="Burger", user=self.user)
+        self.kebab = Recipe.objects.create(name="Kebab", user=self.user)
+        RecipeItem.objects.create(
+            recipe=self.burger, product_instance=self.meat, quantity=100
+        )
+        RecipeItem.objects.create(
+            recipe=self.burger, product_instance=self.bread, quantity=100
+        )
+        RecipeItem.objects.create(
+            recipe=self.kebab, product_instance=self.meat, quantity=300
+        )
+
+    def test_price_change_updates_all_affected_recipes(self):
+        """Test that changing a price recalculates every recipe using it."""
+        product = ProductInstance.objects.get(pk=self.meat.pk)
+        product.price_per_kilo = 20000
+        product.save()
+
+        self.burger.refresh_from_db()
+        self.kebab.refresh_from_db()
+        self.assertAlmostEqual(self.burger.total_cost, 2000 + 200)
+        self.assertAlmostEqual(self.kebab.total_cost, 6000)
+
+    def test_unchanged_price_does_not_propagate(self):
+        """Test that saving without a price change leaves recipes alone."""
+        Recipe.objects.filter(pk=self.kebab.pk).update(total_cost=1)
+        product = ProductInstance.objects.get(pk=self.meat.pk)
+        product.total_weight = 500
+        product.save()
+
+        self.kebab.refresh_from_db()
+        self.assertEqual(self.kebab.total_cost, 1)
+
+    def test_bulk_price_changes_propagate_once(self):
+        """Test that a bulk update propagates its price changes once."""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with patch(
+            "core.bulk.propagate_price_changes", wraps=propagate_price_changes
+        ) as propagate:
+            client.patch(
+                "/api/v1/products/bulk/",
+                [
+                    {"id": self.meat.pk, "price_per_kilo": 30000},
+                    {"id": self.bread.pk, "price_per_kilo": 4000},
+                ],
+                format="json",
+            )
+        propagate.assert_called_once()
+
+        self.burger.refresh_from_db()
+        self.assertAlmostEqual(self.burger.total_cost, 3000 + 400)
+
+
+class SubRecipeCostTest(TestCase):
+    """Test cases for recipes used as ingredients of other recipes."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        product_type = ProductType.objects.create(
+            name="Tomato", base_weight=100, waste=0
+        )
+        self.tomato = ProductInstance.objects.create(
+            product_type=product_type, price_per_kilo=10000, user=self.user
+        )
+        # Sauce yields 4 portions and costs 10000 in total
+        self.sauce = Recipe.objects.create(
+            name="Sauce", user=self.user, yield_quantity=4
+        )
+        self.sauce_item = RecipeItem.objects.create(
+            recipe=self.sauce, product_instance=self.tomato, quantity=1000
+        )
+        self.pasta = Recipe.objects.create(name="Pasta", user=self.user)
+        RecipeItem.objects.create(recipe=self.pasta, sub_recipe=self.sauce, quantity=2)
+        self.menu = Recipe.objects.create(name="Menu", user=self.user)
+        RecipeItem.objects.create(recipe=self.menu, sub_recipe=self.pasta, quantity=1)
+        RecipeItem.objects.create(recipe=self.menu, sub_recipe=self.sauce, quantity=1)
+
+    def assertTotalCosts(self, sauce, pasta, menu):
+        """Assert the stored total costs of the test recipes."""
+        for recipe, expected in ((self.sauce, sauce), (self.pasta, pasta)):
+            recipe.refresh_from_db()
+            self.assertAlmostEqual(recipe.total_cost, expected)
+        self.menu.refresh_from_db()
+        self.assertAlmostEqual(self.menu.total_cost, menu)
+
+    def test_sub_recipe_is_costed_per_unit(self):
+        """Test that sub-recipe ingredients use the sub-recipe unit cost."""
+        self.assertTotalCosts(10000, 5000, 7500)
+
+    def test_sub_recipe_change_propagates_upward(self):
+        """Test that editing a sub-recipe updates every recipe using it."""
+        self.sauce_item.quantity = 2000
+        self.sauce_item.save()
+        self.assertTotalCosts(20000, 10000, 15000)
+
+        self.sauce_item.delete()
+        self.assertTotalCosts(0, 0, 0)
+
+    def test_price_change_propagates_through_sub_recipes(self):
+        """Test that a product price change reaches recipes via sub-recipes."""
+        tomato = ProductInstance.objects.get(pk=self.tomato.pk)
+        tomato.price_per_kilo = 20000
+        tomato.save()
+        self.assertTotalCosts(20000, 10000, 15000)
+
+    def test_yield_change_propagates_upward(self):
+        """Test that changing the yield of a sub-recipe updates its users."""
+        sauce = Recipe.objects.get(pk=self.sauce.pk)
+        sauce.yield_quantity = 2
+        sauce.save()
+        self.assertTotalCosts(10000, 10000, 15000)
+
+    def test_full_recalculation_walks_sub_recipes(self):
+        """Test that recalculating a recipe recalculates its sub-recipes."""
+        Recipe.objects.update(total_cost=0)
+        RecipeItem.objects.update(cost=0)
+        self.assertAlmostEqual(self.menu.calculate_total_cost(), 7500)
+        self.assertTotalCosts(10000, 5000, 7500)
+
+    def test_circular_sub_recipe_is_rejected(self):
+        """Test that a recipe cannot use a recipe that depends on it."""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(
+            "/api/v1/recipe-items/",
+            {"recipe": self.sauce.pk, "sub_recipe": self.menu.pk, "quantity": 1},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("sub_recipe", response.json())
+
+    def test_item_cannot_move_to_other_users_recipe(self):
+        """Test that an update cannot move an item into another user's recipe."""
+        other = User.objects.create_user(username="other", password="testpass123")
+        other_recipe = Recipe.objects.create(name="Other", user=other)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.patch(
+            f"/api/v1/recipe-items/{self.sauce_item.pk}/",
+            {"recipe": other_recipe.pk},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("recipe", response.json())
+        self.sauce_item.refresh_from_db()
+        self.assertEqual(self.sauce_item.recipe, self.sauce)
+        other_recipe.refresh_from_db()
+        self.assertEqual(other_recipe.total_cost, 0)
+
+    def test_simulation_includes_sub_recipes(self):
+        """Test that the simulation costs sub-recipes like the stored costs."""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(
+            "/api/v1/recipes/simulate/", {"shocks": []}, format="json"
+        )
+        costs = {
+            result["name"]: result["total_cost"]
+            for result in response.json()["results"]
+        }
+        self.assertAlmostEqual(costs["Sauce"], 10000)
+        self.assertAlmostEqual(costs["Pasta"], 5000)
+        self.assertAlmostEqual(costs["Menu"], 7500)
+
+
+class RecostQueueTest(TestCase):
+    """Test cases for the debounced background recost queue."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        product_type = ProductType.objects.create(
+            name="Tomato", base_weight=100, waste=0
+        )
+        self.tomato = ProductInstance.objects.create(
+            product_type=product_type, price_per_kilo=10000, user=self.user
+        )
+        self.sauce = Recipe.objects.create(name="Sauce", user=self.user)
+        self.pasta = Recipe.objects.create(name="Pasta", user=self.user)
+        RecipeItem.objects.create(recipe=self.pasta, sub_recipe=self.sauce, quantity=1)
+
+    @override_settings(RECOST_ASYNC=True, RECOST_WORKERS=0)
+    def test_parent_recosts_are_coalesced(self):
+        """Test that repeated sub-recipe edits queue one recost per parent."""
+        for _ in range(3):
+            RecipeItem.objects.create(
+                recipe=self.sauce, product_instance=self.tomato, quantity=100
+            )
+
+        # The edited recipe is updated at once, its parent is queued
+        self.sauce.refresh_from_db()
+        self.pasta.refresh_from_db()
+        self.assertAlmostEqual(self.sauce.total_cost, 3000)
+        self.assertEqual(self.sauce.cost_version, 3)
+        self.assertAlmostEqual(self.pasta.total_cost, 0)
+        self.assertEqual(RecostTask.objects.filter(recipe=self.pasta).count(), 1)
+
+        # Not due before the debounce window has passed
+        self.assertEqual(run_due_tasks(), 0)
+        later = timezone.now() + timedelta(minutes=1)
+        self.assertEqual(run_due_tasks(now=later), 1)
+
+        self.pasta.refresh_from_db()
+        self.assertAlmostEqual(self.pasta.total_cost, 3000)
+        self.assertFalse(RecostTask.objects.exists())
+
+    @override_settings(RECOST_ASYNC=True, RECOST_WORKERS=0)
+    def test_requeued_recipes_keep_their_due_time(self):
+        """Test that changes to a queued recipe do not postpone its recost."""
+        schedule_recost([self.pasta.pk])
+        due_at = RecostTask.objects.get().due_at
+
+        with patch(
+            "core.tasks.timezone.now", return_value=due_at + timedelta(seconds=1)
+        ):
+            schedule_recost([self.pasta.pk, self.sauce.pk])
+        self.assertEqual(RecostTask.objects.get(recipe=self.pasta).due_at, due_at)
+        self.assertGreater(RecostTask.objects.get(recipe=self.sauce).due_at, due_at)
+        self.assertEqual(run_due_tasks(now=due_at), 1)
+
+    @override_settings(RECOST_ASYNC=True, RECOST_WORKERS=0)
+    def test_api_reports_pending_cost(self):
+        """Test that item writes report the recipe cost status for polling."""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        RecipeItem.objects.create(
+            recipe=self.sauce, product_instance=self.tomato, quantity=100
+        )
+
+        response = client.get(f"/api/v1/recipes/{self.pasta.pk}/cost_status/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data["cost_pending"])
+        version = response.data["cost_version"]
+
+        response = client.post(
+            "/api/v1/recipe-items/",
+            {
+                "recipe": self.pasta.pk,
+                "product_instance_id": self.tomato.pk,
+                "quantity": 100,
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.data["cost_pending"])
+        self.assertEqual(response.data["cost_version"], version + 1)
+
+        call_command("process_recost_queue", stdout=StringIO())
+        response = client.get(f"/api/v1/recipes/{self.pasta.pk}/")
+        self.assertTrue(response.data["cost_pending"])
+
+        run_due_tasks(now=timezone.now() + timedelta(minutes=1))
+        response = client.get(f"/api/v1/recipes/{self.pasta.pk}/")
+        self.assertFalse(response.data["cost_pending"])
+        self.assertAlmostEqual(response.data["total_cost"], 2000)
+
+
+class PriceHistoryTest(TestCase):
+    """Test cases for the price history and as-of recipe costing."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.product_type = ProductType.objects.create(
+            name="Test Product", base_weight=100, waste=0
+        )
+        self.product = ProductInstance.objects.create(
+            product_type=self.product_type, price_per_kilo=10000, user=self.user
+        )
+        self.recipe = Recipe.objects.create(name="Test Recipe", user=self.user)
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=100
+        )
+        self.today = timezone.localdate()
+        PriceHistory.objects.all().delete()
+        for days_ago, price in ((30, 5000), (10, 8000), (2, 10000)):
+            PriceHistory.objects.create(
+                product_type=self.product_type,
+                user=self.user,
+                price_per_kilo=price,
+                effective_at=timezone.now() - timedelta(days=days_ago),
+            )
+
+    def test_price_changes_are_recorded(self):
+        """Test that creating and repricing products appends history."""
+        PriceHistory.objects.all().delete()
+        product = ProductInstance.objects.create(
+            product_type=self.product_type, price_per_kilo=1000, user=self.user
+        )
+        product.price_per_kilo = 2000
+        product.save()
+        product.total_weight = 500
+        product.save()
+        prices = PriceHistory.objects.order_by("pk").values_list(
+            "price_per_kilo", flat=True
+        )
+        self.assertEqual(list(prices), [1000, 2000])
+
+    def test_history_is_append_only(self):
+        """Test that existing history entries cannot be changed."""
+        entry = PriceHistory.objects.first()
+        entry.price_per_kilo = 1
+        with self.assertRaises(ValueError):
+            entry.save()
+
+    def test_cost_as_of_date(self):
+        """Test costing a recipe with the prices of a past date."""
+        self.assertAlmostEqual(
+            recipe_cost_as_of(self.recipe, self.today - timedelta(days=20)), 500
+        )
+        self.assertAlmostEqual(
+            recipe_cost_as_of(self.recipe, self.today - timedelta(days=5)), 800
+        )
+        # Before any recorded price the current price is used
+        self.assertAlmostEqual(
+            recipe_cost_as_of(self.recipe, self.today - timedelta(days=60)), 1000
+        )
+
+    def test_cost_trend_endpoint(self):
+        """Test the daily cost trend endpoint."""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(f"/api/v1/recipes/{self.recipe.pk}/cost_trend/?days=15")
+        self.assertEqual(response.status_code, 200)
+        trend = response.json()["trend"]
+        self.assertEqual(len(trend), 15)
+        self.assertAlmostEqual(trend[0]["total_cost"], 500)
+        self.assertAlmostEqual(trend[-6]["total_cost"], 800)
+        self.assertAlmostEqual(trend[-1]["total_cost"], 1000)
+
+
+class MarketPricingTest(TestCase):
+    """Test cases for costing recipes at the latest market prices."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.product_type = ProductType.objects.create(
+            name="Test Product", base_weight=100, waste=0
+        )
+        self.old_purchase = ProductInstance.objects.create(
+            product_type=self.product_type, price_per_kilo=10000, user=self.user
+        )
+        self.recipe = Recipe.objects.create(
+            name="Test Recipe", user=self.user, selling_price=3000
+        )
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.old_purchase, quantity=100
+        )
+        self.new_purchase = ProductInstance.objects.create(
+            product_type=self.product_type, price_per_kilo=20000, user=self.user
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_latest_price_is_maintained(self):
+        """Test that the lookup follows new purchases and deletions."""
+        latest = LatestPrice.objects.get(user=self.user)
+        self.assertEqual(latest.product_instance, self.new_purchase)
+
+        self.new_purchase.price_per_kilo = 25000
+        self.new_purchase.save()
+        self.assertEqual(LatestPrice.objects.get(user=self.user).price_per_kilo, 25000)
+
+        self.new_purchase.delete()
+        latest = LatestPrice.objects.get(user=self.user)
+        self.assertEqual(latest.product_instance_id, self.old_purchase.pk)
+
+    def test_recipe_market_pricing_mode(self):
+        """Test that market mode uses the latest purchase of each type."""
+        url = f"/api/v1/recipes/{self.recipe.pk}/"
+        self.assertAlmostEqual(self.client.get(url).json()["total_cost"], 1000)
+
+        data = self.client.get(url, {"pricing": "market"}).json()
+        self.assertAlmostEqual(data["total_cost"], 2000)
+        self.assertAlmostEqual(data["profit"], 1000)
+
+        response = self.client.post(
+            f"{url}recalculate_cost/?pricing=market", format="json"
+        )
+        self.assertAlmostEqual(response.json()["total_cost"], 2000)
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 1000)
+
+    def test_invalid_pricing_mode(self):
+        """Test that an unknown pricing mode is rejected."""
+        response = self.client.get("/api/v1/recipes/", {"pricing": "cheapest"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_refresh_latest_prices_command(self):
+        """Test rebuilding the lookup from the purchase history."""
+        LatestPrice.objects.all().delete()
+        call_command("refresh_latest_prices", stdout=StringIO())
+        latest = LatestPrice.objects.get(user=self.user)
+        self.assertEqual(latest.product_instance, self.new_purchase)
+
+    def test_failed_rebuild_keeps_the_lookup(self):
+        """Test that a rebuild failing halfway leaves the lookup as it was."""
+        with patch.object(
+            LatestPrice.objects, "bulk_create", side_effect=RuntimeError
+        ), self.assertRaises(RuntimeError):
+            refresh_latest_prices()
+        latest = LatestPrice.objects.get(user=self.user)
+        self.assertEqual(latest.product_instance, self.new_purchase)
+
+
+class PriceSimulationTest(TestCase):
+    """Test cases for the what-if pricing simulation endpoint."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.protein = Category.objects.create(name="Protein")
+        self.meat_type = ProductType.objects.create(
+            name="Meat", base_weight=100, waste=10, category=self.protein
+        )
+        self.drink_type = ProductType.objects.create(
+            name="Drink", base_weight=1, waste=0, unit="piece"
+        )
+        meat = ProductInstance.objects.create(
+            product_type=self.meat_type, price_per_kilo=10000, user=self.user
+        )
+        drink = ProductInstance.objects.create(
+            product_type=self.drink_type,
+            price_per_kilo=5000,
+            unit="piece",
+            user=self.user,
+        )
+        self.recipe = Recipe.objects.create(
+            name="Menu", user=self.user, selling_price=20000
+        )
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=meat, quantity=200
+        )
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=drink, quantity=2
+        )
+        Recipe.objects.create(name="Empty", user=self.user)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def simulate(self, shocks):
+        """Run a simulation and return the results by recipe name."""
+        response = self.client.post(
+            "/api/v1/recipes/simulate/", {"shocks": shocks}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        return {result["name"]: result for result in response.json()["results"]}
+
+    def test_simulation_without_shocks_matches_stored_cost(self):
+        """Test that an empty scenario reproduces the stored costs."""
+        results = self.simulate([])
+        self.assertAlmostEqual(
+            results["Menu"]["total_cost"], self.recipe.calculate_total_cost()
+        )
+        self.assertEqual(results["Empty"]["total_cost"], 0)
+        self.assertEqual(results["Empty"]["profit"], 0)
+
+    def test_simulation_applies_shocks_without_writing(self):
+        """Test category percentage and product type price shocks."""
+        results = self.simulate(
+            [
+                {"category": self.protein.pk, "percent": 15},
+                {"product_type": self.drink_type.pk, "price": 6000},
+            ]
+        )
+        menu = results["Menu"]
+        self.assertAlmostEqual(menu["total_cost"], 2300 + 12000)
+        self.assertAlmostEqual(menu["profit"], 20000 - 14300)
+        self.assertAlmostEqual(menu["profit_percentage"], (20000 - 14300) / 14300 * 100)
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 12000)
+
+    def test_invalid_shock_is_rejected(self):
+        """Test that a shock must have exactly one target and one change."""
+        response = self.client.post(
+            "/api/v1/recipes/simulate/",
+            {"shocks": [{"category": self.protein.pk}]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class UnitConversionTest(TestCase):
+    """Test cases for unit conversion factors and unit-aware costing."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.oil_type = ProductType.objects.create(
+            name="Oil",
+            base_weight=100,
+            waste=0,
+            unit=ProductType.UNIT_LITER,
+            density=0.9,
+        )
+        self.oil = ProductInstance.objects.create(
+            product_type=self.oil_type,
+            price_per_kilo=50000,
+            unit=ProductInstance.UNIT_LITER,
+            user=self.user,
+        )
+        egg_type = ProductType.objects.create(
+            name="Egg", base_weight=100, waste=0, package_size=30
+        )
+        self.eggs = ProductInstance.objects.create(
+            product_type=egg_type,
+            price_per_kilo=3000,
+            unit=ProductInstance.UNIT_PIECE,
+            user=self.user,
+        )
+        self.recipe = Recipe.objects.create(name="Cake", user=self.user)
+
+    def test_conversion_factors(self):
+        """Test the precomputed and product specific conversion factors."""
+        self.assertAlmostEqual(conversion_factor("kilogram", "gram"), 1000)
+        self.assertAlmostEqual(conversion_factor("milliliter", "liter"), 0.001)
+        self.assertAlmostEqual(conversion_factor("dozen", "piece"), 12)
+        self.assertAlmostEqual(
+            conversion_factor("package", "dozen", package_size=30), 2.5
+        )
+        self.assertAlmostEqual(conversion_factor("gram", "liter", density=0.9), 1 / 900)
+        self.assertIsNone(conversion_factor("gram", "liter"))
+        self.assertIsNone(conversion_factor("meter", "gram", density=1))
+        # Gram prices are per kilo
+        self.assertAlmostEqual(cost_factor("kilogram", "gram"), 1)
+
+    def test_product_total_price_uses_unit(self):
+        """Test that only per-kilo prices are divided by 1000."""
+        self.assertAlmostEqual(self.oil.total_price, 50000 * 1000)
+        product = ProductInstance.objects.create(
+            product_type=self.oil_type, price_per_kilo=8000, user=self.user
+        )
+        self.assertAlmostEqual(product.total_price, 8000)
+
+    def test_items_in_other_units(self):
+        """Test that item quantities are converted to the product unit."""
+        items = [
+            RecipeItem.objects.create(
+                recipe=self.recipe,
+                product_instance=self.oil,
+                quantity=200,
+                unit="milliliter",
+            ),
+            RecipeItem.objects.create(
+                recipe=self.recipe, product_instance=self.oil, quantity=90, unit="gram"
+            ),
+            RecipeItem.objects.create(
+                recipe=self.recipe, product_instance=self.eggs, quantity=1, unit="dozen"
+            ),
+            RecipeItem.objects.create(
+                recipe=self.recipe,
+                product_instance=self.eggs,
+                quantity=1,
+                unit="package",
+            ),
+        ]
+        self.assertEqual(
+            [round(item.cost) for item in items], [10000, 5000, 36000, 90000]
+        )
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 141000)
+        self.assertAlmostEqual(self.recipe.calculate_total_cost(), 141000)
+
+        invalid = RecipeItem(
+            recipe=self.recipe, product_instance=self.eggs, quantity=1, unit="gram"
+        )
+        with self.assertRaises(ValidationError):
+            invalid.clean()
+
+    def test_density_change_updates_costs(self):
+        """Test that changing a product density re-costs the recipes."""
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.oil, quantity=90, unit="gram"
+        )
+        oil_type = ProductType.objects.get(pk=self.oil_type.pk)
+        oil_type.density = 0.45
+        oil_type.save()
+
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 10000)
+
+    def test_product_unit_change_refreshes_factors(self):
+        """Test that changing a product unit re-derives its item factors."""
+        item = RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.oil, quantity=500
+        )
+        oil = ProductInstance.objects.get(pk=self.oil.pk)
+        oil.unit = ProductInstance.UNIT_MILLILITER
+        oil.save()
+
+        item.refresh_from_db()
+        self.assertAlmostEqual(item.cost_factor, 0.001)
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 25000)
+
+
+class QueryBudgetTest(TestCase):
+    """Test that API endpoints run a fixed number of queries per request."""
+
+    # Maximum number of queries per endpoint, whatever the page contents
+    # User-scoped collections include the collection version lookup
+    BUDGETS = {
+        "/api/v1/categories/": 2,
+        "/api/v1/product-types/": 2,
+        "/api/v1/products/": 3,
+        "/api/v1/products/{product}/": 2,
+        "/api/v1/recipes/": 4,
+        "/api/v1/recipes/?pricing=market": 8,
+        "/api/v1/recipes/?fields=id,name,total_cost": 3,
+        "/api/v1/recipes/?expand=": 4,
+        "/api/v1/recipes/{recipe}/": 3,
+        "/api/v1/recipe-items/": 3,
+        "/api/v1/recipe-items/{item}/": 2,
+    }
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name="Vegetables")
+        self.sauce = Recipe.objects.create(name="Sauce", user=self.user)
+
+    def populate(self, count):
+        """Create ``count`` products and recipes with a few items each."""
+        for n in range(count):
+            product_type = ProductType.objects.create(
+                name=f"Type {n}", base_weight=100, waste=10, category=self.category
+            )
+            product = ProductInstance.objects.create(
+                product_type=product_type, price_per_kilo=1000, user=self.user
+            )
+            recipe = Recipe.objects.create(name=f"Recipe {n}", user=self.user)
+            item = RecipeItem.objects.create(
+                recipe=recipe, product_instance=product, quantity=100
+            )
+            RecipeItem.objects.create(recipe=recipe, sub_recipe=self.sauce, quantity=1)
+        return {"product": product.pk, "recipe": recipe.pk, "item": item.pk}
+
+    def measure(self, ids):
+        """Return the number of queries run by each endpoint."""
+        counts = []
+        for url, budget in self.BUDGETS.items():
+            url = url.format(**ids)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertLessEqual(len(queries), budget, url)
+            counts.append(len(queries))
+        return counts
+
+    def test_query_counts_do_not_grow_with_page_size(self):
+        """Test that larger pages run the same number of queries."""
+        small = self.measure(self.populate(1))
+        large = self.measure(self.populate(15))
+        self.assertEqual(small, large)
+
+
+class SparseFieldsTest(TestCase):
+    """Test cases for ?fields= and ?expand= on API responses."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name="Vegetables")
+        self.product_type = ProductType.objects.create(
+            name="Tomato", base_weight=100, waste=0, category=category
+        )
+        self.product = ProductInstance.objects.create(
+            product_type=self.product_type, price_per_kilo=1000, user=self.user
+        )
+        self.recipe = Recipe.objects.create(name="Salad", user=self.user)
+        self.item = RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=100
+        )
+
+    def get_recipe(self, query):
+        """Return the first recipe of the recipe list."""
+        response = self.client.get(f"/api/v1/recipes/?{query}")
+        self.assertEqual(response.status_code, 200)
+        return response.data["results"][0]
+
+    def test_fields_limit_the_response(self):
+        """Test that only the requested fields are returned."""
+        recipe = self.get_recipe("fields=id,name,total_cost")
+        self.assertEqual(set(recipe), {"id", "name", "total_cost"})
+
+    def test_unexpanded_relations_are_ids(self):
+        """Test that relations are plain IDs unless expanded."""
+        recipe = self.get_recipe("expand=")
+        self.assertEqual(recipe["recipe_items"], [self.item.pk])
+
+        recipe = self.get_recipe("expand=recipe_items.product_instance")
+        item = recipe["recipe_items"][0]
+        self.assertEqual(item["product_instance"]["id"], self.product.pk)
+        self.assertEqual(item["product_instance"]["product_type"], self.product_type.pk)
+
+    def test_nested_by_default(self):
+        """Test that relations stay embedded without ?expand=."""
+        recipe = self.get_recipe("")
+        product_type = recipe["recipe_items"][0]["product_instance"]["product_type"]
+        self.assertEqual(product_type["category"]["name"], "Vegetables")
+
+    def test_writes_ignore_the_selection(self):
+        """Test that ?fields= does not drop fields from writes."""
+        response = self.client.post(
+            "/api/v1/recipes/?fields=id",
+            {"name": "Soup", "selling_price": 5000},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["selling_price"], 5000)
+
+
+class KeysetPaginationTest(TestCase):
+    """Test cases for opt-in keyset pagination with ?cursor=."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        product_type = ProductType.objects.create(
+            name="Tomato", base_weight=100, waste=0
+        )
+        ProductInstance.objects.bulk_create(
+            ProductInstance(product_type=product_type, user=self.user)
+            for _ in range(45)
+        )
+        # Half of the rows share a timestamp, so ties are broken by ID
+        moment = timezone.now()
+        ids = list(ProductInstance.objects.order_by("pk").values_list("pk", flat=True))
+        ProductInstance.objects.filter(pk__in=ids[::2]).update(created_at=moment)
+
+    def test_cursor_walks_every_row_once(self):
+        """Test that following the next links returns every row in order."""
+        url = "/api/v1/products/?cursor="
+        seen = []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            # The collection version lookup and the page: no COUNT(*), no OFFSET
+            self.assertEqual(len(queries), 2)
+            self.assertNotIn("OFFSET", queries[1]["sql"].upper())
+            seen.extend(product["id"] for product in response.data["results"])
+            url = response.data["next"]
+
+        expected = list(
+            ProductInstance.objects.order_by("-created_at", "-id").values_list(
+                "pk", flat=True
+            )
+        )
+        self.assertEqual(seen, expected)
+
+    def test_page_numbers_without_cursor(self):
+        """Test that page number clients keep working."""
+        response = self.client.get("/api/v1/products/?page=3")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], 45)
+        self.assertEqual(len(response.data["results"]), 5)
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected."""
+        response = self.client.get("/api/v1/products/?cursor=invalid")
+        self.assertEqual(response.status_code, 404)
+
+    def test_ordering_with_cursor(self):
+        """Test that an ordering, which keyset pages ignore, is rejected."""
+        response = self.client.get("/api/v1/products/?cursor=&ordering=id")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("ordering", response.data)
+
+        response = self.client.get("/api/v1/products/?ordering=id")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], 45)
+
+
+class BulkEndpointTest(TestCase):
+    """Test cases for the bulk product and recipe item endpoints."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product_type = ProductType.objects.create(
+            name="Tomato", base_weight=100, waste=10
+        )
+        self.product = ProductInstance.objects.create(
+            product_type=self.product_type, price_per_kilo=10000, user=self.user
+        )
+        self.recipe = Recipe.objects.create(name="Salad", user=self.user)
+
+    def test_bulk_create_products(self):
+        """Test that products are created with history and latest prices."""
+        rows = [
+            {"product_type_id": self.product_type.pk, "price_per_kilo": price}
+            for price in (11000, 12000, 13000)
+        ]
+        response = self.client.post("/api/v1/products/bulk/", rows, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 3)
+        self.assertAlmostEqual(response.data[0]["total_price"], 11000 * 1.1)
+        self.assertEqual(PriceHistory.objects.count(), 4)
+        latest = LatestPrice.objects.get(user=self.user)
+        self.assertEqual(latest.price_per_kilo, 13000)
+
+    def test_invalid_rows_reject_the_batch(self):
+        """Test that errors are reported per row and nothing is written."""
+        other = User.objects.create_user(username="other", password="testpass123")
+        foreign = Recipe.objects.create(name="Foreign", user=other)
+        rows = [
+            {
+                "recipe": self.recipe.pk,
+                "product_instance_id": self.product.pk,
+                "quantity": 100,
+            },
+            {
+                "recipe": foreign.pk,
+                "product_instance_id": self.product.pk,
+                "quantity": 100,
+            },
+            {"recipe": self.recipe.pk, "quantity": 100},
+        ]
+        response = self.client.post("/api/v1/recipe-items/bulk/", rows, format="json")
+        self.assertEqual(response.status_code, 400)
+        errors = response.data["errors"]
+        self.assertEqual(errors[0], {})
+        self.assertIn("recipe", errors[1])
+        self.assertIn("non_field_errors", errors[2])
+        self.assertFalse(RecipeItem.objects.exists())
+
+    def test_bulk_recipe_items_recost_once(self):
+        """Test that a batch of items is costed with a fixed number of queries."""
+        rows = [
+            {
+                "recipe": self.recipe.pk,
+                "product_instance_id": self.product.pk,
+                "quantity": 10,
+            }
+            for _ in range(50)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                "/api/v1/recipe-items/bulk/", rows, format="json"
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertLess(len(queries), 30)
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 5000)
+
+        ids = [item["id"] for item in response.data]
+        response = self.client.patch(
+            "/api/v1/recipe-items/bulk/",
+            [{"id": pk, "quantity": 20} for pk in ids[:10]],
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 6000)
+
+        response = self.client.delete(
+            "/api/v1/recipe-items/bulk/", {"ids": ids[:10]}, format="json"
+        )
+        self.assertEqual(response.data, {"deleted": 10})
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 4000)
+
+    def test_bulk_update_and_delete_products(self):
+        """Test that product changes reach the recipes using them."""
+        RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=100
+        )
+        response = self.client.patch(
+            "/api/v1/products/bulk/",
+            [{"id": self.product.pk, "price_per_kilo": 20000}],
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 2000)
+        self.assertEqual(PriceHistory.objects.count(), 2)
+
+        response = self.client.delete(
+            "/api/v1/products/bulk/", {"ids": [self.product.pk]}, format="json"
+        )
+        self.assertEqual(response.data, {"deleted": 1})
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(self.recipe.total_cost, 0)
+        self.assertFalse(LatestPrice.objects.exists())
+
+    def test_bulk_product_type_change_refreshes_cost_factors(self):
+        """Test that changing the product type re-derives package costs."""
+        crate = ProductType.objects.create(
+            name="Egg crate", base_weight=100, waste=0, package_size=30
+        )
+        box = ProductType.objects.create(
+            name="Egg box", base_weight=100, waste=0, package_size=10
+        )
+        eggs = ProductInstance.objects.create(
+            product_type=crate,
+            price_per_kilo=3000,
+            unit=ProductInstance.UNIT_PIECE,
+            user=self.user,
+        )
+        item = RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=eggs, quantity=1, unit="package"
+        )
+        self.assertAlmostEqual(item.cost, 90000)
+
+        response = self.client.patch(
+            "/api/v1/products/bulk/",
+            [{"id": eggs.pk, "product_type_id": box.pk}],
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        item.refresh_from_db()
+        self.recipe.refresh_from_db()
+        self.assertAlmostEqual(item.cost, 30000)
+        self.assertAlmostEqual(self.recipe.total_cost, 30000)
+
+
+class ExportTest(TestCase):
+    """Test cases for the streaming CSV and NDJSON exports."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        product_type = ProductType.objects.create(
+            name="Tomato", base_weight=100, waste=0
+        )
+        self.product = ProductInstance.objects.create(
+            product_type=product_type, price_per_kilo=10000, user=self.user
+        )
+        self.sauce = Recipe.objects.create(name="Sauce", user=self.user)
+        RecipeItem.objects.create(
+            recipe=self.sauce, product_instance=self.product, quantity=300
+        )
+        self.pasta = Recipe.objects.create(name="Pasta", user=self.user)
+        RecipeItem.objects.create(
+            recipe=self.pasta, product_instance=self.product, quantity=100
+        )
+        RecipeItem.objects.create(recipe=self.pasta, sub_recipe=self.sauce, quantity=1)
+        Recipe.objects.create(name="Empty", user=self.user)
+
+    def get_content(self, url):
+        """Return the streamed content of an export endpoint."""
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_product_csv(self):
+        """Test the CSV export of products."""
+        lines = self.get_content("/api/v1/products/export/").splitlines()
+        self.assertEqual(lines[0].split(",")[:3], ["id", "product_type", "category"])
+        self.assertEqual(len(lines), 2)
+        self.assertIn("Tomato", lines[1])
+
+    def test_recipe_ndjson_breakdown(self):
+        """Test that recipes are exported with their cost breakdown."""
+        content = self.get_content("/api/v1/recipes/export/?file_format=ndjson")
+        recipes = {row["name"]: row for row in map(json.loads, content.splitlines())}
+        self.assertEqual(set(recipes), {"Sauce", "Pasta", "Empty"})
+
+        pasta = recipes["Pasta"]
+        self.assertAlmostEqual(pasta["total_cost"], 4000)
+        self.assertEqual(
+            [
+                (row["ingredient"], row["unit"], row["cost"])
+                for row in pasta["ingredients"]
+            ],
+            [("Tomato", "gram", 1000), ("Sauce", "", 3000)],
+        )
+        self.assertAlmostEqual(pasta["ingredients"][1]["cost_share"], 75)
+        self.assertEqual(recipes["Empty"]["ingredients"], [])
+
+    def test_invalid_format(self):
+        """Test that unknown formats are rejected."""
+        response = self.client.get("/api/v1/recipes/export/?file_format=xml")
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_command(self):
+        """Test the export command with one row per ingredient."""
+        out = StringIO()
+        call_command("export_data", "recipes", user="testuser", stdout=out)
+        lines = out.getvalue().splitlines()
+        # Header, one row per ingredient and one for the empty recipe
+        self.assertEqual(len(lines), 5)
+
+
+class ConditionalGetTest(TestCase):
+    """Test cases for the ETag and Last-Modified support of user collections."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product_type = ProductType.objects.create(
+            name="Tomato", base_weight=100, waste=0
+        )
+        self.product = ProductInstance.objects.create(
+            product_type=self.product_type, price_per_kilo=10000, user=self.user
+        )
+        self.recipe = Recipe.objects.create(name="Sauce", user=self.user)
+        self.item = RecipeItem.objects.create(
+            recipe=self.recipe, product_instance=self.product, quantity=100
+        )
+
+    def test_not_modified_skips_the_queryset(self):
+        """Test that a matching If-None-Match returns 304 with one query."""
+        for url in [
+            "/api/v1/products/",
+            f"/api/v1/recipes/{self.recipe.pk}/",
+            "/api/v1/recipe-items/",
+        ]:
+            etag = self.client.get(url)["ETag"]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(len(queries), 1, url)
+
+    def test_writes_change_the_etag(self):
+        """Test that writes to products, recipes and items change the ETag."""
+        url = "/api/v1/recipes/"
+        etag = self.client.get(url)["ETag"]
+        self.item.quantity = 200
+        self.item.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        etag = response["ETag"]
+        self.product.price_per_kilo = 20000
+        self.product.save()
+        self.assertNotEqual(self.client.get(url)["ETag"], etag)
+
+    def test_other_users_writes_keep_the_etag(self):
+        """Test that the version is scoped to the user."""
+        url = "/api/v1/products/"
+        etag = self.client.get(url)["ETag"]
+        ProductInstance.objects.create(product_type=self.product_type, user=self.other)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_bulk_writes_bump_once(self):
+        """Test that bulk deletes bump the version once."""
+        version = CollectionVersion.objects.get(user=self.user).version
+        self.client.delete(
+            "/api/v1/recipe-items/bulk/", {"ids": [self.item.pk]}, format="json"
+        )
+        self.assertEqual(
+            CollectionVersion.objects.get(user=self.user).version, version + 1
+        )
+
+    def test_deleting_the_user(self):
+        """Test that deleting a user does not bump its deleted version again."""
+        menu = Recipe.objects.create(name="Menu", user=self.user)
+        RecipeItem.objects.create(recipe=menu, sub_recipe=self.recipe, quantity=1)
+
+        user_id = self.user.pk
+        self.user.delete()
+
+        connection.check_constraints()
+        self.assertFalse(CollectionVersion.objects.filter(user_id=user_id).exists())
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_last_modified(self):
+        """Test the Last-Modified header and If-Modified-Since."""
+        response = self.client.get("/api/v1/products/")
+        last_modified = response["Last-Modified"]
+        response = self.client.get(
+            "/api/v1/products/", HTTP_IF_MODIFIED_SINCE=last_modified
+        )
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class ReferenceCacheTest(TestCase):
+    """Test cases for the cached categories and product types."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name="Vegetables")
+        self.product_type = ProductType.objects.create(
+            name="Tomato", base_weight=100, waste=0, category=self.category
+        )
+        invalidate_reference_data()
+
+    def assertRepeatedReadsAreFree(self, url):
+        """Check that a second read of an URL runs no queries."""
+        first = self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(url)
+        self.assertEqual(second.status_code, 200, url)
+        self.assertEqual(len(queries), 0, url)
+        self.assertEqual(first.content, second.content, url)
+        return second
+
+    def test_repeated_reads_run_no_queries(self):
+        """Test that the reference endpoints are served from the cache."""
+        for url in [
+            "/api/v1/categories/",
+            f"/api/v1/categories/{self.category.pk}/",
+            "/api/v1/product-types/",
+            "/api/v1/product-types/?expand=category",
+            f"/api/v1/product-types/{self.product_type.pk}/",
+            f"/api/v1/legacy/get-product-type-unit/?id={self.product_type.pk}",
+        ]:
+            self.assertRepeatedReadsAreFree(url)
+
+    def test_shared_tier(self):
+        """Test that another process is served from Django's cache."""
+        self.client.get("/api/v1/product-types/")
+        _local.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/v1/product-types/")
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(response.data["count"], 1)
+
+    def test_writes_invalidate(self):
+        """Test that saving and deleting reference data invalidates it."""
+        self.client.get("/api/v1/categories/")
+        Category.objects.create(name="Drinks")
+        response = self.client.get("/api/v1/categories/")
+        self.assertEqual(response.data["count"], 2)
+
+        pk = self.product_type.pk
+        self.product_type.delete()
+        response = self.client.get("/api/v1/product-types/")
+        self.assertEqual(response.data["count"], 0)
+        response = self.client.get(f"/api/v1/legacy/get-product-type-unit/?id={pk}")
+        self.assertEqual(response.status_code, 404)
+
+    def test_explicit_invalidation(self):
+        """Test invalidation of changes that bypass the signals."""
+        self.client.get("/api/v1/product-types/")
+        ProductType.objects.update(name="Onion")
+        invalidate_reference_data()
+        response = self.client.get("/api/v1/product-types/")
+        self.assertEqual(response.data["results"][0]["name"], "Onion")
+
+    def test_product_types_are_cached_per_page_and_object(self):
+        """Test that product types are cached by page and by ID, not as a table."""
+        ProductType.objects.bulk_create(
+            ProductType(name=f"Product {index}", base_weight=100, waste=0)
+            for index in range(25)
+        )
+        invalidate_reference_data()
+        self.client.get("/api/v1/product-types/")
+        self.client.get(f"/api/v1/product-types/{self.product_type.pk}/")
+
+        # Changes bypassing the signals show on pages and objects not read yet
+        last = ProductType.objects.order_by("pk").last()
+        ProductType.objects.filter(pk=last.pk).update(name="Onion")
+        response = self.client.get("/api/v1/product-types/?page=2")
+        self.assertEqual(response.data["results"][-1]["name"], "Onion")
+        response = self.client.get(f"/api/v1/product-types/{last.pk}/")
+        self.assertEqual(response.data["name"], "Onion")
+        response = self.client.get(f"/api/v1/product-types/{self.product_type.pk}/")
+        self.assertEqual(response.data["name"], "Tomato")
+
+    def test_product_type_list_view(self):
+        """Test that the legacy product type list pages are cached."""
+        self.user.is_staff = True
+        self.user.save()
+        request = RequestFactory().get("/api/v1/legacy/product-types/")
+        request.user = self.user
+        ProductTypeListView.as_view()(request)
+        with CaptureQueriesContext(connection) as queries:
+            response = ProductTypeListView.as_view()(request)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(
+            [obj.name for obj in response.context_data["product_types"]], ["Tomato"]
+        )
+        self.assertEqual(response.context_data["paginator"].count, 1)
+
+    def test_local_tier_expires(self):
+        """Test that in-process entries expire without an invalidation."""
+        loads = []
+
+        def load():
+            loads.append(1)
+            return len(loads)
+
+        get_reference("kept", load)
+        with override_settings(REFERENCE_CACHE_LOCAL_TIMEOUT=0):
+            get_reference("expired", load)
+        # Another process stored newer values in the shared tier
+        version = cache.get(VERSION_KEY)
+        cache.set_many(
+            {f"reference:{version}:kept": 5, f"reference:{version}:expired": 5}
+        )
+
+        self.assertEqual(get_reference("kept", load), 1)
+        self.assertEqual(get_reference("expired", load), 5)
+        self.assertEqual(len(loads), 2)
+
+    def test_process_local_backend_warning(self):
+        """Test the deploy check warning about a per-process cache."""
+        self.assertEqual(
+            [warning.id for warning in check_shared_cache(None)], ["core.W001"]
+        )
+        backend = "django.core.cache.backends.redis.RedisCache"
+        with override_settings(CACHES={"default": {"BACKEND": backend}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_filtered_lists_use_the_database(self):
+        """Test that filtered lists are not served from the cache."""
+        ProductType.objects.create(name="Milk", base_weight=100, waste=0)
+        self.client.get("/api/v1/product-types/")
+        response = self.client.get("/api/v1/product-types/?search=Milk")
+        self.assertEqual([row["name"] for row in response.data["results"]], ["Milk"])
+
+
+class ProductAutocompleteTest(TestCase):
+    """Test cases for the ingredient autocomplete and its form widget."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        other = User.objects.create_user(username="other", password="pass")
+        tomato = ProductType.objects.create(name="Tomato", base_weight=100, waste=0)
+        milk = ProductType.objects.create(
+            name="Milk", base_weight=100, waste=0, unit=ProductType.UNIT_LITER
+        )
+        ProductInstance.objects.bulk_create(
+            [ProductInstance(product_type=tomato, user=self.user) for _ in range(25)]
+            + [ProductInstance(product_type=milk, user=self.user, unit="liter")]
+            + [ProductInstance(product_type=milk, user=other)]
+        )
+        self.recipe = Recipe.objects.create(name="Sauce", user=self.user)
+        self.client.force_login(self.user)
+        self.url = "/api/v1/legacy/products/autocomplete/"
+
+    def test_prefix_search(self):
+        """Test that products are searched by product type name prefix."""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {"term": "Mi"})
+        data = response.json()
+        self.assertEqual(
+            [(row["text"], row["unit"]) for row in data["results"]],
+            [("Milk", "liter")],
+        )
+        self.assertFalse(data["pagination"]["more"])
+        product_queries = [
+            query for query in queries if "core_productinstance" in query["sql"]
+        ]
+        self.assertEqual(len(product_queries), 1)
+
+    def test_pages(self):
+        """Test that results are returned one page at a time."""
+        first = self.client.get(self.url, {"term": "To"}).json()
+        self.assertEqual(len(first["results"]), 20)
+        self.assertTrue(first["pagination"]["more"])
+        second = self.client.get(self.url, {"term": "To", "page": 2}).json()
+        self.assertEqual(len(second["results"]), 5)
+        self.assertFalse(second["pagination"]["more"])
+
+    def test_form_renders_only_the_selected_product(self):
+        """Test that the form does not preload the user's products."""
+        form = RecipeItemForm(self.user, instance=RecipeItem(recipe=self.recipe))
+        with CaptureQueriesContext(connection) as queries:
+            html = str(form["product_instance"])
+        self.assertEqual(html.count("<option"), 1)
+        self.assertIn("data-ajax--url", html)
+        self.assertFalse(
+            [query for query in queries if "core_productinstance" in query["sql"]]
+        )
+
+        product = ProductInstance.objects.filter(user=self.user).first()
+        form = RecipeItemForm(
+            self.user,
+            {"product_instance": product.pk, "quantity": ""},
+            instance=RecipeItem(recipe=self.recipe),
+        )
+        self.assertFalse(form.is_valid())
+        html = str(form["product_instance"])
+        self.assertEqual(html.count("<option"), 2)
+        self.assertIn("selected", html)
+
+    def test_product_types(self):
+        """Test the product type autocomplete of the product form."""
+        response = self.client.get(
+            "/api/v1/legacy/product-types/autocomplete/", {"term": "Mi"}
+        )
+        self.assertEqual(
+            [(row["text"], row["unit"]) for row in response.json()["results"]],
+            [("Milk", ProductType.UNIT_LITER)],
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            html = str(ProductForm()["product_type"])
+        self.assertEqual(html.count("<option"), 1)
+        self.assertIn("product-types/autocomplete", html)
+        self.assertFalse(
+            [query for query in queries if "core_producttype" in query["sql"]]
+        )
+
+
+class NormalizedSearchTest(TestCase):
+    """Test cases for the Persian-aware search index."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # Typed with the Arabic kaf
+        self.lettuce = ProductType.objects.create(
+            name="كاهو پیچ", base_weight=100, waste=0
+        )
+        self.tomato = ProductType.objects.create(
+            name="گوجه فرنگی", base_weight=100, waste=0
+        )
+        ProductInstance.objects.create(product_type=self.lettuce, user=self.user)
+        Recipe.objects.create(
+            name="سالاد", description="با سس مخصوص\u200cسرآشپز", user=self.user
+        )
+
+    def search(self, url, query):
+        """Return the names found by an API search."""
+        response = self.client.get(url, {"search": query})
+        self.assertEqual(response.status_code, 200)
+        return [row.get("name") or row["id"] for row in response.data["results"]]
+
+    def test_normalize(self):
+        """Test the folding of Arabic variants, digits and joiners."""
+        self.assertEqual(normalize("عليك"), "علیک")
+        self.assertEqual(normalize("مي\u200cخواهم"), "میخواهم")
+        self.assertEqual(normalize("كِتاب ۱۲٣"), "کتاب 123")
+        self.assertEqual(normalize("Tomato-Sauce"), "tomato sauce")
+
+    def test_character_variants(self):
+        """Test that Persian and Arabic spellings find each other."""
+        self.assertEqual(self.search("/api/v1/product-types/", "کاهو"), ["كاهو پیچ"])
+        self.assertEqual(self.search("/api/v1/product-types/", "كاه"), ["كاهو پیچ"])
+
+    def test_substring_and_words(self):
+        """Test substring matches of every word of the query."""
+        self.assertEqual(self.search("/api/v1/product-types/", "رنگ"), ["گوجه فرنگی"])
+        self.assertEqual(
+            self.search("/api/v1/product-types/", "وجه رنگی"), ["گوجه فرنگی"]
+        )
+        self.assertEqual(self.search("/api/v1/product-types/", "وجه کاهو"), [])
+
+    def test_products_and_recipes(self):
+        """Test product search by type name and recipe search by description."""
+        self.assertEqual(len(self.search("/api/v1/products/", "كاهو")), 1)
+        self.assertEqual(self.search("/api/v1/recipes/", "مخصوصسراشپز"), ["سالاد"])
+
+    def test_index_follows_changes(self):
+        """Test that renames and deletions update the index."""
+        self.tomato.name = "خیار"
+        self.tomato.save()
+        self.assertEqual(self.search("/api/v1/product-types/", "فرنگی"), [])
+        self.assertEqual(self.search("/api/v1/product-types/", "خیار"), ["خیار"])
+
+        pk = self.tomato.pk
+        self.tomato.delete()
+        self.assertFalse(
+            SearchTerm.objects.filter(
+                kind=SearchTerm.KIND_PRODUCT_TYPE, object_id=pk
+            ).exists()
+        )
+
+    def test_rebuild_command(self):
+        """Test rebuilding the index with the management command."""
+        SearchTerm.objects.all().delete()
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.search("/api/v1/product-types/", "پیچ"), ["كاهو پیچ"])
+
+    def test_benchmark_command(self):
+        """Test that the benchmark command runs and rolls back."""
+        out = StringIO()
+        call_command("benchmark_search", rows=50, queries=5, stdout=out)
+        self.assertIn("5 lookups", out.getvalue())
+        self.assertEqual(ProductType.objects.count(), 2)
+
+
+class SchemaCacheTest(TestCase):
+    """Test cases for the precompiled API schema."""
+
+    def setUp(self):
+        """Use a temporary schema file and an empty in-memory schema."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.schema_file = os.path.join(directory.name, "openapi.json")
+        settings = override_settings(SCHEMA_FILE=self.schema_file)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        schema._documents.clear()
+        self.addCleanup(schema._documents.clear)
+
+    def test_served_from_memory_with_etag(self):
+        """Test that the schema is generated once and revalidated by ETag."""
+        response = self.client.get("/swagger.json")
+        self.assertEqual(response.status_code, 200)
+        spec = json.loads(response.content)
+        self.assertIn("/api/v1/recipes/", spec["paths"])
+        self.assertEqual(spec["x-code-version"], schema.code_version())
+
+        documents = schema.schema_documents()
+        response = self.client.get("/swagger.json", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertIs(schema.schema_documents(), documents)
+        self.assertEqual(self.client.get("/swagger.yaml").status_code, 200)
+
+    def test_schema_file(self):
+        """Test that the generated file is served while the code is unchanged."""
+        call_command("generate_schema", stdout=StringIO())
+        with open(self.schema_file, encoding="utf-8") as f:
+            spec = json.load(f)
+        spec["info"]["title"] = "Stored"
+        with open(self.schema_file, "w", encoding="utf-8") as f:
+            json.dump(spec, f)
+        response = self.client.get("/swagger.json")
+        self.assertEqual(json.loads(response.content)["info"]["title"], "Stored")
+
+        # Files of another code version are ignored
+        spec["x-code-version"] = "old"
+        with open(self.schema_file, "w", encoding="utf-8") as f:
+            json.dump(spec, f)
+        schema._documents.clear()
+        response = self.client.get("/swagger.json")
+        self.assertEqual(json.loads(response.content)["info"]["title"], "DB-FA API")
+
+    def test_code_version_follows_contents(self):
+        """Test that the code version does not change with a new checkout."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "module.py")
+            with open(path, "w") as f:
+                f.write("VALUE = 1\n")
+            with override_settings(BASE_DIR=directory, CODE_VERSION=""):
+                version = schema.code_version.__wrapped__()
+                os.utime(path, (0, 0))
+                self.assertEqual(schema.code_version.__wrapped__(), version)
+                with open(path, "w") as f:
+                    f.write("VALUE = 2\n")
+                self.assertNotEqual(schema.code_version.__wrapped__(), version)
+
+    def test_openapi_format(self):
+        """Test that the OpenAPI renderer is served from memory too."""
+        response = self.client.get("/swagger/?format=openapi")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header("ETag"))
+
+
+class ProductInstanceAdminTest(TestCase):
+    """Test cases for the product instance admin changelist."""
+
+    url = "/admin/core/productinstance/"
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_superuser(username="admin", password="pass")
+        self.client.force_login(self.user)
+        self.tomato = ProductType.objects.create(
+            name="Tomato", base_weight=100, waste=0
+        )
+        self.milk = ProductType.objects.create(name="Milk", base_weight=100, waste=0)
+
+    def create(self, count, product_type, created_at=None):
+        """Create product instances, optionally backdated."""
+        products = ProductInstance.objects.bulk_create(
+            ProductInstance(product_type=product_type, user=self.user)
+            for _ in range(count)
+        )
+        if created_at:
+            ProductInstance.objects.filter(
+                pk__in=[product.pk for product in products]
+            ).update(created_at=created_at)
+
+    def get(self, query=""):
+        """Return the changelist response and its number of queries."""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url + query)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_queries_do_not_grow_with_rows(self):
+        """Test that product types are joined and filters are not listed."""
+        self.create(2, self.tomato)
+        _, small = self.get()
+        self.create(30, self.milk)
+        response, large = self.get()
+        self.assertEqual(small, large)
+        self.assertEqual(response.context["cl"].result_count, 32)
+
+    def test_filters(self):
+        """Test the product type and month filters."""
+        self.create(2, self.tomato)
+        self.create(3, self.milk, timezone.make_aware(datetime(2023, 5, 10)))
+        response, _ = self.get(f"?product_type__id__exact={self.milk.pk}")
+        self.assertEqual(response.context["cl"].result_count, 3)
+        response, _ = self.get("?created=2023-05")
+        self.assertEqual(response.context["cl"].result_count, 3)
+        response, _ = self.get("?created=2023-06")
+        self.assertEqual(response.context["cl"].result_count, 0)
+        response, _ = self.get("?created=2023")
+        self.assertContains(response, "?created=2023-12")
+
+    def test_paginator_counts_exactly_without_estimates(self):
+        """Test that backends without planner estimates count rows."""
+        self.create(3, self.tomato)
+        paginator = EstimatedCountPaginator(ProductInstance.objects.order_by("pk"), 2)
+        self.assertEqual(paginator.count, 3)
+
+
+class ProductTypeImportTest(TestCase):
+    """Test cases for the bulk CSV import of product types."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.vegetables = Category.objects.create(name="سبزیجات")
+        self.lettuce = ProductType.objects.create(
+            name="کاهو",
+            base_weight=500,
+            waste=50,
+            unit=ProductType.UNIT_KILOGRAM,
+            category=self.vegetables,
+        )
+        self.cucumber = ProductType.objects.create(
+            name="خیار", base_weight=800, waste=80, category=self.vegetables
+        )
+        self.product = ProductInstance.objects.create(
+            product_type=self.lettuce,
+            total_weight=1000,
+            price_per_kilo=10000,
+            user=self.user,
+        )
+        self.rows = [
+            ["نوشیدنی", "", ""],
+            ["نوشابه", "1500", "0"],
+            ["آب سیب", "1000", "", "liter"],
+            ["سبزیجات", "", ""],
+            ["کاهو", "500", "100"],
+            ["خیار", "800", "80"],
+        ]
+
+    def test_import(self):
+        """Test that rows are inserted and updated with their side effects."""
+        version = CollectionVersion.objects.get(user=self.user).version
+        result = import_product_types(self.rows)
+
+        self.assertEqual(result.rows, 6)
+        self.assertEqual(result.categories_created, ["نوشیدنی"])
+        self.assertEqual(result.product_types_created, ["نوشابه", "آب سیب"])
+        self.assertEqual(result.product_types_updated, ["کاهو"])
+        self.assertEqual(result.unchanged, 1)
+        self.assertEqual(result.errors, [])
+
+        drinks = Category.objects.get(name="نوشیدنی")
+        soda = ProductType.objects.get(name="نوشابه")
+        self.assertEqual(soda.category, drinks)
+        self.assertEqual(soda.unit, ProductType.UNIT_PIECE)
+        juice = ProductType.objects.get(name="آب سیب")
+        self.assertEqual((juice.waste, juice.unit), (0, ProductType.UNIT_LITER))
+
+        # Rows without a unit keep the existing one
+        self.lettuce.refresh_from_db()
+        self.assertEqual(self.lettuce.waste, 100)
+        self.assertEqual(self.lettuce.unit, ProductType.UNIT_KILOGRAM)
+
+        # Bulk writes send no signals, the engine applies their effects
+        self.product.refresh_from_db()
+        self.assertAlmostEqual(self.product.waste_weight, 200)
+        self.assertEqual(
+            CollectionVersion.objects.get(user=self.user).version, version + 1
+        )
+        self.assertTrue(
+            SearchTerm.objects.filter(
+                kind=SearchTerm.KIND_PRODUCT_TYPE, object_id=soda.pk
+            ).exists()
+        )
+
+    def test_query_count(self):
+        """Test that the number of queries does not grow with the rows."""
+        rows = [["سبزیجات", "", ""]] + [
+            [f"محصول {index}", "100", "10"] for index in range(50)
+        ]
+        with CaptureQueriesContext(connection) as context:
+            import_product_types(rows, chunk_size=1000)
+        self.assertLess(len(context.captured_queries), 15)
+        self.assertEqual(ProductType.objects.count(), 52)
+
+    def test_batches(self):
+        """Test that rows are written in batches while they are read."""
+        rows = (
+            [["سبزیجات", "", ""]]
+            + [[f"محصول {index}", "100", "10"] for index in range(5)]
+            + [["کاهو", "500", "100"], ["محصول 0", "100", "20"], ["کاهو", "500", "90"]]
+        )
+
+        written = []
+
+        def reading():
+            for row in rows:
+                written.append(
+                    ProductType.objects.filter(name__startswith="محصول").count()
+                )
+                yield row
+
+        dry_run = import_product_types(rows, dry_run=True, chunk_size=2)
+        result = import_product_types(reading(), chunk_size=2)
+
+        # Product types are created before the end of the file
+        self.assertEqual(written[-1], 5)
+        for counted in [dry_run, result]:
+            self.assertEqual(
+                counted.product_types_created, [f"محصول {i}" for i in range(5)]
+            )
+            self.assertEqual(counted.product_types_updated, ["کاهو"])
+        self.assertEqual(ProductType.objects.get(name="محصول 0").waste, 20)
+        self.lettuce.refresh_from_db()
+        self.assertEqual(self.lettuce.waste, 90)
+
+    def test_dry_run(self):
+        """Test that a dry run reports the changes without saving them."""
+        result = import_product_types(self.rows, dry_run=True)
+
+        self.assertEqual(result.product_types_created, ["نوشابه", "آب سیب"])
+        self.assertEqual(result.product_types_updated, ["کاهو"])
+        self.assertFalse(Category.objects.filter(name="نوشیدنی").exists())
+        self.assertEqual(ProductType.objects.count(), 2)
+        self.lettuce.refresh_from_db()
+        self.assertEqual(self.lettuce.waste, 50)
+
+    def test_invalid_rows(self):
+        """Test that invalid rows are reported and skipped."""
+        result = import_product_types(
+            [["کاهو", "زیاد", "10"], ["خیار", "800", "80", "bushel"]]
+        )
+
+        self.assertEqual(len(result.errors), 2)
+        self.assertIn("سطر 2", result.errors[0])
+        self.assertIn("bushel", result.errors[1])
+        self.assertEqual(result.product_types_updated, [])
+
+    def test_xlsx(self):
+        """Test that workbooks are imported with the layout of CSV files."""
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(["نوع", "وزن پایه", "دور ریز", "واحد", "وزن خالص"])
+        for row in self.rows:
+            sheet.append([None if cell == "" else cell for cell in row])
+        sheet.append([None, None, None, None, None])
+        sheet.append(["نان", 1000, 25.5, "piece", 974.5])
+        path = os.path.join(tempfile.mkdtemp(), "catalog.xlsx")
+        workbook.save(path)
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.remove, path)
+
+        result = import_file(path)
+
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.categories_created, ["نوشیدنی"])
+        self.assertEqual(result.product_types_created, ["نوشابه", "آب سیب", "نان"])
+        self.assertEqual(result.product_types_updated, ["کاهو"])
+        bread = ProductType.objects.get(name="نان")
+        self.assertEqual((bread.waste, bread.unit), (25.5, ProductType.UNIT_PIECE))
+        self.assertEqual(bread.category, self.vegetables)
+
+    def test_command(self):
+        """Test the management command with and without a dry run."""
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".csv", encoding="utf-8", delete=False
+        ) as f:
+            f.write("نوع,وزن پایه,دور ریز,واحد\n")
+            f.write("کاهو,500,100,\n")
+        self.addCleanup(os.remove, f.name)
+
+        call_command("import_csv", f.name, "--dry-run", stdout=StringIO())
+        self.lettuce.refresh_from_db()
+        self.assertEqual(self.lettuce.waste, 50)
+
+        out = StringIO()
+        call_command("import_csv", f.name, stdout=out)
+        self.lettuce.refresh_from_db()
+        self.assertEqual(self.lettuce.waste, 100)
+        self.assertIn("تعداد محصولات به‌روزرسانی شده: 1", out.getvalue())
+
+        # The same content is skipped, unless forced
+        self.lettuce.waste = 50
+        self.lettuce.save()
+        out = StringIO()
+        call_command("import_csv", f.name, stdout=out)
+        self.assertIn("قبلاً وارد شده", out.getvalue())
+        self.lettuce.refresh_from_db()
+        self.assertEqual(self.lettuce.waste, 50)
+
+        call_command("import_csv", f.name, "--force", stdout=StringIO())
+        self.lettuce.refresh_from_db()
+        self.assertEqual(self.lettuce.waste, 100)
+
+    def test_fingerprints(self):
+        """Test that rows imported unchanged are skipped by fingerprint."""
+        import_product_types(self.rows)
+        self.assertTrue(
+            ProductType.objects.exclude(import_fingerprint="").filter(
+                pk=self.cucumber.pk
+            )
+        )
+
+        # Only the fingerprints are read, nothing is written
+        with CaptureQueriesContext(connection) as context:
+            result = import_product_types(self.rows)
+        self.assertEqual(len(context.captured_queries), 2)
+        self.assertEqual(result.unchanged, 4)
+        self.assertEqual(result.product_types_updated, [])
+
+        # Saved outside imports, the product type is compared again
+        self.cucumber.refresh_from_db()
+        self.cucumber.save()
+        self.assertEqual(self.cucumber.import_fingerprint, "")
+        result = import_product_types(self.rows)
+        self.assertEqual(result.unchanged, 4)
+        self.assertEqual(result.product_types_updated, [])
+        self.cucumber.refresh_from_db()
+        self.assertNotEqual(self.cucumber.import_fingerprint, "")
+
+        rows = [row[:] for row in self.rows]
+        rows[-1][2] = "90"
+        result = import_product_types(rows)
+        self.assertEqual(result.product_types_updated, ["خیار"])
+        self.assertEqual(result.unchanged, 3)
+
+
+class ImportJobTest(TestCase):
+    """Test cases for the background admin imports."""
+
+    url = "/admin/core/producttype/import-csv/"
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_superuser(username="admin", password="pass")
+        self.client.force_login(self.user)
+        self.upload_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.upload_dir)
+        settings = override_settings(
+            IMPORT_ASYNC=False, IMPORT_UPLOAD_DIR=self.upload_dir
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def upload(self, content, **data):
+        """Upload a file through the admin and return its job."""
+        upload = SimpleUploadedFile("catalog.csv", content, "text/csv")
+        response = self.client.post(self.url, {"csv_file": upload, **data})
+        job = ImportJob.objects.get()
+        self.assertRedirects(response, f"{self.url}{job.pk}/")
+        return job
+
+    def test_upload(self):
+        """Test that an upload is imported by a job reporting its progress."""
+        content = "نوع,وزن پایه,دور ریز,واحد\nسبزیجات,,,\nکاهو,500,50,\nخیار,x,1,\n"
+        job = self.upload(content.encode())
+
+        self.assertEqual(job.status, ImportJob.STATUS_DONE)
+        self.assertEqual(job.user, self.user)
+        self.assertEqual((job.rows_processed, job.product_types_created), (3, 1))
+        self.assertEqual(job.percent, 100)
+        self.assertEqual(len(job.errors), 1)
+        self.assertIn("خیار", job.errors[0])
+        self.assertTrue(ProductType.objects.filter(name="کاهو").exists())
+        # The uploaded file is removed once imported
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+        response = self.client.get(f"{self.url}{job.pk}/status/")
+        self.assertEqual(response.json()["status"], ImportJob.STATUS_DONE)
+        self.assertEqual(response.json()["error_count"], 1)
+        response = self.client.get(f"{self.url}{job.pk}/")
+        self.assertContains(response, "خیار")
+
+    def test_dry_run(self):
+        """Test that a dry run job saves nothing."""
+        job = self.upload("نوع,وزن پایه,دور ریز\nکاهو,500,50\n".encode(), dry_run="on")
+
+        self.assertEqual(job.status, ImportJob.STATUS_DONE)
+        self.assertEqual(job.product_types_created, 1)
+        self.assertFalse(ProductType.objects.exists())
+
+    def test_invalid_encoding(self):
+        """Test that a file that is not UTF-8 fails the job."""
+        with self.assertLogs("core.importer", "ERROR"):
+            job = self.upload("نوع\nکاهو,500,50\n".encode("utf-16"))
+
+        self.assertEqual(job.status, ImportJob.STATUS_FAILED)
+        self.assertTrue(job.message)
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_xlsx_upload(self):
+        """Test that Excel uploads are imported and other files rejected."""
+        workbook = Workbook()
+        workbook.active.append(["نوع", "وزن پایه", "دور ریز"])
+        workbook.active.append(["کاهو", 500, 50])
+        content = BytesIO()
+        workbook.save(content)
+        upload = SimpleUploadedFile("catalog.xlsx", content.getvalue())
+        self.client.post(self.url, {"csv_file": upload})
+
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, ImportJob.STATUS_DONE)
+        self.assertTrue(ProductType.objects.filter(name="کاهو", waste=50).exists())
+
+        upload = SimpleUploadedFile("catalog.txt", b"data")
+        response = self.client.post(self.url, {"csv_file": upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ImportJob.objects.count(), 1)
+
+    def test_stale_job(self):
+        """Test that a job left running by a restart fails and can be retried."""
+        path = os.path.join(self.upload_dir, "catalog.csv")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("نوع,وزن پایه,دور ریز\nکاهو,500,50\n")
+        job = ImportJob.objects.create(
+            file_name="catalog.csv", path=path, status=ImportJob.STATUS_RUNNING
+        )
+        response = self.client.get(f"{self.url}{job.pk}/status/")
+        self.assertEqual(response.json()["status"], ImportJob.STATUS_RUNNING)
+
+        ImportJob.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        response = self.client.get(f"{self.url}{job.pk}/status/")
+        self.assertEqual(response.json()["status"], ImportJob.STATUS_FAILED)
+
+        self.client.post(
+            "/admin/core/importjob/",
+            {"action": "retry", "_selected_action": [job.pk]},
+        )
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.STATUS_DONE)
+        self.assertTrue(ProductType.objects.filter(name="کاهو").exists())
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_staff_only(self):
+        """Test that the import pages require an admin login."""
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("/admin/login/", response.url)
+
+
+class PurchaseImportTest(TestCase):
+    """Test cases for the bulk import of purchases (product instances)."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.lettuce = ProductType.objects.create(
+            name="کاهو", base_weight=500, waste=50
+        )
+        self.cucumber = ProductType.objects.create(
+            name="خیار", base_weight=800, waste=80
+        )
+        self.old = ProductInstance.objects.create(
+            product_type=self.lettuce, price_per_kilo=5000, user=self.user
+        )
+
+    def write_csv(self, lines, suffix=".csv"):
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=suffix, encoding="utf-8", delete=False
+        ) as f:
+            f.write("نوع,مقدار,واحد,قیمت\n")
+            f.writelines(f"{line}\n" for line in lines)
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_import(self):
+        """Test that the derived fields and side effects match saved products."""
+        version = CollectionVersion.objects.get(user=self.user).version
+        path = self.write_csv(
+            ["کاهو,2000,kilogram,12000", " خیار ,1500,,9000", "کاهو,1000,piece,3000"]
+        )
+
+        result = import_purchases(path, self.user, chunk_rows=2, batch_size=2)
+
+        self.assertEqual((result.rows, result.created, result.errors), (3, 3, []))
+        products = ProductInstance.objects.filter(user=self.user).exclude(
+            pk=self.old.pk
+        )
+        self.assertEqual(products.count(), 3)
+        for product in products:
+            expected = ProductInstance(
+                product_type=product.product_type,
+                total_weight=product.total_weight,
+                price_per_kilo=product.price_per_kilo,
+                unit=product.unit,
+            )
+            expected.compute_derived_fields()
+            self.assertAlmostEqual(product.waste_weight, expected.waste_weight)
+            self.assertAlmostEqual(product.net_weight, expected.net_weight)
+            self.assertAlmostEqual(product.total_price, expected.total_price)
+        self.assertEqual(
+            products.get(product_type=self.cucumber).unit, ProductInstance.UNIT_GRAM
+        )
+
+        # Bulk writes send no signals, the import applies their effects
+        self.assertEqual(
+            PriceHistory.objects.filter(product_instance__in=products).count(), 3
+        )
+        latest = LatestPrice.objects.get(user=self.user, product_type=self.lettuce)
+        self.assertEqual((latest.price_per_kilo, latest.unit), (3000, "piece"))
+        self.assertEqual(
+            LatestPrice.objects.get(
+                user=self.user, product_type=self.cucumber
+            ).price_per_kilo,
+            9000,
+        )
+        self.assertEqual(
+            CollectionVersion.objects.get(user=self.user).version, version + 1
+        )
+
+    def test_invalid_rows(self):
+        """Test that invalid rows are reported once and skipped."""
+        path = self.write_csv(
+            [
+                "نان,1000,gram,100",
+                "کاهو,زیاد,gram,100",
+                "کاهو,1000,gram,-5",
+                "کاهو,1000,bushel,100",
+                "خیار,1000,gram,100",
+            ]
+        )
+
+        result = import_purchases(path, self.user)
+
+        self.assertEqual((result.rows, result.created, result.error_count), (5, 1, 4))
+        self.assertIn("سطر 2", result.errors[0])
+        self.assertIn("نان", result.errors[0])
+        self.assertIn("سطر 5", result.errors[3])
+        self.assertTrue(
+            ProductInstance.objects.filter(product_type=self.cucumber).exists()
+        )
+
+    def test_xlsx(self):
+        """Test that workbooks are imported like CSV files."""
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(["نوع", "مقدار", "واحد", "قیمت"])
+        sheet.append(["کاهو", 2000, "kilogram", 12000])
+        sheet.append([None, None, None, None])
+        sheet.append(["خیار", 1500.5])
+        path = os.path.join(tempfile.mkdtemp(), "purchases.xlsx")
+        workbook.save(path)
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.remove, path)
+
+        result = import_purchases(path, self.user)
+
+        self.assertEqual(result.error_count, 1)
+        self.assertIn("سطر 4", result.errors[0])
+        self.assertEqual(result.created, 1)
+
+    def test_api(self):
+        """Test that uploads create the products of the requesting user."""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        upload = SimpleUploadedFile(
+            "purchases.csv", "نوع,مقدار,واحد,قیمت\nکاهو,2000,gram,100\n".encode()
+        )
+        response = client.post(
+            "/api/v1/products/import/", {"file": upload}, format="multipart"
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["created"], 1)
+        self.assertEqual(
+            ProductInstance.objects.filter(user=self.user, total_weight=2000).count(),
+            1,
+        )
+
+        upload = SimpleUploadedFile("purchases.txt", b"")
+        response = client.post(
+            "/api/v1/products/import/", {"file": upload}, format="multipart"
+        )
+        self.assertEqual(response.status_code, 400)
+
+        # Too few columns, and no valid rows
+        for content in ["نوع,مقدار\nکاهو,2000\n", "نوع,مقدار,واحد,قیمت\nنان,1,,1\n"]:
+            upload = SimpleUploadedFile("purchases.csv", content.encode())
+            response = client.post(
+                "/api/v1/products/import/", {"file": upload}, format="multipart"
+            )
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error_count"], 1)
+        upload = SimpleUploadedFile("purchases.xlsx", b"not a workbook")
+        response = client.post(
+            "/api/v1/products/import/", {"file": upload}, format="multipart"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("could not be read", response.json()["detail"])
+
+    def test_command(self):
+        """Test the management command."""
+        path = self.write_csv(["خیار,1000,gram,100"])
+        out = StringIO()
+        call_command("import_purchases", path, "--user", "testuser", stdout=out)
+        self.assertIn("تعداد خریدهای ثبت شده: 1", out.getvalue())
+        self.assertTrue(
+            ProductInstance.objects.filter(product_type=self.cucumber).exists()
+        )
+
+
 class BusinessLogicTest(TestCase):
     """Test business logic calculations."""
 
@@ -0,0 +1,175 @@
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from django.db import models
+from django.db.models import Case, Value, When
+
+# Dimensions a quantity can be measured in
+MASS = "mass"
+VOLUME = "volume"
+COUNT = "count"
+LENGTH = "length"
+
+# Unit codes, as stored in the database
+GRAM = "gram"
+KILOGRAM = "kilogram"
+MILLILITER = "milliliter"
+LITER = "liter"
+PIECE = "piece"
+DOZEN = "dozen"
+PACKAGE = "package"
+METER = "meter"
+
+
+class Unit(NamedTuple):
+    """A measurement unit and how it relates to the base unit of its dimension."""
+
+    code: str
+    label: str
+    dimension: str
+    # Size in the base unit of the dimension (gram, milliliter, piece, meter).
+    # None when it depends on the product, like the pieces in a package.
+    size: Optional[float]
+    # Quantity of this unit a price is quoted for (prices of gram items are
+    # per kilo, prices of milliliter items per liter)
+    price_quantity: float
+
+
+UNITS: Dict[str, Unit] = {
+    unit.code: unit
+    for unit in (
+        Unit(GRAM, "گرم", MASS, 1, 1000),
+        Unit(PIECE, "عدد", COUNT, 1, 1),
+        Unit(LITER, "لیتر", VOLUME, 1000, 1),
+        Unit(METER, "متر", LENGTH, 1, 1),
+        Unit(KILOGRAM, "کیلوگرم", MASS, 1000, 1),
+        Unit(MILLILITER, "میلی‌لیتر", VOLUME, 1, 1000),
+        Unit(DOZEN, "دوجین", COUNT, 12, 1),
+        Unit(PACKAGE, "بسته", COUNT, None, 1),
+    )
+}
+
+UNIT_CHOICES = [(unit.code, unit.label) for unit in UNITS.values()]
+
+# Precomputed factor turning "price per unit" into "price per one of the unit"
+PRICE_FACTORS: Dict[str, float] = {
+    code: 1 / unit.price_quantity for code, unit in UNITS.items()
+}
+
+# Precomputed conversions between units of fixed size in the same dimension
+CONVERSION_FACTORS: Dict[Tuple[str, str], float] = {
+    (source.code, target.code): source.size / target.size
+    for source in UNITS.values()
+    for target in UNITS.values()
+    if source.dimension == target.dimension
+    and source.size is not None
+    and target.size is not None
+}
+
+
+class UnitChoices:
+    """Unit constants shared by the models with a unit field."""
+
+    UNIT_GRAM = GRAM
+    UNIT_KILOGRAM = KILOGRAM
+    UNIT_MILLILITER = MILLILITER
+    UNIT_LITER = LITER
+    UNIT_PIECE = PIECE
+    UNIT_DOZEN = DOZEN
+    UNIT_PACKAGE = PACKAGE
+    UNIT_METER = METER
+
+    UNIT_CHOICES = UNIT_CHOICES
+
+
+def unit_label(code: str) -> str:
+    """Return the display label of a unit code."""
+    unit = UNITS.get(code)
+    return unit.label if unit else "واحد"
+
+
+def price_factor(code: str) -> float:
+    """Return the factor turning a quoted price into the price of one unit."""
+    return PRICE_FACTORS.get(code, 1.0)
+
+
+def _base_size(code: str, package_size: Optional[float]) -> Optional[float]:
+    """Size of a unit in its base unit, resolving package sizes."""
+    if code == PACKAGE:
+        return package_size or None
+    return UNITS[code].size
+
+
+def conversion_factor(
+    source: str,
+    target: str,
+    density: Optional[float] = None,
+    package_size: Optional[float] = None,
+) -> Optional[float]:
+    """
+    Return the factor converting a quantity from one unit into another.
+
+    Fixed conversions come from the precomputed table. Packages need the
+    number of pieces per package, and mass <-> volume conversions need the
+    product density in grams per milliliter.
+
+    Returns:
+        The factor, or None if the units cannot be converted
+    """
+    if source == target:
+        return 1.0
+    factor = CONVERSION_FACTORS.get((source, target))
+    if factor is not None:
+        return factor
+    if source not in UNITS or target not in UNITS:
+        return None
+
+    source_size = _base_size(source, package_size)
+    target_size = _base_size(target, package_size)
+    if source_size is None or target_size is None:
+        return None
+
+    dimensions = (UNITS[source].dimension, UNITS[target].dimension)
+    if dimensions[0] == dimensions[1]:
+        return source_size / target_size
+    if density:
+        if dimensions == (VOLUME, MASS):
+            return source_size * density / target_size
+        if dimensions == (MASS, VOLUME):
+            return source_size / density / target_size
+    return None
+
+
+def cost_factor(
+    quantity_unit: str,
+    price_unit: str,
+    density: Optional[float] = None,
+    package_size: Optional[float] = None,
+) -> Optional[float]:
+    """
+    Return the factor that costs a quantity with a single multiplication:
+    ``cost = price * quantity * factor``.
+
+    Args:
+        quantity_unit: Unit the quantity is measured in
+        price_unit: Unit the price is quoted in
+
+    Returns:
+        The factor, or None if the units cannot be converted
+    """
+    conversion = conversion_factor(quantity_unit, price_unit, density, package_size)
+    if conversion is None:
+        return None
+    return conversion * price_factor(price_unit)
+
+
+def price_factor_expression(unit_field: str) -> Case:
+    """Database-side equivalent of ``price_factor`` for a unit field."""
+    return Case(
+        *(
+            When(**{unit_field: code}, then=Value(factor))
+            for code, factor in PRICE_FACTORS.items()
+            if factor != 1
+        ),
+        default=Value(1.0),
+        output_field=models.FloatField(),
+    )
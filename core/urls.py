@@ -25,6 +25,16 @@ urlpatterns = [
         views.get_product_type_unit,
         name="get_product_type_unit",
     ),
+    path(
+        "legacy/product-types/autocomplete/",
+        views.product_type_autocomplete,
+        name="product_type_autocomplete",
+    ),
+    path(
+        "legacy/products/autocomplete/",
+        views.product_autocomplete,
+        name="product_autocomplete",
+    ),
     # Recipe management legacy URLs
     path("legacy/recipes/", views.recipe_list, name="recipe_list"),
     path("legacy/recipes/new/", views.recipe_create, name="recipe_create"),
@@ -1,35 +1,109 @@
+import os
+from datetime import timedelta
 from typing import Union
 
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.core.paginator import Page
+from django.db.models import Exists, F, OuterRef, Prefetch
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.utils.decorators import method_decorator
 from django.views.generic import ListView
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
+from .bulk import (
+    bulk_create_products,
+    bulk_create_recipe_items,
+    bulk_delete_products,
+    bulk_delete_recipe_items,
+    bulk_update_products,
+    bulk_update_recipe_items,
+)
+from .cache import CachedReferenceMixin, category, get_reference, product_type
+from .conditional import ConditionalGetMixin
+from .costing import market_costs, recipe_cost_as_of, recipe_cost_trend
+from .exports import (
+    EXPORT_FORMATS,
+    FORMAT_CSV,
+    export_products,
+    export_recipes,
+)
 from .forms import ProductForm, RecipeForm, RecipeItemForm
-from .models import Category, ProductInstance, ProductType, Recipe, RecipeItem
+from .importer import IMPORT_EXTENSIONS, save_upload
+from .models import (
+    Category,
+    ProductInstance,
+    ProductType,
+    Recipe,
+    RecipeItem,
+    RecostTask,
+    SearchTerm,
+)
+from .purchases import import_purchases
 from .serializers import (
     CategorySerializer,
+    FieldSelection,
+    PriceSimulationSerializer,
     ProductInstanceSerializer,
     ProductTypeSerializer,
     RecipeItemSerializer,
     RecipeSerializer,
 )
+from .simulation import simulate_recipe_costs
+
+# Recipe costing modes
+PRICING_PURCHASE = "purchase"
+PRICING_MARKET = "market"
 
 # API ViewSets
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+def export_response(request, export, queryset, name: str):
+    """
+    Stream an export in the format requested with ``?file_format=`` (csv or
+    ndjson). ``format`` is taken by DRF content negotiation.
+    """
+    file_format = request.query_params.get("file_format", FORMAT_CSV)
+    if file_format not in EXPORT_FORMATS:
+        return Response(
+            {"file_format": f"Must be one of {', '.join(EXPORT_FORMATS)}."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    response = StreamingHttpResponse(
+        export(queryset, file_format), content_type=EXPORT_FORMATS[file_format]
+    )
+    response["Content-Disposition"] = f'attachment; filename="{name}.{file_format}"'
+    return response
+
+
+def _bulk_ids(request) -> list:
+    """Return the ``ids`` list of a bulk delete request."""
+    return request.data.get("ids") if isinstance(request.data, dict) else None
+
+
+def select_embedded(queryset, selection: FieldSelection, *path: str):
+    """Join a relation path as far as it is embedded in the response."""
+    related = selection.select_related(*path)
+    return queryset.select_related(related) if related else queryset
+
+
+class CategoryViewSet(CachedReferenceMixin, viewsets.ModelViewSet):
     """API endpoint for categories."""
 
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    ordering = ["id"]
+    reference_name = "categories"
+    reference_object = staticmethod(category)
 
     def get_permissions(self):
         if self.action in ["create", "update", "partial_update", "destroy"]:
@@ -39,13 +113,25 @@ class CategoryViewSet(viewsets.ModelViewSet):
         return [permission() for permission in permission_classes]
 
 
-class ProductTypeViewSet(viewsets.ModelViewSet):
+class ProductTypeViewSet(CachedReferenceMixin, viewsets.ModelViewSet):
     """API endpoint for product types."""
 
     queryset = ProductType.objects.all()
     serializer_class = ProductTypeSerializer
+    ordering = ["id"]
     filterset_fields = ["category", "unit"]
     search_fields = ["name"]
+    search_index = (SearchTerm.KIND_PRODUCT_TYPE, "pk")
+    reference_name = "product_types"
+    reference_object = staticmethod(product_type)
+
+    def get_queryset(self):
+        """Join the category only when it is embedded in the response."""
+        return select_embedded(
+            super().get_queryset(),
+            FieldSelection.from_request(self.request),
+            "category",
+        )
 
     def get_permissions(self):
         if self.action in ["create", "update", "partial_update", "destroy"]:
@@ -55,50 +141,291 @@ class ProductTypeViewSet(viewsets.ModelViewSet):
         return [permission() for permission in permission_classes]
 
 
-class ProductInstanceViewSet(viewsets.ModelViewSet):
+class ProductInstanceViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """API endpoint for product instances."""
 
     serializer_class = ProductInstanceSerializer
     filterset_fields = ["product_type", "unit"]
     search_fields = ["product_type__name"]
+    search_index = (SearchTerm.KIND_PRODUCT_TYPE, "product_type_id")
+    ordering = ["-created_at", "-id"]
+    keyset_ordering = ("-created_at", "-id")
 
     def get_queryset(self):
         """Filter queryset by the current user."""
+        if getattr(self, "swagger_fake_view", False):
+            # Schema generation, there is no user
+            return ProductInstance.objects.none()
+        queryset = select_embedded(
+            ProductInstance.objects.all(),
+            FieldSelection.from_request(self.request),
+            "product_type",
+            "category",
+        )
         if self.request.user.is_staff:
-            return ProductInstance.objects.all()
-        return ProductInstance.objects.filter(user=self.request.user)
+            return queryset
+        return queryset.filter(user=self.request.user)
+
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        """Endpoint for streaming all products as CSV or NDJSON."""
+        return export_response(
+            request,
+            export_products,
+            self.filter_queryset(self.get_queryset()),
+            "products",
+        )
+
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="import",
+        parser_classes=[MultiPartParser],
+    )
+    def import_purchases(self, request):
+        """
+        Endpoint for creating the products of a CSV or Excel (.xlsx) file
+        uploaded as ``file``, with product type, weight, unit and price
+        columns. Invalid rows are skipped and reported, nothing created is
+        a 400 response with the errors of the rows.
+        """
+        upload = request.FILES.get("file")
+        if upload is None:
+            return Response(
+                {"detail": "A file is required."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        extension = os.path.splitext(upload.name)[1].lower().lstrip(".")
+        if extension not in IMPORT_EXTENSIONS:
+            return Response(
+                {"detail": "Only CSV and .xlsx files are supported."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        path = save_upload(upload)
+        try:
+            result = import_purchases(path, request.user)
+        except ValueError as e:
+            return Response(
+                {"detail": f"The file could not be read: {e}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        finally:
+            os.remove(path)
+        return Response(
+            result.as_dict(),
+            status=(
+                status.HTTP_201_CREATED
+                if result.created
+                else status.HTTP_400_BAD_REQUEST
+            ),
+        )
+
+    @action(detail=False, methods=["post", "patch", "delete"])
+    def bulk(self, request):
+        """
+        Endpoint for creating (POST) or updating (PATCH) a list of products,
+        or deleting (DELETE) the products in an ``ids`` list, in one
+        transaction. Invalid batches are rejected with the errors per row.
+        """
+        if request.method == "DELETE":
+            deleted = bulk_delete_products(request.user, _bulk_ids(request))
+            return Response({"deleted": deleted})
+
+        if request.method == "POST":
+            products = bulk_create_products(request.user, request.data)
+        else:
+            products = bulk_update_products(request.user, request.data)
+        return Response(
+            self.get_serializer(products, many=True).data,
+            status=(
+                status.HTTP_201_CREATED
+                if request.method == "POST"
+                else status.HTTP_200_OK
+            ),
+        )
+
+
+def recipe_cost_status(recipe_id: int) -> dict:
+    """
+    Return the stored cost of a recipe, its version and whether a background
+    recost of it is still queued.
+    """
+    return (
+        Recipe.objects.filter(pk=recipe_id)
+        .annotate(cost_pending=Exists(RecostTask.objects.filter(recipe=OuterRef("pk"))))
+        .values("total_cost", "cost_version", "cost_pending")
+        .get()
+    )
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """API endpoint for recipes."""
 
     serializer_class = RecipeSerializer
     search_fields = ["name", "description"]
+    search_index = (SearchTerm.KIND_RECIPE, "pk")
+    ordering = ["-created_at", "-id"]
+    keyset_ordering = ("-created_at", "-id")
 
     def get_queryset(self):
         """Filter queryset by the current user."""
+        if getattr(self, "swagger_fake_view", False):
+            # Schema generation, there is no user
+            return Recipe.objects.none()
+        selection = FieldSelection.from_request(self.request)
+        queryset = Recipe.objects.all()
+        if selection.includes("cost_pending"):
+            queryset = queryset.annotate(
+                cost_pending=Exists(RecostTask.objects.filter(recipe=OuterRef("pk")))
+            )
+        if selection.includes("recipe_items"):
+            if selection.expands("recipe_items"):
+                items = select_embedded(
+                    RecipeItem.objects.all(),
+                    selection.nested("recipe_items"),
+                    "product_instance",
+                    "product_type",
+                    "category",
+                )
+            else:
+                # Only the item IDs are returned
+                items = RecipeItem.objects.only("pk", "recipe_id")
+            queryset = queryset.prefetch_related(
+                Prefetch("recipe_items", queryset=items.order_by("pk"))
+            )
         if self.request.user.is_staff:
-            return Recipe.objects.all()
-        return Recipe.objects.filter(user=self.request.user)
+            return queryset
+        return queryset.filter(user=self.request.user)
+
+    def get_pricing_mode(self) -> str:
+        """
+        Return the costing mode requested with ``?pricing=``: the purchases
+        picked for each ingredient (default) or the latest market prices.
+        """
+        mode = self.request.query_params.get("pricing", PRICING_PURCHASE)
+        if mode not in (PRICING_PURCHASE, PRICING_MARKET):
+            raise ValidationError(
+                {"pricing": f"Must be {PRICING_PURCHASE} or {PRICING_MARKET}."}
+            )
+        return mode
+
+    def get_serializer(self, *args, **kwargs):
+        """Add market costs to the serializer context in market pricing mode."""
+        if args and self.get_pricing_mode() == PRICING_MARKET:
+            recipes = args[0] if kwargs.get("many") else [args[0]]
+            kwargs.setdefault("context", self.get_serializer_context())
+            kwargs["context"]["market_costs"] = market_costs(
+                recipe.pk for recipe in recipes
+            )
+        return super().get_serializer(*args, **kwargs)
 
     @action(detail=True, methods=["post"])
     def recalculate_cost(self, request, pk=None):
-        """Endpoint for recalculating recipe cost."""
+        """
+        Endpoint for recalculating recipe cost. In market pricing mode the
+        cost is calculated at the latest prices without being stored.
+        """
+        recipe = self.get_object()
+        mode = self.get_pricing_mode()
+        if mode == PRICING_MARKET:
+            total_cost = market_costs([recipe.pk])[recipe.pk]
+        else:
+            total_cost = recipe.calculate_total_cost()
+        return Response({"total_cost": total_cost, "pricing": mode})
+
+    @action(detail=True, methods=["get"])
+    def cost_status(self, request, pk=None):
+        """
+        Endpoint for polling the stored cost of a recipe while a background
+        recost is pending.
+        """
+        recipe = self.get_object()
+        return Response(recipe_cost_status(recipe.pk))
+
+    @action(detail=True, methods=["get"])
+    def cost_as_of(self, request, pk=None):
+        """Endpoint for the cost of a recipe at the end of a given date."""
         recipe = self.get_object()
-        total_cost = recipe.calculate_total_cost()
-        return Response({"total_cost": total_cost})
+        day = parse_date(request.query_params.get("date", ""))
+        if day is None:
+            return Response(
+                {"detail": "A valid date (YYYY-MM-DD) is required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response({"date": day, "total_cost": recipe_cost_as_of(recipe, day)})
 
+    @action(detail=True, methods=["get"])
+    def cost_trend(self, request, pk=None):
+        """Endpoint for the daily cost of a recipe over the last days."""
+        recipe = self.get_object()
+        try:
+            days = int(request.query_params.get("days", 90))
+        except ValueError:
+            days = 0
+        if not 1 <= days <= 366:
+            return Response(
+                {"detail": "days must be between 1 and 366."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-class RecipeItemViewSet(viewsets.ModelViewSet):
+        end = timezone.localdate()
+        trend = recipe_cost_trend(recipe, end - timedelta(days=days - 1), end)
+        return Response(
+            {
+                "trend": [
+                    {"date": day, "total_cost": total_cost} for day, total_cost in trend
+                ]
+            }
+        )
+
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        """
+        Endpoint for streaming all recipes with their per-ingredient cost
+        breakdown as CSV or NDJSON.
+        """
+        return export_response(
+            request,
+            export_recipes,
+            self.filter_queryset(self.get_queryset()),
+            "recipes",
+        )
+
+    @action(detail=False, methods=["post"])
+    def simulate(self, request):
+        """Endpoint for simulating recipe costs under price shocks (read-only)."""
+        serializer = PriceSimulationSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        results = simulate_recipe_costs(
+            Recipe.objects.filter(user=request.user),
+            serializer.validated_data["shocks"],
+        )
+        return Response({"results": results})
+
+
+class RecipeItemViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """API endpoint for recipe items."""
 
     serializer_class = RecipeItemSerializer
+    ordering = ["id"]
+    keyset_ordering = ("id",)
 
     def get_queryset(self):
         """Filter queryset by the current user's recipes."""
+        if getattr(self, "swagger_fake_view", False):
+            # Schema generation, there is no user
+            return RecipeItem.objects.none()
+        queryset = select_embedded(
+            RecipeItem.objects.all(),
+            FieldSelection.from_request(self.request),
+            "product_instance",
+            "product_type",
+            "category",
+        )
         if self.request.user.is_staff:
-            return RecipeItem.objects.all()
-        return RecipeItem.objects.filter(recipe__user=self.request.user)
+            return queryset
+        return queryset.filter(recipe__user=self.request.user)
 
     def create(self, request, *args, **kwargs):
         """Override create to validate recipe ownership."""
@@ -117,25 +444,39 @@ class RecipeItemViewSet(viewsets.ModelViewSet):
                 {"detail": "Recipe not found."}, status=status.HTTP_404_NOT_FOUND
             )
 
+        # The recipe total is updated incrementally when the item is saved
         response = super().create(request, *args, **kwargs)
-
-        # Recalculate recipe cost
-        if response.status_code == status.HTTP_201_CREATED:
-            recipe.calculate_total_cost()
-
+        response.data.update(recipe_cost_status(response.data["recipe"]))
         return response
 
-    def destroy(self, request, *args, **kwargs):
-        """Override destroy to recalculate recipe cost after deletion."""
-        instance = self.get_object()
-        recipe = instance.recipe
-
-        response = super().destroy(request, *args, **kwargs)
-
-        # Recalculate recipe cost
-        if response.status_code == status.HTTP_204_NO_CONTENT:
-            recipe.calculate_total_cost()
-
+    @action(detail=False, methods=["post", "patch", "delete"])
+    def bulk(self, request):
+        """
+        Endpoint for adding (POST) or updating (PATCH) a list of recipe items,
+        or deleting (DELETE) the items in an ``ids`` list, in one transaction.
+        Each affected recipe is recalculated once.
+        """
+        if request.method == "DELETE":
+            deleted = bulk_delete_recipe_items(request.user, _bulk_ids(request))
+            return Response({"deleted": deleted})
+
+        if request.method == "POST":
+            items = bulk_create_recipe_items(request.user, request.data)
+        else:
+            items = bulk_update_recipe_items(request.user, request.data)
+        return Response(
+            self.get_serializer(items, many=True).data,
+            status=(
+                status.HTTP_201_CREATED
+                if request.method == "POST"
+                else status.HTTP_200_OK
+            ),
+        )
+
+    def update(self, request, *args, **kwargs):
+        """Override update to report the cost status of the recipe."""
+        response = super().update(request, *args, **kwargs)
+        response.data.update(recipe_cost_status(response.data["recipe"]))
         return response
 
 
@@ -160,13 +501,9 @@ def product_list(request) -> Union[redirect, render]:
     # Filter products by the current user
     products = ProductInstance.objects.filter(user=request.user).order_by("-created_at")
 
-    # Get all product types for JavaScript unit mapping
-    product_types = ProductType.objects.all()
-
     context = {
         "form": form,
         "products": products,
-        "product_types": product_types,
     }
     return render(request, "core/product_list.html", context)
 
@@ -178,6 +515,26 @@ class ProductTypeListView(ListView):
     model = ProductType
     template_name = "core/product_type_list.html"
     context_object_name = "product_types"
+    ordering = ["id"]
+    paginate_by = 50
+
+    def paginate_queryset(self, queryset, page_size):
+        """Serve the pages from the reference cache, never the whole table."""
+
+        def load():
+            paginator, page, objects, _ = super(
+                ProductTypeListView, self
+            ).paginate_queryset(queryset, page_size)
+            return paginator.count, page.number, list(objects)
+
+        number = self.request.GET.get(self.page_kwarg) or 1
+        count, number, objects = get_reference(
+            f"product_types:list:{page_size}:{number}", load
+        )
+        paginator = self.get_paginator(queryset, page_size)
+        paginator.count = count
+        page = Page(objects, number, paginator)
+        return paginator, page, objects, page.has_other_pages()
 
 
 def get_product_type_unit(request) -> JsonResponse:
@@ -189,14 +546,82 @@ def get_product_type_unit(request) -> JsonResponse:
         return JsonResponse({"error": "No product type ID provided"}, status=400)
 
     try:
-        product_type = ProductType.objects.get(id=product_type_id)
-        return JsonResponse({"unit": product_type.unit})
-    except ProductType.DoesNotExist:
-        return JsonResponse({"error": "Product type not found"}, status=404)
+        cached = product_type(int(product_type_id))
+        if cached is None:
+            return JsonResponse({"error": "Product type not found"}, status=404)
+        return JsonResponse({"unit": cached.unit})
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
 
+# Results per page of the autocomplete endpoints
+AUTOCOMPLETE_PAGE_SIZE = 20
+
+
+@login_required
+def product_autocomplete(request) -> JsonResponse:
+    """
+    AJAX view to search the user's products by product type name prefix,
+    in the Select2 format, one page of ``AUTOCOMPLETE_PAGE_SIZE`` at a time.
+    """
+    term = request.GET.get("term", "").strip()
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        return JsonResponse({"error": "Invalid page"}, status=400)
+
+    products = ProductInstance.objects.filter(user=request.user)
+    if term:
+        # Served by the prefix index on the product type name
+        products = products.filter(product_type__name__startswith=term)
+    offset = (page - 1) * AUTOCOMPLETE_PAGE_SIZE
+    # One row more than a page tells whether there is a next one
+    limit = offset + AUTOCOMPLETE_PAGE_SIZE + 1
+    rows = list(
+        products.order_by("product_type__name", "-created_at", "-id").values(
+            "id", "unit", text=F("product_type__name")
+        )[offset:limit]
+    )
+    return JsonResponse(
+        {
+            "results": rows[:AUTOCOMPLETE_PAGE_SIZE],
+            "pagination": {"more": len(rows) > AUTOCOMPLETE_PAGE_SIZE},
+        }
+    )
+
+
+@login_required
+def product_type_autocomplete(request) -> JsonResponse:
+    """
+    AJAX view to search product types by name prefix with their units, in
+    the Select2 format, one page of ``AUTOCOMPLETE_PAGE_SIZE`` at a time.
+    """
+    term = request.GET.get("term", "").strip()
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        return JsonResponse({"error": "Invalid page"}, status=400)
+
+    product_types = ProductType.objects.all()
+    if term:
+        # Served by the prefix index on the name
+        product_types = product_types.filter(name__startswith=term)
+    offset = (page - 1) * AUTOCOMPLETE_PAGE_SIZE
+    # One row more than a page tells whether there is a next one
+    limit = offset + AUTOCOMPLETE_PAGE_SIZE + 1
+    rows = list(
+        product_types.order_by("name", "id").values("id", "unit", text=F("name"))[
+            offset:limit
+        ]
+    )
+    return JsonResponse(
+        {
+            "results": rows[:AUTOCOMPLETE_PAGE_SIZE],
+            "pagination": {"more": len(rows) > AUTOCOMPLETE_PAGE_SIZE},
+        }
+    )
+
+
 @login_required
 def recipe_list(request) -> render:
     """
@@ -242,19 +667,17 @@ def recipe_detail(request, recipe_id: int) -> Union[redirect, render]:
 
     # Form for adding new ingredient
     if request.method == "POST":
-        form = RecipeItemForm(request.user, request.POST)
+        form = RecipeItemForm(
+            request.user, request.POST, instance=RecipeItem(recipe=recipe)
+        )
         if form.is_valid():
-            recipe_item = form.save(commit=False)
-            recipe_item.recipe = recipe
-            recipe_item.save()
-
-            # Update the total cost of the recipe
-            recipe.calculate_total_cost()
+            # Saving the item updates the total cost of the recipe
+            form.save()
 
             messages.success(request, "ماده اولیه با موفقیت اضافه شد.")
             return redirect("recipe_detail", recipe_id=recipe.id)
     else:
-        form = RecipeItemForm(request.user)
+        form = RecipeItemForm(request.user, instance=RecipeItem(recipe=recipe))
 
     # Calculate statistics
     profit = recipe.calculate_profit()
@@ -283,11 +706,9 @@ def recipe_item_delete(request, item_id: int) -> redirect:
         messages.error(request, "شما اجازه حذف این ماده را ندارید.")
         return redirect("recipe_list")
 
+    # Deleting the item updates the total cost of the recipe
     recipe_item.delete()
 
-    # Update the total cost of the recipe
-    recipe.calculate_total_cost()
-
     messages.success(request, "ماده اولیه با موفقیت حذف شد.")
     return redirect("recipe_detail", recipe_id=recipe.id)
 
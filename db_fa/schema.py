@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from drf_yasg import openapi
+from drf_yasg.codecs import yaml_sane_dump
+from drf_yasg.generators import OpenAPISchemaGenerator
+from drf_yasg.renderers import (
+    OpenAPIRenderer,
+    SwaggerJSONRenderer,
+    SwaggerYAMLRenderer,
+)
+from drf_yasg.views import get_schema_view
+from rest_framework import permissions
+
+INFO = openapi.Info(
+    title="DB-FA API",
+    default_version="v1",
+    description="API for DB-FA food and recipe management",
+    terms_of_service="https://www.yourapp.com/terms/",
+    contact=openapi.Contact(email="contact@yourapp.com"),
+    license=openapi.License(name="Your License"),
+)
+
+# Key of the code version in the stored schema
+VERSION_KEY = "x-code-version"
+
+# Directories never part of the code version
+IGNORED_DIRS = {"__pycache__", "node_modules", "venv", "static", "media"}
+
+# Rendered schema documents and ETags by format, built once per process
+_documents: Dict[str, Tuple[bytes, str]] = {}
+_documents_lock = Lock()
+
+
+@lru_cache(maxsize=None)
+def code_version() -> str:
+    """
+    Return the version of the running code: the ``CODE_VERSION`` setting, or
+    a hash of the names and contents of the Python files, which unlike their
+    modification times is the same in every checkout of the same code.
+    """
+    if settings.CODE_VERSION:
+        return settings.CODE_VERSION
+
+    digest = hashlib.md5()
+    for root, dirs, files in os.walk(settings.BASE_DIR):
+        dirs[:] = sorted(
+            name
+            for name in dirs
+            if not name.startswith(".") and name not in IGNORED_DIRS
+        )
+        for name in sorted(files):
+            if name.endswith(".py"):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, settings.BASE_DIR).encode())
+                with open(path, "rb") as f:
+                    digest.update(hashlib.md5(f.read()).digest())
+    return digest.hexdigest()
+
+
+def generate_schema() -> OrderedDict:
+    """Introspect every endpoint and return the public schema."""
+    schema = OpenAPISchemaGenerator(INFO).get_schema(request=None, public=True)
+    spec = schema.as_odict()
+    spec[VERSION_KEY] = code_version()
+    return spec
+
+
+def read_schema_file() -> Optional[OrderedDict]:
+    """
+    Return the schema written by ``generate_schema``, if it was generated
+    for the running code.
+    """
+    try:
+        with open(settings.SCHEMA_FILE, encoding="utf-8") as f:
+            spec = json.load(f, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError):
+        return None
+    if spec.get(VERSION_KEY) != code_version():
+        return None
+    return spec
+
+
+def write_schema_file(spec: OrderedDict) -> None:
+    """Store a schema to be served without introspection."""
+    with open(settings.SCHEMA_FILE, "w", encoding="utf-8") as f:
+        json.dump(spec, f, ensure_ascii=False)
+
+
+def schema_documents() -> Dict[str, Tuple[bytes, str]]:
+    """
+    Return the schema as JSON and YAML documents with their ETags.
+
+    The schema is read from the schema file, or generated if it is missing
+    or stale, once per process.
+    """
+    with _documents_lock:
+        if not _documents:
+            spec = read_schema_file() or generate_schema()
+            content = json.dumps(spec, ensure_ascii=False).encode()
+            for name, document in [
+                ("json", content),
+                ("yaml", yaml_sane_dump(spec, binary=True)),
+            ]:
+                etag = hashlib.md5(document).hexdigest()
+                _documents[name] = (document, quote_etag(etag))
+        return _documents
+
+
+SchemaView = get_schema_view(
+    INFO,
+    public=True,
+    permission_classes=(permissions.AllowAny,),
+)
+
+
+class CachedSchemaView(SchemaView):
+    """
+    Schema view serving the schema documents from memory, with ETags.
+
+    The UI pages do not embed the schema and are rendered as usual.
+    """
+
+    def get(self, request, version="", format=None):
+        renderer = request.accepted_renderer
+        if not isinstance(
+            renderer, (OpenAPIRenderer, SwaggerJSONRenderer, SwaggerYAMLRenderer)
+        ):
+            return super().get(request, version, format)
+
+        document_format = (
+            "yaml" if isinstance(renderer, SwaggerYAMLRenderer) else "json"
+        )
+        content, etag = schema_documents()[document_format]
+        response = get_conditional_response(request._request, etag=etag)
+        if response is None:
+            response = HttpResponse(content, content_type=renderer.media_type)
+            response["ETag"] = etag
+        return response
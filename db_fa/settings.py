@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -155,11 +156,13 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
-    "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
+    # Page numbers by default, keyset pagination with ?cursor= where supported
+    "DEFAULT_PAGINATION_CLASS": "core.pagination.KeysetOrPageNumberPagination",
     "PAGE_SIZE": 20,
     "DEFAULT_FILTER_BACKENDS": [
         "django_filters.rest_framework.DjangoFilterBackend",
-        "rest_framework.filters.SearchFilter",
+        # Searches the normalized search index of views with a search_index
+        "core.search.NormalizedSearchFilter",
         "rest_framework.filters.OrderingFilter",
     ],
 }
@@ -171,3 +174,57 @@ SWAGGER_SETTINGS = {
     },
     "USE_SESSION_AUTH": False,
 }
+
+# Background recipe recosting
+# Disabled by default: recipes using a changed sub-recipe are re-costed on the
+# request path. When enabled, they are re-costed by in-process worker threads
+# at most RECOST_DEBOUNCE_SECONDS after the first change, coalescing the
+# changes made in between.
+RECOST_ASYNC = os.getenv("RECOST_ASYNC", "False").lower() in ["true", "1", "yes"]
+RECOST_DEBOUNCE_SECONDS = float(os.getenv("RECOST_DEBOUNCE_SECONDS", "2"))
+RECOST_POLL_SECONDS = float(os.getenv("RECOST_POLL_SECONDS", "1"))
+# Set to 0 to process the queue only with the process_recost_queue command
+RECOST_WORKERS = int(os.getenv("RECOST_WORKERS", "2"))
+
+# Product type imports uploaded in the admin run in a background thread, with
+# their progress in ImportJob. Set to False to import on the request path.
+IMPORT_ASYNC = os.getenv("IMPORT_ASYNC", "True").lower() in ["true", "1", "yes"]
+# Running jobs without progress for this long died with their process (e.g. on
+# a restart) and are failed, keeping their file so they can be retried.
+IMPORT_STALE_SECONDS = float(os.getenv("IMPORT_STALE_SECONDS", "300"))
+# Where uploaded import files wait for their job
+IMPORT_UPLOAD_DIR = os.getenv("IMPORT_UPLOAD_DIR") or os.path.join(
+    tempfile.gettempdir(), "db_fa_imports"
+)
+
+# Caching
+# Categories and product types are served from an in-process LRU in front of
+# this cache, invalidated through a shared version stamp on every change.
+CACHES = {
+    "default": {
+        # e.g. django.core.cache.backends.redis.RedisCache with a redis:// URL.
+        # The default is per process, so with several workers a shared
+        # backend is required for invalidations to reach every worker.
+        "BACKEND": os.getenv("CACHE_BACKEND")
+        or "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": os.getenv("CACHE_LOCATION") or "db-fa",
+    }
+}
+REFERENCE_CACHE_TIMEOUT = int(os.getenv("REFERENCE_CACHE_TIMEOUT") or 3600)
+REFERENCE_CACHE_LOCAL_SIZE = int(os.getenv("REFERENCE_CACHE_LOCAL_SIZE") or 1000)
+REFERENCE_CACHE_LOCAL_TIMEOUT = float(os.getenv("REFERENCE_CACHE_LOCAL_TIMEOUT") or 5)
+
+# API schema
+# Version of the deployed code, e.g. the git commit. The stored and cached
+# API schema is regenerated when it changes. Defaults to a hash of the
+# contents of the Python sources.
+CODE_VERSION = os.getenv("CODE_VERSION", "")
+# Written by the generate_schema command, served instead of introspecting
+SCHEMA_FILE = os.getenv("SCHEMA_FILE") or str(BASE_DIR / "openapi.json")
+
+# Admin
+# Changelists above this many rows (as estimated by the PostgreSQL planner)
+# show the estimate instead of running COUNT(*)
+ADMIN_ESTIMATED_COUNT_THRESHOLD = int(
+    os.getenv("ADMIN_ESTIMATED_COUNT_THRESHOLD") or 100000
+)
@@ -17,24 +17,9 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import include, path, re_path
-from drf_yasg import openapi
-from drf_yasg.views import get_schema_view
-from rest_framework import permissions
 from rest_framework.authtoken.views import obtain_auth_token
 
-# Create schema view for API documentation
-schema_view = get_schema_view(
-    openapi.Info(
-        title="DB-FA API",
-        default_version="v1",
-        description="API for DB-FA food and recipe management",
-        terms_of_service="https://www.yourapp.com/terms/",
-        contact=openapi.Contact(email="contact@yourapp.com"),
-        license=openapi.License(name="Your License"),
-    ),
-    public=True,
-    permission_classes=(permissions.AllowAny,),
-)
+from .schema import CachedSchemaView
 
 urlpatterns = [
     path("admin/", admin.site.urls),
@@ -46,15 +31,19 @@ urlpatterns = [
     # API Documentation
     re_path(
         r"^swagger(?P<format>\.json|\.yaml)$",
-        schema_view.without_ui(cache_timeout=0),
+        CachedSchemaView.without_ui(cache_timeout=0),
         name="schema-json",
     ),
     path(
         "swagger/",
-        schema_view.with_ui("swagger", cache_timeout=0),
+        CachedSchemaView.with_ui("swagger", cache_timeout=0),
         name="schema-swagger-ui",
     ),
-    path("redoc/", schema_view.with_ui("redoc", cache_timeout=0), name="schema-redoc"),
+    path(
+        "redoc/",
+        CachedSchemaView.with_ui("redoc", cache_timeout=0),
+        name="schema-redoc",
+    ),
     # Legacy URLs (can be removed after migration to API is complete)
     path("", include("users.urls")),
     path("products/", include("core.urls")),
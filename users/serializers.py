@@ -1,16 +1,17 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
 
+from core.serializers import DynamicFieldsMixin
 from users.models import Profile
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Profile
         fields = "__all__"
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     profile = ProfileSerializer(read_only=True)
     password = serializers.CharField(write_only=True)
 
@@ -8,6 +8,8 @@ from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from core.serializers import FieldSelection
+
 from .models import Profile
 from .serializers import ProfileSerializer, UserSerializer
 
@@ -69,9 +71,15 @@ class UserViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         """Filter queryset for non-admin users to see only their own data."""
+        if getattr(self, "swagger_fake_view", False):
+            # Schema generation, there is no user
+            return User.objects.none()
+        queryset = User.objects.all()
+        if FieldSelection.from_request(self.request).includes("profile"):
+            queryset = queryset.select_related("profile")
         if self.request.user.is_staff:
-            return User.objects.all()
-        return User.objects.filter(id=self.request.user.id)
+            return queryset
+        return queryset.filter(id=self.request.user.id)
 
 
 class ProfileViewSet(viewsets.ModelViewSet):
@@ -83,6 +91,9 @@ class ProfileViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         """Filter queryset for non-admin users to see only their own data."""
+        if getattr(self, "swagger_fake_view", False):
+            # Schema generation, there is no user
+            return Profile.objects.none()
         if self.request.user.is_staff:
             return Profile.objects.all()
         return Profile.objects.filter(user=self.request.user)